@@ -0,0 +1,1442 @@
+import os
+import time
+import resource
+import tempfile
+import random
+import argparse
+import threading
+import subprocess
+from util.detector import Detector
+from util.events import EventBus
+
+parser = argparse.ArgumentParser(description='simpleCam benchmarks')
+parser.add_argument('scenario', help='Benchmark to run')
+parser.add_argument('--duration', type=float, default=10,
+                    help='Seconds per measurement')
+parser.add_argument('--fps', type=int, default=30,
+                    help='Frame rate of synthetic video')
+parser.add_argument('--clip', help='Recorded video clip to replay')
+parser.add_argument('--wav', help='Recorded WAV file to replay')
+parser.add_argument('--timeline', default='0:0,2:1,4:0,6:1,8:0',
+                    help='PIR timeline as "seconds:state,..."')
+parser.add_argument('--event-at', type=float,
+                    help='Media time in seconds at which the reference event starts')
+parser.add_argument('--speed', type=float, default=10,
+                    help='Replay speed of scripted GPIO timelines')
+
+
+class SyntheticDetector(threading.Thread, Detector):
+    def __init__(self, name, bus, interval):
+        threading.Thread.__init__(self, daemon=True)
+
+        self.name = name
+        self.bus = bus
+        self.interval = interval
+
+    def run(self):
+        """Toggle detection state at random intervals."""
+        while True:
+            time.sleep(random.uniform(0, self.interval))
+            self.set_detected(not self.detected())
+
+
+def synthetic_detectors(bus):
+    """
+    Start one synthetic detector per real worker.
+
+    @param EventBus bus
+    @return list(SyntheticDetector)
+    """
+    detectors = [
+        SyntheticDetector('NoiseDetector', bus, 2),
+        SyntheticDetector('MotionDetector', bus, 3),
+        SyntheticDetector('PIRDetector', bus, 5),
+    ]
+
+    for d in detectors:
+        d.start()
+
+    return detectors
+
+
+def measure_cpu(loop, duration):
+    """
+    Run loop for duration seconds and return the CPU usage of the process.
+
+    @param callable loop
+    @param float duration
+    @return float CPU usage in percent of one core
+    """
+    start_wall = time.time()
+    start_cpu = time.process_time()
+
+    loop(start_wall + duration)
+
+    return (time.process_time() - start_cpu) * 100 / (time.time() - start_wall)
+
+
+def bench_watch(args):
+    """Compare CPU usage of the busy-polling watch loop with the event-driven one."""
+    bus = EventBus()
+    detectors = synthetic_detectors(bus)
+
+    def polling(deadline):
+        while time.time() < deadline:
+            for t in detectors:
+                if t.detected():
+                    break
+
+    def event_driven(deadline):
+        while time.time() < deadline:
+            bus.wait(max(0, deadline - time.time()))
+
+    print('Polling:      {:6.1f}% CPU'.format(measure_cpu(polling, args.duration)))
+    print('Event-driven: {:6.1f}% CPU'.format(measure_cpu(event_driven, args.duration)))
+
+
+def bench_recorder(args):
+    """Feed synthetic frames through the streaming recorder and report peak RSS, drops and stop latency."""
+    import cv2
+    import numpy as np
+    from util.video_writer import VideoWriter
+
+    frame = np.random.randint(0, 255, (240, 320, 3), np.uint8)
+    codec = cv2.VideoWriter_fourcc('M', 'J', 'P', 'G')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        writer = VideoWriter(os.path.join(tmp, 'bench.avi'), codec, args.fps, (320, 240))
+        writer.start()
+
+        start = time.time()
+        num_frames = int(args.duration * args.fps)
+
+        for i in range(num_frames):
+            writer.write(frame.copy())
+
+            # Pace like a camera would
+            time.sleep(max(0, start + (i + 1) / args.fps - time.time()))
+
+            if i % (args.fps * 5) == 0:
+                print('{:5.0f}s peak RSS: {:.1f} MB'.format(
+                    time.time() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+        stop = time.time()
+        writer.close()
+
+        print('Frames written: {}, dropped: {}'.format(writer.written, writer.dropped))
+        print('Stop latency: {:.3f}s'.format(time.time() - stop))
+
+
+def make_clip(folder, name, duration):
+    """
+    Create a synthetic AVI (MJPG) and WAV pair like the recorders would.
+
+    @param string folder
+    @param string name
+    @param float duration
+    """
+    subprocess.run(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y',
+                    '-f', 'lavfi', '-i', 'testsrc=size=320x240:rate=30',
+                    '-t', str(duration), '-c:v', 'mjpeg', os.path.join(folder, name + '.avi')], check=True)
+    subprocess.run(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y',
+                    '-f', 'lavfi', '-i', 'sine=frequency=440:sample_rate=44100',
+                    '-t', str(duration), '-ac', '1', os.path.join(folder, name + '.wav')], check=True)
+
+
+def bench_merge(args):
+    """Compare wall time and bytes written of the legacy two-step merge with the single-pass one."""
+    from util.merger import merge_command
+
+    with tempfile.TemporaryDirectory() as tmp:
+        make_clip(tmp, 'clip', args.duration)
+        avi, wav = os.path.join(tmp, 'clip.avi'), os.path.join(tmp, 'clip.wav')
+
+        # Legacy: AVI -> MP4, then MP4 + WAV -> MP4
+        start = time.time()
+        intermediate, legacy = os.path.join(tmp, 'intermediate.mp4'), os.path.join(tmp, 'legacy.mp4')
+        subprocess.run(['ffmpeg', '-y', '-i', avi, intermediate], capture_output=True, check=True)
+        subprocess.run(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y', '-i', wav, '-i', intermediate,
+                        '-c:v', 'copy', '-c:a', 'aac', '-strict', 'experimental', legacy], check=True)
+        legacy_time = time.time() - start
+        legacy_bytes = os.path.getsize(intermediate) + os.path.getsize(legacy)
+
+        # Single pass
+        start = time.time()
+        single = os.path.join(tmp, 'single.mp4')
+        subprocess.run(merge_command(avi, wav, single), check=True)
+        single_time = time.time() - start
+        single_bytes = os.path.getsize(single)
+
+        print('Two-step:    {:6.2f}s {:10d} bytes written'.format(legacy_time, legacy_bytes))
+        print('Single-pass: {:6.2f}s {:10d} bytes written'.format(single_time, single_bytes))
+
+
+def bench_segments(args):
+    """Compare merging every short clip on its own with cutting them from continuously encoded segments."""
+    from util.merger import Merger
+    from util.segments import SegmentStore
+
+    clips, clip_length, segment_length, recorded = 10, 3, 10, 60
+    events = sorted(random.uniform(0, recorded - clip_length) for i in range(clips))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        archive, segment_dir = os.path.join(tmp, 'archive'), os.path.join(tmp, 'segments')
+        os.mkdir(archive)
+        os.mkdir(segment_dir)
+
+        # Event mode: every trigger creates its own recording and pays a full merge
+        for i in range(clips):
+            make_clip(tmp, 'event{}'.format(i), clip_length)
+
+        merger = Merger(workers=0)
+        start = time.time()
+
+        for i in range(clips):
+            merger.merge('event{}'.format(i), tmp, archive)
+
+        merged = time.time() - start
+
+        # Continuous mode: segments are encoded as they're recorded, events only cut them
+        for i in range(recorded // segment_length):
+            make_clip(tmp, 'segment{}'.format(i), segment_length)
+
+        store = SegmentStore(segment_dir, retention=recorded * 10)
+        base = time.time()
+        start = time.time()
+
+        for i in range(recorded // segment_length):
+            store.add('segment{}'.format(i), tmp, base + i * segment_length, base + (i + 1) * segment_length)
+
+        store.close()
+        encoded = time.time() - start
+        start = time.time()
+
+        for i, at in enumerate(events):
+            store.mark('clip{}'.format(i), base + at, base + at + clip_length, ['MotionDetector'], archive)
+
+        store.close()
+        cut = time.time() - start
+
+        print('Event mode, {} merges:            {:6.2f}s, {:.3f}s per clip'.format(clips, merged, merged / clips))
+        print('Continuous, encoding {}s of segments: {:6.2f}s regardless of events'.format(recorded, encoded))
+        print('Continuous, {} cuts:               {:6.2f}s, {:.3f}s per clip'.format(clips, cut, cut / clips))
+
+
+def bench_ingest(args):
+    """Compare CPU time of streaming through loopback devices and merging with ingesting through a single ffmpeg."""
+    from util.merger import merge_command
+    from util.segments import concat_list, cut_command
+    from util.ingest import ingest_command, SEGMENT_LIST
+
+    size, fps, rate = (320, 240), args.fps, 44100
+    inputs = ['-f', 'lavfi', '-t', str(args.duration), '-i', 'sine=frequency=440:sample_rate={}'.format(rate),
+              '-f', 'lavfi', '-t', str(args.duration), '-i', 'testsrc=size={}x{}:rate={}'.format(size[0], size[1], fps)]
+
+    def cpu():
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return usage.ru_utime + usage.ru_stime
+
+    with tempfile.TemporaryDirectory() as tmp:
+        hls, segment_dir = os.path.join(tmp, 'stream'), os.path.join(tmp, 'segments')
+        os.mkdir(hls)
+        os.mkdir(segment_dir)
+
+        # Legacy: HLS encode with raw copies for the loopback devices, recorder encodes MJPEG, merge re-encodes
+        start = cpu()
+        subprocess.run(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y'] + inputs + [
+            '-map', '1:v', '-map', '0:a', '-c:v', 'libx264', '-preset', 'ultrafast', '-tune', 'zerolatency',
+            '-c:a', 'aac', '-b:a', '128k', '-f', 'hls', '-hls_time', '1', '-hls_list_size', '10',
+            '-hls_flags', 'delete_segments', os.path.join(hls, 'index.m3u8'),
+            '-map', '1:v', '-f', 'rawvideo', '-pix_fmt', 'bgr24', os.devnull,
+            '-map', '0:a', '-f', 's16le', os.devnull], check=True)
+        make_clip(tmp, 'clip', args.duration)
+        subprocess.run(merge_command(os.path.join(tmp, 'clip.avi'), os.path.join(tmp, 'clip.wav'),
+                                     os.path.join(tmp, 'legacy.mp4')), check=True)
+        legacy = cpu() - start
+
+        # Ingest: one encode for stream and segments, raw copies on pipes, clip is cut without re-encoding
+        start = cpu()
+
+        with open(os.devnull, 'wb') as null:
+            subprocess.run(ingest_command(inputs, size, rate, 1, null.fileno(), hls, segment_dir, 2),
+                           stdout=null, pass_fds=(null.fileno(),), check=True)
+
+        with open(os.path.join(segment_dir, SEGMENT_LIST)) as f:
+            segments = [line.strip().rsplit(',', 2) for line in f]
+
+        segments = [{'path': os.path.join(segment_dir, name), 'start': float(s), 'end': float(e)} for name, s, e in segments]
+        list_path = os.path.join(tmp, 'clip.txt')
+
+        with open(list_path, 'w') as f:
+            f.write(concat_list(segments, 0, args.duration))
+
+        subprocess.run(cut_command(list_path, os.path.join(tmp, 'ingest.mp4')), check=True)
+        ingest = cpu() - start
+
+        print('Loopback + merge: {:6.2f} CPU seconds for {:.0f}s of video'.format(legacy, args.duration))
+        print('Single ingest:    {:6.2f} CPU seconds for {:.0f}s of video'.format(ingest, args.duration))
+
+
+def bench_listing(args):
+    """Compare listing a large archive by scanning the folder with filtering the listing the way the server does."""
+    import json
+    from util.archive_index import ArchiveIndex, COLUMNS
+
+    clips = 20000
+    sources = ['MotionDetector', 'NoiseDetector', 'PIRDetector']
+
+    with tempfile.TemporaryDirectory() as tmp:
+        index = ArchiveIndex(tmp)
+        base = time.time() - clips * 600
+        rows = []
+
+        for i in range(clips):
+            name = time.strftime('%Y%m%d_%H%M%S', time.localtime(base + i * 600))
+            open(os.path.join(tmp, name + '.mp4'), 'w').close()
+            rows.append((name, base + i * 600, 10.0, 1000000, random.choice(sources), 5.0, 800.0, name + '.jpg', '[]'))
+
+        index.db.executemany('INSERT INTO records ({}) VALUES ({})'.format(
+            ', '.join(COLUMNS), ','.join('?' * len(COLUMNS))), rows)
+        index.db.commit()
+
+        start = time.perf_counter()
+        names = sorted((f[:-4] for f in os.listdir(tmp) if f.endswith('.mp4')), reverse=True)[:50]
+        scan = time.perf_counter() - start
+
+        start = time.perf_counter()
+        index.write_listing()
+        listing = time.perf_counter() - start
+
+        # The server re-reads records.json after every change and filters it in memory
+        start = time.perf_counter()
+
+        with open(index.listing_path) as f:
+            records = json.load(f)
+
+        parse = time.perf_counter() - start
+
+        start = time.perf_counter()
+        records = [r for r in records if 'PIRDetector' in r['sources'] and r['started'] >= base + clips * 300][100:150]
+        page = time.perf_counter() - start
+
+        print('{} clips'.format(clips))
+        print('Folder scan, first page:          {:8.2f} ms (no metadata, no filters)'.format(scan * 1000))
+        print('Loading records.json after change: {:7.2f} ms'.format(parse * 1000))
+        print('Filtered page from the listing:   {:8.2f} ms'.format(page * 1000))
+        print('Rewriting records.json per clip:  {:8.2f} ms ({:.1f} MB)'.format(
+            listing * 1000, os.path.getsize(index.listing_path) / 1024 / 1024))
+
+
+def bench_compact(args):
+    """Size and CPU cost of compacting a synthetic clip with the retention settings."""
+    from util.merger import merge_command
+    from util.retention import compact_command
+
+    def cpu():
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return usage.ru_utime + usage.ru_stime
+
+    with tempfile.TemporaryDirectory() as tmp:
+        subprocess.run(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y',
+                        '-f', 'lavfi', '-i', 'testsrc=size=1280x720:rate=30', '-t', str(args.duration),
+                        '-c:v', 'mjpeg', os.path.join(tmp, 'clip.avi')], check=True)
+        clip, compacted = os.path.join(tmp, 'clip.mp4'), os.path.join(tmp, 'compacted.mp4')
+        subprocess.run(merge_command(os.path.join(tmp, 'clip.avi'), None, clip), check=True)
+
+        for height, crf in ((720, 28), (480, 30), (360, 32)):
+            start, wall = cpu(), time.time()
+            subprocess.run(compact_command(clip, compacted, height, crf), check=True)
+
+            print('{}p crf {}: {:5.1f} MB -> {:5.1f} MB, {:.2f} CPU s, {:.2f} s wall per minute of video'.format(
+                height, crf, os.path.getsize(clip) / 1024 ** 2, os.path.getsize(compacted) / 1024 ** 2,
+                (cpu() - start) * 60 / args.duration, (time.time() - wall) * 60 / args.duration))
+
+
+def record_flash_clip(folder, name, duration, fps, timestamped):
+    """
+    Record a clip with a white flash and a click every two seconds like an irregular camera and a microphone would.
+    The camera runs 2% fast, jitters and loses 5% of its frames, audio starts 0.37s after video.
+
+    @param string folder
+    @param string name
+    @param float duration
+    @param int fps Nominal frame rate
+    @param bool timestamped Place frames by capture time, otherwise write them back to back like before
+    @return tuple(list(float), list(float)) Event times relative to the start of the video and capture times of the first frame showing each flash
+    """
+    import wave
+    import cv2
+    import numpy as np
+    from util.video_writer import VideoWriter, BLOCK
+    from util.recorder import write_start_time
+
+    rng = np.random.default_rng(1)
+    events = list(np.arange(1, duration - 1, 2.0))
+    size = (160, 120)
+    dark, white = np.zeros((size[1], size[0], 3), np.uint8), np.full((size[1], size[0], 3), 255, np.uint8)
+
+    # Capture times of the frames that made it
+    times = np.arange(0, duration, 1 / (fps * 1.02))
+    times = np.sort(times + rng.normal(0, 0.004, len(times)))
+    times = times[rng.random(len(times)) > 0.05]
+
+    path = os.path.join(folder, name + '.avi')
+    codec = cv2.VideoWriter_fourcc('M', 'J', 'P', 'G')
+
+    if timestamped:
+        writer = VideoWriter(path, codec, fps, size, drop_policy=BLOCK)
+    else:
+        # Frame rate reconstructed from the frame count like the recorder used to
+        writer = VideoWriter(path, codec, int(len(times) / duration), size, drop_policy=BLOCK)
+
+    writer.start()
+
+    # A flash can only show on the next frame the camera delivers
+    shown = [times[times >= e][0] for e in events]
+
+    for t in times:
+        flash = any(e <= t < e + 0.2 for e in events)
+        writer.write(white if flash else dark, t if timestamped else None)
+
+    writer.close()
+
+    if timestamped:
+        write_start_time(path, writer.start_time)
+
+    # 20ms clicks, audio starting late
+    rate, audio_start = 44100, 0.37
+    samples = np.zeros(int((duration - audio_start) * rate), np.int16)
+
+    for e in events:
+        i = int((e - audio_start) * rate)
+        samples[i:i + rate // 50] = 20000
+
+    path = os.path.join(folder, name + '.wav')
+    wf = wave.open(path, 'wb')
+    wf.setnchannels(1)
+    wf.setsampwidth(2)
+    wf.setframerate(rate)
+    wf.writeframes(samples.tobytes())
+    wf.close()
+
+    if timestamped:
+        write_start_time(path, audio_start)
+
+    return events, shown
+
+
+def flash_click_offsets(path):
+    """
+    Find flashes and clicks in a merged clip.
+
+    @param string path
+    @return tuple(list(float), list(float)) Onset times of flashes, onset times of clicks
+    """
+    import cv2
+    import numpy as np
+
+    capture = cv2.VideoCapture(path)
+    fps = capture.get(cv2.CAP_PROP_FPS)
+    brightness = []
+    grabbed, frame = capture.read()
+
+    while grabbed:
+        brightness.append(frame.mean())
+        grabbed, frame = capture.read()
+
+    capture.release()
+
+    bright = np.array(brightness) > 127
+    flashes = np.flatnonzero(bright[1:] & ~bright[:-1]) + 1
+
+    # Decode audio padded to the container's start time
+    rate = 44100
+    pcm = subprocess.run(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-i', path, '-map', '0:a',
+                          '-af', 'aresample=async=1:first_pts=0', '-f', 's16le', '-ac', '1', '-ar', str(rate), '-'],
+                         capture_output=True, check=True).stdout
+    loud = np.abs(np.frombuffer(pcm, np.int16)) > 10000
+    onsets = np.flatnonzero(loud[1:] & ~loud[:-1]) + 1
+    # AAC rings a little, only keep onsets after a quiet second
+    clicks = [i for j, i in enumerate(onsets) if j == 0 or i - onsets[j - 1] > rate]
+
+    return list(flashes / fps), [i / rate for i in clicks]
+
+
+def bench_sync(args):
+    """
+    Measure A/V drift of merged recordings with a synthetic flash and click every two seconds.
+    Fails unless every event is found in the timestamped recording, its typical offset is within a frame
+    and it doesn't drift by a frame or more between the first and last third of the clip.
+    Single events may be off by more when the writer skips the flash's first frame, so the median is checked.
+    """
+    import sys
+    import statistics
+    from util.merger import Merger
+
+    tolerance = 1.0 / args.fps
+    failures = []
+
+    for timestamped in (False, True):
+        with tempfile.TemporaryDirectory() as tmp:
+            events, shown = record_flash_clip(tmp, 'sync', args.duration, args.fps, timestamped)
+            Merger().merge('sync', tmp, tmp)
+            flashes, clicks = flash_click_offsets(os.path.join(tmp, 'sync.mp4'))
+
+        # Video minus audio per event, positive if the flash shows late
+        offsets = [f - c for f, c in zip(flashes, clicks)]
+        # What's left once the camera's delay in showing the flash is taken out
+        errors = [o - (s - e) for o, s, e in zip(offsets, shown, events)]
+
+        if len(offsets) < len(events):
+            print('Only found {} of {} events'.format(len(offsets), len(events)))
+
+            if timestamped:
+                failures.append('only {} of {} events found'.format(len(offsets), len(events)))
+
+        if not offsets:
+            continue
+
+        third = max(len(errors) // 3, 1)
+        error = statistics.median(errors)
+        drift = statistics.median(errors[-third:]) - statistics.median(errors[:third])
+
+        print('{:12s} A/V offset first: {:+.3f}s, last: {:+.3f}s, median error: {:+.3f}s, drift: {:+.3f}s, max error: {:.3f}s'.format(
+            'Timestamped:' if timestamped else 'Frame count:', offsets[0], offsets[-1], error, drift, max(abs(e) for e in errors)))
+
+        # The legacy frame-count recording is only shown for comparison
+        if not timestamped:
+            continue
+
+        if abs(error) >= tolerance:
+            failures.append('median error {:+.3f}s is not within a frame ({:.3f}s)'.format(error, tolerance))
+
+        if abs(drift) >= tolerance:
+            failures.append('drifted {:+.3f}s, not within a frame ({:.3f}s)'.format(drift, tolerance))
+
+    if failures:
+        sys.exit('FAIL: {}'.format(', '.join(failures)))
+
+    print("OK: timestamped recording stays within a frame and doesn't drift")
+
+
+def bench_window(args):
+    """Compare per-sample cost of the deque + list comprehension observer with the numpy sliding window."""
+    from collections import deque
+    from util.sliding_window import SlidingWindow
+
+    size = 5 * 44100 // 1024
+    threshold = 0.5
+    samples = [random.random() for i in range(100000)]
+
+    observer = deque(maxlen=size)
+    start = time.perf_counter()
+
+    for x in samples:
+        observer.append(x)
+        sum([v > threshold for v in observer]) > 0
+
+    legacy = (time.perf_counter() - start) / len(samples)
+
+    window = SlidingWindow(size, threshold)
+    start = time.perf_counter()
+
+    for x in samples:
+        window.append(x)
+        window.exceeded > 0
+
+    vectorized = (time.perf_counter() - start) / len(samples)
+
+    print('Window size: {}'.format(size))
+    print('deque + sum():  {:8.2f} us/sample'.format(legacy * 1e6))
+    print('SlidingWindow:  {:8.2f} us/sample'.format(vectorized * 1e6))
+
+
+def read_clip(path):
+    """
+    @param string path
+    @return list(array) All frames of a clip
+    """
+    import cv2
+
+    capture = cv2.VideoCapture(path)
+    frames = []
+
+    while True:
+        grabbed, frame = capture.read()
+
+        if not grabbed:
+            break
+
+        frames.append(frame)
+
+    return frames
+
+
+def bench_motion(args):
+    """Measure frames per second of the motion pipeline over a recorded clip for several configurations."""
+    import cv2
+    import numpy as np
+    from util.motion_pipeline import FrameDifference
+
+    if not args.clip:
+        parser.error('motion requires --clip')
+
+    frames = read_clip(args.clip)
+    height, width = frames[0].shape[:2]
+
+    # Center quarter of the image
+    roi = np.zeros((height, width), np.uint8)
+    roi[height // 4:height * 3 // 4, width // 4:width * 3 // 4] = 255
+
+    configurations = [
+        ('full resolution', {}),
+        ('scale 0.5', {'scale': 0.5}),
+        ('scale 0.25', {'scale': 0.25}),
+        ('scale 0.5 + ROI', {'scale': 0.5, 'roi': roi}),
+    ]
+
+    print('{} frames at {}x{}'.format(len(frames), width, height))
+
+    for name, options in configurations:
+        pipeline = FrameDifference(width, height, **options)
+        start = time.perf_counter()
+
+        for frame in frames:
+            pipeline.process(frame)
+
+        print('{:20s} {:8.1f} fps'.format(name, len(frames) / (time.perf_counter() - start)))
+
+
+def bench_motion_engines(args):
+    """
+    Compare cost and triggers of all motion engines replaying --clip, as is and with the lights switched on halfway.
+    With --event-at, triggers before the event count as false.
+    """
+    import cv2
+    from util.motion_pipeline import ENGINES, create_pipeline
+    from util.sliding_window import SlidingWindow
+
+    if not args.clip:
+        parser.error('motion-engines requires --clip')
+
+    frames = read_clip(args.clip)
+    height, width = frames[0].shape[:2]
+    fps = int(cv2.VideoCapture(args.clip).get(cv2.CAP_PROP_FPS)) or args.fps
+
+    # Sudden global brightness step, like lights or the camera's IR filter switching
+    lit = frames[:len(frames) // 2] + [cv2.add(f, (40, 40, 40, 0)) for f in frames[len(frames) // 2:]]
+
+    def triggers(pipeline, frames):
+        observer = SlidingWindow(fps * 5, 3)
+        detected = False
+        started = []
+        elapsed = 0
+
+        for i, frame in enumerate(frames):
+            start = time.perf_counter()
+            movement = pipeline.process(frame)
+            elapsed += time.perf_counter() - start
+
+            if movement is not None:
+                observer.append(movement)
+
+            if observer.exceeded > 0 and not detected:
+                started.append(i / fps)
+
+            detected = observer.exceeded > 0
+
+        return started, elapsed * 1000 / len(frames)
+
+    print('{} frames at {}x{}, {} FPS'.format(len(frames), width, height, fps))
+
+    for engine in ENGINES:
+        for illumination_change in (0, 10):
+            options = {'scale': 0.5, 'illumination_change': illumination_change}
+            started, cost = triggers(create_pipeline(engine, width, height, **options), frames)
+            started_lit, _ = triggers(create_pipeline(engine, width, height, **options), lit)
+
+            line = '{:8s} {:20s} {:6.2f} ms/frame, {:3d} triggers, {:3d} with lights switched on'.format(
+                engine, 'rejecting lighting' if illumination_change else '', cost, len(started), len(started_lit))
+
+            if args.event_at is not None:
+                line += ', {} false'.format(len([t for t in started if t < args.event_at]))
+
+            print(line)
+
+
+def bench_tracking(args):
+    """
+    Compare triggers of plain motion detection with tracked motion replaying --clip, and the cost of tracking.
+    With --event-at, triggers before the event count as false.
+    """
+    import cv2
+    from util.motion_pipeline import FrameDifference
+    from util.sliding_window import SlidingWindow
+    from util.tracker import Tracker, find_targets
+
+    if not args.clip:
+        parser.error('tracking requires --clip')
+
+    frames = read_clip(args.clip)
+    height, width = frames[0].shape[:2]
+    fps = int(cv2.VideoCapture(args.clip).get(cv2.CAP_PROP_FPS)) or args.fps
+
+    for label, tracker in [('Motion only', None), ('Tracked', Tracker())]:
+        pipeline = FrameDifference(width, height, scale=0.5)
+        observer = SlidingWindow(fps * 5, 3)
+        detected = False
+        started = []
+        elapsed = 0
+
+        for i, frame in enumerate(frames):
+            movement = pipeline.process(frame)
+
+            if movement is None:
+                continue
+
+            observer.append(movement)
+            now = observer.exceeded > 0
+
+            if tracker:
+                start = time.perf_counter()
+                tracker.update(find_targets(pipeline.dilated, pipeline.scale)[1], i / fps)
+                elapsed += time.perf_counter() - start
+
+                now = now and tracker.last_confirmed is not None and i / fps - tracker.last_confirmed <= 5
+
+            if now and not detected:
+                started.append(i / fps)
+
+            detected = now
+
+        line = '{:12s} {:3d} triggers at {}'.format(label, len(started), ', '.join('{:.1f}s'.format(t) for t in started))
+
+        if args.event_at is not None:
+            line += ', {} false'.format(len([t for t in started if t < args.event_at]))
+
+        if tracker:
+            line += ', tracking {:.2f} ms/frame, {} tracks'.format(elapsed * 1000 / len(frames), len(tracker.take_summaries()))
+
+        print(line)
+
+
+class ReplayBus:
+    def __init__(self, source):
+        """
+        Collect detection changes together with the media time they happened at.
+
+        @param source Replayed source with a position attribute
+        """
+        self.source = source
+        self.changes = []
+        self.first = threading.Event()
+
+    def publish(self, source, detected):
+        self.changes.append((getattr(self.source, 'position', None), detected, time.time()))
+
+        if detected and not self.first.is_set():
+            self.first_position, _, self.first_time = self.changes[-1]
+            self.first.set()
+
+
+def replay(detector, source, args, count):
+    """
+    Run a detector on a file-backed source until the source runs dry and report throughput and latency.
+
+    @param Detector detector
+    @param source
+    @param Namespace args
+    @param callable count Returns how many samples were processed
+    """
+    bus = ReplayBus(source)
+    detector.bus = bus
+    detector.daemon = True
+
+    start = time.perf_counter()
+    detector.start()
+    detector.join()
+    elapsed = time.perf_counter() - start
+
+    print('{}: {:.0f} samples/s, {:.1f}x real time'.format(
+        detector.name, count() / elapsed, source.position / elapsed))
+
+    report_detections(bus, args)
+
+
+def report_detections(bus, args):
+    """
+    @param ReplayBus bus
+    @param Namespace args
+    """
+    detections = [position for position, detected, _ in bus.changes if detected]
+
+    if not detections:
+        print('No detection')
+        return
+
+    print('Detections at: {}'.format(', '.join('{:.2f}s'.format(p) for p in detections)))
+
+    if args.event_at is not None:
+        print('Detection latency: {:.3f}s'.format(detections[0] - args.event_at))
+
+
+def bench_replay_motion(args):
+    """Replay a video clip through the MotionDetector as fast as possible."""
+    from util.sources import VideoFileSource
+
+    if not args.clip:
+        parser.error('replay-motion requires --clip')
+
+    os.environ['VISUAL_MOTION_DETECTION'] = '1'
+    from workers.motion import MotionDetector
+
+    source = VideoFileSource(args.clip)
+    replay(MotionDetector(source=source), source, args, lambda: source.frames)
+
+
+def bench_replay_noise(args):
+    """Replay a WAV file through the NoiseDetector as fast as possible."""
+    from util.sources import WavFileSource
+    from workers.noise import NoiseDetector
+
+    if not args.wav:
+        parser.error('replay-noise requires --wav')
+
+    source = WavFileSource(args.wav)
+    detector = NoiseDetector(source=source)
+    replay(detector, source, args, lambda: source.frames // detector.CHUNK_SIZE)
+
+
+def bench_replay_pir(args):
+    """Replay a scripted GPIO timeline through the PIRDetector."""
+    from util.sources import ScriptedGPIOSource
+    from workers.pir import PIRDetector
+
+    source = ScriptedGPIOSource.parse(args.timeline, args.speed)
+    detector = PIRDetector(source=source)
+    bus = ReplayBus(source)
+    detector.bus = bus
+    detector.daemon = True
+
+    start = time.time()
+    detector.start()
+    source.done.wait()
+
+    # Let the last change arrive, hold times are applied by the manager's trigger
+    time.sleep(0.5)
+
+    for position, detected, at in bus.changes:
+        print('{:6.2f}s (timeline {:6.2f}s): {}'.format(
+            at - start, (at - start) * args.speed, 'detected' if detected else 'clear'))
+
+
+def bench_streams(args):
+    """
+    Add synthetic cameras until they no longer sustain real time.
+    A camera sustains real time if it delivers all frames and motion is detected on at least every other one.
+    """
+    import numpy as np
+    from util.motion_pipeline import FrameDifference
+    from util.worker_pool import WorkerPool
+
+    frames = [np.random.randint(0, 255, (240, 320, 3), np.uint8) for _ in range(10)]
+    due = int(args.duration * args.fps)
+
+    def camera(key, pool, results):
+        pipeline = FrameDifference(320, 240, scale=0.5)
+        captured = detected = 0
+        start = time.time()
+
+        while time.time() < start + args.duration:
+            frame = frames[captured % len(frames)]
+            captured += 1
+
+            if pool:
+                if pool.take(key):
+                    detected += 1
+
+                pool.submit(key, pipeline.process, frame)
+            else:
+                pipeline.process(frame)
+                detected += 1
+
+            # Pace like a camera would, a camera falling behind loses frames
+            time.sleep(max(0, start + captured / args.fps - time.time()))
+
+        results[key] = (captured, detected)
+
+    workers = os.cpu_count() or 1
+
+    for label, pool in [('Own thread', None), ('Shared pool ({} workers)'.format(workers), WorkerPool(workers))]:
+        sustained = 0
+
+        for streams in range(1, 33):
+            results = {}
+            threads = [threading.Thread(target=camera, args=(i, pool, results)) for i in range(streams)]
+
+            for t in threads:
+                t.start()
+
+            for t in threads:
+                t.join()
+
+            # Let the pool finish before the next round
+            time.sleep(0.5)
+
+            captured = min(c for c, _ in results.values())
+            detected = [d / args.duration for _, d in results.values()]
+
+            print('{}: {:2d} streams, {:5.1f}% of frames captured, detection at {:5.1f}-{:5.1f} FPS'.format(
+                label, streams, captured * 100 / due, min(detected), max(detected)))
+
+            if captured < 0.95 * due or min(detected) < args.fps / 2:
+                break
+
+            sustained = streams
+
+        print('{}: {} streams sustain real time at {} FPS'.format(label, sustained, args.fps))
+
+
+def bench_preview(args):
+    """
+    Publish synthetic frames at --fps to the preview with a fast and a stalled viewer.
+    Reports the capture loop's cost per frame, JPEG encodes and frames each viewer got.
+    """
+    import socket
+    import numpy as np
+    from util.preview import preview, PreviewServer
+
+    server = PreviewServer(0, '127.0.0.1', fps=10)
+    server.start()
+    port = server.server.server_address[1]
+    frames = [np.random.randint(0, 255, (480, 640, 3), np.uint8) for _ in range(10)]
+    preview.register('bench')
+
+    received = {'fast': 0, 'slow': 0}
+
+    def viewer(label, stall):
+        with socket.socket() as s:
+            # Small receive buffer so a stalled viewer quickly stops accepting data
+            if stall:
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+
+            s.connect(('127.0.0.1', port))
+            s.sendall(b'GET /preview/bench.mjpg HTTP/1.0\r\n\r\n')
+            end = time.time() + args.duration
+
+            while time.time() < end:
+                data = s.recv(65536)
+                received[label] += data.count(b'--frame')
+
+                if stall:
+                    time.sleep(1)
+
+    viewers = [threading.Thread(target=viewer, args=(l, l == 'slow'), daemon=True) for l in received]
+
+    for v in viewers:
+        v.start()
+
+    time.sleep(0.5)
+    start = time.time()
+    published = published_cost = loop_cost = 0
+    captured = 0
+
+    while time.time() < start + args.duration:
+        frame = frames[captured % len(frames)]
+        captured += 1
+
+        loop_start = time.perf_counter()
+        publish, _ = preview.wants('bench')
+
+        if publish:
+            preview.publish('bench', frame)
+            published += 1
+
+        loop_cost += time.perf_counter() - loop_start
+        time.sleep(max(0, start + captured / args.fps - time.time()))
+
+    print('Captured {} frames, {:.1f} us per frame for the preview'.format(captured, loop_cost * 1e6 / captured))
+    print('Encoded {} JPEGs ({:.1f}/s) for 2 viewers'.format(published, published / args.duration))
+    print('Fast viewer got {} frames, stalled viewer {}'.format(received['fast'], received['slow']))
+    print('Capture kept up: {}'.format(captured >= 0.95 * args.duration * args.fps))
+
+
+# Run in a fresh interpreter per configuration, so imports aren't shared between measurements
+STARTUP_PROBE = """
+import sys, json, time, resource
+start = time.perf_counter()
+
+import manager
+from util.registry import WORKERS, load_worker, parse_workers
+from util.sources import VideoFileSource, WavFileSource, ScriptedGPIOSource
+
+kinds = parse_workers(sys.argv[1])
+classes = {k: load_worker(k) for k in (WORKERS if sys.argv[2] == 'eager' else kinds)}
+imported = time.perf_counter() - start
+
+sources = {
+    'noise': sys.argv[4] and (lambda: WavFileSource(sys.argv[4])),
+    'motion': sys.argv[3] and (lambda: VideoFileSource(sys.argv[3])),
+    'pir': lambda: ScriptedGPIOSource.parse('0:0'),
+}
+workers = [classes[k](source=sources[k]()) for k in kinds if sources[k]]
+
+print(json.dumps({
+    'import': imported,
+    'startup': time.perf_counter() - start,
+    'rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    'modules': len(sys.modules),
+}))
+"""
+
+
+def bench_startup(args):
+    """
+    Import time, time until all workers are constructed and peak RSS for typical worker configurations,
+    importing only the enabled workers vs. all of them as before.
+    Workers read from --clip and --wav, those without a file are only imported.
+    Also compares the capture loop's cost per frame with motion detection off, decoding every frame vs. grabbing only.
+    """
+    import sys
+    import json
+
+    configurations = [
+        ('noise,motion,pir', 'lazy'),
+        ('noise,motion,pir', 'eager'),
+        ('motion', 'lazy'),
+        ('noise', 'lazy'),
+        ('pir', 'lazy'),
+        ('noise,pir', 'lazy'),
+    ]
+
+    print('{:18} {:6} {:>10} {:>11} {:>9} {:>8}'.format('Workers', 'Import', 'Import ms', 'Startup ms', 'RSS MB', 'Modules'))
+
+    for workers, mode in configurations:
+        result = subprocess.run([sys.executable, '-c', STARTUP_PROBE, workers, mode, args.clip or '', args.wav or ''],
+                                cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True,
+                                env=dict(os.environ, VISUAL_MOTION_DETECTION='0', FACE_DETECTION='0', SHOW_IMAGE='0'))
+
+        if result.returncode:
+            print('{:18} {:6} failed: {}'.format(workers, mode, result.stderr.strip().splitlines()[-1]))
+            continue
+
+        r = json.loads(result.stdout.strip().splitlines()[-1])
+        print('{:18} {:6} {:10.0f} {:11.0f} {:9.1f} {:8}'.format(
+            workers, mode, r['import'] * 1000, r['startup'] * 1000, r['rss'] / 1024, r['modules']))
+
+    if not args.clip:
+        return
+
+    # Buffering only, nothing recorded or pre-rolled
+    os.environ.update(VISUAL_MOTION_DETECTION='0', FACE_DETECTION='0', SHOW_IMAGE='0', PRE_ROLL_LENGTH='0')
+    from util.sources import VideoFileSource
+    from workers.motion import MotionDetector
+
+    for grab_only in (False, True):
+        source = VideoFileSource(args.clip)
+        detector = MotionDetector(source=source)
+        detector.grab_only = grab_only
+
+        start = time.process_time()
+        detector.run()
+        elapsed = time.process_time() - start
+
+        print('{}: {:.2f} ms CPU per frame'.format('Grab only' if grab_only else 'Decode', elapsed * 1000 / source.frames))
+
+
+def bench_calibration(args):
+    """
+    Time until the motion detector is ready for a camera replaying --clip in real time,
+    measuring its frame rate on a cold start vs. reusing the cached calibration on a warm one.
+    Also checks that a corrected frame rate is only applied once measured twice and never cuts short
+    an ongoing detection or recording, exits non-zero otherwise.
+    """
+    import sys
+    from util.sources import VideoFileSource
+    from util.calibration import calibration
+
+    if not args.clip:
+        parser.error('calibration requires --clip')
+
+    os.environ.update(VISUAL_MOTION_DETECTION='0', FACE_DETECTION='0', SHOW_IMAGE='0', PRE_ROLL_LENGTH='2')
+    from workers.motion import MotionDetector
+
+    class Camera:
+        """Real-time replay which, like a webcam, doesn't know its frame rate."""
+
+        def __init__(self, path):
+            self.video = VideoFileSource(path, realtime=True)
+
+        def read(self):
+            return self.video.read()
+
+        def release(self):
+            self.video.capture.release()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        calibration.path = os.path.join(tmp, 'calibration.json')
+        calibration.values = {}
+
+        for start in ('Cold', 'Warm'):
+            begin = time.perf_counter()
+            detector = MotionDetector(source=Camera(args.clip), camera=0)
+            elapsed = time.perf_counter() - begin
+
+            print('{} start: {:7.0f} ms, {} FPS'.format(start, elapsed * 1000, detector.fps))
+
+        # The camera runs at half the calibrated frame rate and is detecting something right now
+        fps = detector.fps
+        calibration.set('camera:0', fps=fps * 2)
+        detector = MotionDetector(source=Camera(args.clip), camera=0)
+        ok, frame = detector.source.read()
+        failures = []
+
+        for i in range(detector.pre_roll.capacity):
+            detector.pre_roll.append(frame, i)
+
+        for i in range(detector.fps):
+            detector.observer.append(detector.threshold * 2)
+
+        detector.set_detected(True)
+        exceeded = detector.observer.exceeded
+
+        def check(what, ok):
+            print('{:58} {}'.format(what, 'ok' if ok else 'FAILED'))
+
+            if not ok:
+                failures.append(what)
+
+        detector.recalibrate(frame, (fps * 2 - 1) * 30, 30)
+        check('Jitter of 1 FPS is ignored', detector.measured_fps is None)
+
+        detector.recalibrate(frame, fps * 30, 30)
+        check('A single measurement at {} FPS is not applied'.format(fps), detector.resize_fps is None)
+
+        detector.recalibrate(frame, fps * 30, 30)
+        check('The second one is', detector.resize_fps == fps)
+
+        # As the capture loop does on every frame
+        if detector.resize_fps and not detector.detected():
+            detector.resize_buffers()
+
+        check('Ongoing detection survives, observer untouched',
+              detector.detected() and detector.fps == fps * 2 and detector.observer.exceeded == exceeded)
+
+        detector.start_recording(os.path.join(tmp, 'calibration'))
+        detector.resize_buffers()
+        check('Open recording keeps its frame rate', detector.fps == fps * 2)
+        detector.stop_recording()
+
+        # Detection ended, the pre-roll filled up again after the writer encoded it
+        detector.set_detected(False)
+
+        for i in range(detector.pre_roll.capacity):
+            detector.pre_roll.append(frame, i)
+
+        newest = [t for _, t in detector.pre_roll.items()][-fps * int(os.environ['PRE_ROLL_LENGTH']):]
+        detector.resize_buffers()
+
+        check('Resized afterwards, newest frames and movement kept',
+              detector.fps == fps and [t for _, t in detector.pre_roll.items()] == newest
+              and detector.observer.exceeded == exceeded)
+
+    if failures:
+        sys.exit('FAIL: {}'.format(', '.join(failures)))
+
+
+def bursty_events(length, seed=1):
+    """
+    Synthetic detections: bursts of short pulses by random detectors about once a minute.
+
+    @param float length Seconds
+    @param int seed
+    @return list(tuple(float, string, bool)) Time, source and detection state, in order
+    """
+    rng = random.Random(seed)
+    events = []
+    at = rng.uniform(0, 60)
+
+    while at < length:
+        for _ in range(rng.randint(1, 6)):
+            source = rng.choice(['NoiseDetector', 'MotionDetector', 'PIRDetector'])
+            events += [(at, source, True), (at + rng.uniform(0.2, 2), source, False)]
+            at += rng.uniform(1, 6)
+
+        at += rng.uniform(30, 90)
+
+    return sorted(events)
+
+
+def bench_trigger(args):
+    """Count recordings and loop wakeups for bursty detections, replayed in virtual time."""
+    from util.trigger import Trigger, START
+
+    events = bursty_events(3600)
+    triggers = [
+        # Stop as soon as everything cleared, like the watch loop used to
+        ('Stop on clear', Trigger(hold={'PIRDetector': 3}, max_length=10)),
+        ('State machine', Trigger(hold={'PIRDetector': 3}, cooldown=5, min_length=5, max_length=10)),
+    ]
+
+    for label, trigger in triggers:
+        pending = list(events)
+        recordings = wakeups = 0
+        recorded = 0
+        started = None
+        now = 0
+
+        while pending or trigger.deadline() is not None:
+            deadline = trigger.deadline()
+            now = pending[0][0] if pending and (deadline is None or pending[0][0] <= deadline) else deadline
+
+            while pending and pending[0][0] <= now:
+                trigger.event(pending[0][1], pending[0][2], pending[0][0])
+                pending.pop(0)
+
+            wakeups += 1
+
+            for action in trigger.step(now):
+                if action == START:
+                    recordings += 1
+                    started = now
+                else:
+                    recorded += now - started
+
+        print('{}: {:4d} recordings (merge jobs), {:6.0f}s recorded, {:5d} wakeups for {} events'.format(
+            label, recordings, recorded, wakeups, len(events)))
+
+
+def bench_end_to_end(args):
+    """Replay clip and WAV in real time and measure the time from the first trigger to the merged file."""
+    from util.sources import VideoFileSource, WavFileSource
+    from util.merger import Merger
+
+    if not args.clip or not args.wav:
+        parser.error('end-to-end requires --clip and --wav')
+
+    os.environ['VISUAL_MOTION_DETECTION'] = '1'
+    from workers.motion import MotionDetector
+    from workers.noise import NoiseDetector
+
+    video, audio = VideoFileSource(args.clip, realtime=True), WavFileSource(args.wav, realtime=True)
+    bus = ReplayBus(video)
+    workers = [MotionDetector(source=video), NoiseDetector(source=audio)]
+
+    for w in workers:
+        w.bus = bus
+        w.daemon = True
+        w.start()
+
+    bus.first.wait()
+    trigger = bus.first_time
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for w in workers:
+            w.start_recording(os.path.join(tmp, 'clip'))
+
+        time.sleep(args.duration)
+
+        for w in workers:
+            w.stop_recording()
+
+        merger = Merger()
+        merger.submit('clip', tmp, tmp)
+        merger.close()
+
+        if not os.path.exists(os.path.join(tmp, 'clip.mp4')):
+            print('Merge failed')
+            return
+
+        print('Trigger at media time {:.2f}s'.format(bus.first_position))
+        print('Trigger to file: {:.2f}s ({:.2f}s after the recording ended)'.format(
+            time.time() - trigger, time.time() - trigger - args.duration))
+
+
+def bench_audio(args):
+    """Compare chunks per second of the legacy per-chunk RMS with the batched multi-band analysis."""
+    import numpy as np
+    from util.audio_analysis import BandAnalyzer
+
+    rate, chunk_size, block_chunks = 44100, 1024, 8
+    chunks = [np.random.randint(-3000, 3000, chunk_size, np.int16).tobytes() for i in range(block_chunks * 200)]
+
+    start = time.perf_counter()
+
+    for chunk in chunks:
+        d = np.frombuffer(chunk, np.int16).astype(float)
+        np.sqrt((d * d).sum() / len(d))
+
+    legacy = len(chunks) / (time.perf_counter() - start)
+
+    analyzer = BandAnalyzer(rate, chunk_size)
+    blocks = [b''.join(chunks[i:i + block_chunks]) for i in range(0, len(chunks), block_chunks)]
+    start = time.perf_counter()
+
+    for block in blocks:
+        analyzer.process(block)
+
+    batched = len(chunks) / (time.perf_counter() - start)
+
+    print('Real time needs {:.0f} chunks/s'.format(rate / chunk_size))
+    print('Broadband RMS per chunk:      {:10.0f} chunks/s'.format(legacy))
+    print('Band analysis, {} per block:   {:10.0f} chunks/s'.format(block_chunks, batched))
+
+
+def cpu_time():
+    """
+    @return float CPU seconds of this process and its finished subprocesses
+    """
+    own, children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def bench_audio_encode(args):
+    """
+    Record --duration seconds of audio (--wav or a synthetic tone with noise) the legacy way,
+    collecting PCM in memory and saving a WAV that's transcoded when merging, vs. streaming it to each codec while recording.
+    Reports bytes written, PCM held in memory and CPU time per minute of audio for recording and merging.
+    """
+    import wave
+    import numpy as np
+    from util.audio_writer import AudioWriter, AUDIO_CODECS
+    from util.merger import merge_command
+
+    block_frames = 8 * 1024
+
+    if args.wav:
+        with wave.open(args.wav, 'rb') as wf:
+            rate, channels = wf.getframerate(), wf.getnchannels()
+            pcm = wf.readframes(int(args.duration * rate))
+    else:
+        rate, channels = 44100, 1
+        t = np.arange(int(args.duration * rate)) / rate
+        samples = 3000 * np.sin(2 * np.pi * 440 * t) + np.random.normal(0, 300, len(t))
+        pcm = samples.astype(np.int16).tobytes()
+
+    block_bytes = block_frames * channels * 2
+    blocks = [pcm[i:i + block_bytes] for i in range(0, len(pcm), block_bytes)]
+    per_minute = 60 / (len(pcm) / (rate * channels * 2))
+
+    print('{:16} {:>9} {:>12} {:>15} {:>14}'.format('Recording', 'MB/min', 'Peak PCM MB', 'Record CPU s/min', 'Merge CPU s/min'))
+
+    def report(label, path, peak, recorded):
+        start = cpu_time()
+        subprocess.run(merge_command(None, path, path + '.mp4'), check=True)
+        merged = cpu_time() - start
+
+        print('{:16} {:9.2f} {:12.2f} {:15.3f} {:14.3f}'.format(
+            label, os.path.getsize(path) * per_minute / 1024 / 1024, peak / 1024 / 1024,
+            recorded * per_minute, merged * per_minute))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Legacy: every block in a list, joined into one WAV when the recording stops
+        path = os.path.join(tmp, 'legacy.wav')
+        start = cpu_time()
+        record = []
+
+        for block in blocks:
+            record.append(block)
+
+        wf = wave.open(path, 'wb')
+        wf.setnchannels(channels)
+        wf.setsampwidth(2)
+        wf.setframerate(rate)
+        wf.writeframes(b''.join(record))
+        wf.close()
+
+        # The list and its joined copy
+        report('wav, in memory', path, 2 * len(pcm), cpu_time() - start)
+
+        for codec in AUDIO_CODECS:
+            # Faster than real time, so wait for the encoder instead of dropping audio
+            writer = AudioWriter(os.path.join(tmp, codec), rate, channels, codec=codec, block=True)
+            start = cpu_time()
+            writer.start()
+
+            for block in blocks:
+                writer.write(block)
+
+            writer.close()
+            report('{}, streamed'.format(codec), writer.path, writer.queue.maxsize * block_bytes, cpu_time() - start)
+
+
+def bench_audio_capture(args):
+    """Simulate a callback-driven microphone while the consumer is periodically starved."""
+    from util.ring_buffer import AudioRingBuffer
+
+    rate, chunk_size, block_chunks = 44100, 1024, 8
+    chunk = bytes(chunk_size * 2)
+    ring = AudioRingBuffer(5 * rate * 2)
+    overruns = 0
+    stop = threading.Event()
+
+    def callback():
+        nonlocal overruns
+        start = time.time()
+        chunks = 0
+
+        while not stop.is_set():
+            chunks += 1
+            time.sleep(max(0, start + chunks * chunk_size / rate - time.time()))
+
+            if not ring.write(chunk):
+                overruns += 1
+
+    producer = threading.Thread(target=callback, daemon=True)
+    start = time.time()
+    producer.start()
+
+    captured = 0
+    stalled = 0
+
+    while time.time() - start < args.duration:
+        captured += len(ring.read(chunk_size * block_chunks, timeout=1)) // 2
+
+        # Stand-in for the interpreter being busy with video work
+        if int(time.time() - start) > stalled:
+            stalled += 1
+            time.sleep(0.3)
+
+    stop.set()
+    producer.join()
+    elapsed = time.time() - start
+    captured += ring.available() // 2
+
+    print('Wall clock: {:.3f}s, captured: {:.3f}s, ring overruns: {}'.format(elapsed, captured / rate, overruns))
+
+
+SCENARIOS = {
+    'watch': bench_watch,
+    'recorder': bench_recorder,
+    'merge': bench_merge,
+    'sync': bench_sync,
+    'segments': bench_segments,
+    'ingest': bench_ingest,
+    'listing': bench_listing,
+    'compact': bench_compact,
+    'window': bench_window,
+    'motion': bench_motion,
+    'motion-engines': bench_motion_engines,
+    'tracking': bench_tracking,
+    'audio': bench_audio,
+    'audio-capture': bench_audio_capture,
+    'audio-encode': bench_audio_encode,
+    'replay-motion': bench_replay_motion,
+    'replay-noise': bench_replay_noise,
+    'preview': bench_preview,
+    'startup': bench_startup,
+    'calibration': bench_calibration,
+    'trigger': bench_trigger,
+    'streams': bench_streams,
+    'replay-pir': bench_replay_pir,
+    'end-to-end': bench_end_to_end,
+}
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    if args.scenario not in SCENARIOS:
+        parser.error('Unknown scenario, choose from: {}'.format(', '.join(SCENARIOS)))
+
+    SCENARIOS[args.scenario](args)
@@ -2,23 +2,38 @@ import os
 import yaml
 import logging
 import logging.config
-import subprocess
 from dotenv import load_dotenv
 from pathlib import Path
 import time
 import datetime
-from workers.noise import NoiseDetector
-from workers.motion import MotionDetector
-from workers.pir import PIRDetector
-from util.detector import Detector
+import functools
+import threading
+from util.events import bus
 from util.recorder import Recorder
+from util.merger import Merger
+from util.segments import SegmentStore
+from util.ingest import FfmpegIngest
+from util.archive_index import ArchiveIndex
+from util.retention import Retention
+from util.trigger import Trigger, parse_hold_times, START, RECORDING, COOLDOWN
+from util.topology import load_topology, worker_name, KINDS
+from util.worker_pool import WorkerPool
+from util.zone import Zone
+from util.registry import load_worker, parse_workers
+from util.metrics import metrics, MetricsServer, MetricsReporter
+from util.preview import PreviewServer
+from util.process_worker import ProcessWorker
+from util.shared_frames import CaptureProcess
 
 PROJECT_ROOT = Path(__file__).resolve().parent.parent
 DOTENV_PATH = os.path.join(PROJECT_ROOT, '.env')
 TMP_PATH = os.path.join(PROJECT_ROOT, 'tmp')
 ARCHIVE_PATH = os.path.join(PROJECT_ROOT, 'archive')
+SEGMENT_PATH = os.path.join(PROJECT_ROOT, 'segments')
+STREAM_PATH = os.path.join(PROJECT_ROOT, 'server', 'stream')
 LOG_PATH = os.path.join(PROJECT_ROOT, 'log')
 LOGGER_CONFIG_PATH = os.path.join(PROJECT_ROOT, 'config', 'logger.yaml')
+TOPOLOGY_PATH = os.path.join(PROJECT_ROOT, 'config', 'topology.yaml')
 
 load_dotenv(DOTENV_PATH)
 threads = []
@@ -38,107 +53,401 @@ def init_logger():
 
 def init_environment():
     """Create all necessary folders."""
-    for d in [TMP_PATH, ARCHIVE_PATH, LOG_PATH]:
+    for d in [TMP_PATH, ARCHIVE_PATH, SEGMENT_PATH, STREAM_PATH, LOG_PATH]:
         Path(d).mkdir(exist_ok=True)
 
 
-def merge(filename, source, destination):
+def init_ingest():
     """
-    Merge .wav and .avi using ffmpeg.
-    For some reason we need to first convert AVI to MP4 and then merge that MP4 with the WAV to be able to play in the browser.
+    Start the ffmpeg process owning camera and microphone.
 
-    @param string filename
-    @param string source
-    @param string destination
+    @return FfmpegIngest
     """
-    logger.info('Merging...')
+    logger.info('Ingesting through ffmpeg')
+
+    return FfmpegIngest(
+        os.getenv('INGEST_VIDEO_DEVICE', '/dev/video0'),
+        os.getenv('INGEST_AUDIO_DEVICE', 'hw:2,0'),
+        tuple(int(x) for x in os.getenv('INGEST_VIDEO_SIZE', '320x240').split('x')),
+        int(os.getenv('INGEST_FPS', 30)),
+        int(os.getenv('AUDIO_SAMPLE_RATE')),
+        int(os.getenv('AUDIO_CHANNELS')),
+        STREAM_PATH,
+        SEGMENT_PATH,
+        int(os.getenv('SEGMENT_LENGTH', 10)),
+        chunk_size=int(os.getenv('AUDIO_CHUNK_SIZE')),
+        buffer_seconds=float(os.getenv('AUDIO_BUFFER_LENGTH', 5)))
+
+
+def init_pool():
+    """
+    @return WorkerPool|None Pool shared by all cameras for motion detection, None to detect on each camera's thread
+    """
+    workers = int(os.getenv('DETECTION_WORKERS', 0))
+
+    if not workers:
+        return None
+
+    logger.info('Detecting motion on {} shared workers'.format(workers))
+
+    return WorkerPool(workers)
+
+
+def init_worker(kind, **kwargs):
+    """
+    Create a worker as thread in this process or in its own process, depending on WORKER_MODE.
+    Its module is only imported now.
+
+    @param string kind Worker kind from the registry
+    @param dict kwargs Passed to the worker's constructor
+    @return Worker or ProcessWorker
+    """
+    if kind == 'motion':
+        return init_camera(**kwargs)
+
+    if os.getenv('WORKER_MODE', 'thread') != 'process':
+        return load_worker(kind)(**kwargs)
+
+    return ProcessWorker(load_worker(kind), **kwargs)
+
+
+def init_camera(name=None, camera=None):
+    """
+    Create the motion detector of a camera.
+    In process mode the camera is owned by its own capture process.
+
+    @param string name Worker name
+    @param int|string camera Defaults to CAMERA
+    @return MotionDetector|ProcessWorker
+    """
+    MotionDetector = load_worker('motion')
+
+    if os.getenv('WORKER_MODE', 'thread') != 'process':
+        return MotionDetector(name=name, camera=camera, pool=pool)
+
+    capture = CaptureProcess(functools.partial(MotionDetector.init_camera, camera), int(os.getenv('SHARED_FRAME_SLOTS', 8)))
+    capture.start()
+
+    return ProcessWorker(MotionDetector, name=name, camera=camera, source=capture.source())
+
+
+def init_devices():
+    """
+    Create one worker per device of the topology.
+
+    @return dict Workers by kind of device and device name
+    """
+    return {
+        'cameras': {d: init_worker('motion', name=worker_name('MotionDetector', d), camera=c['device'])
+                    for d, c in topology['cameras'].items()},
+        'microphones': {d: init_worker('noise', name=worker_name('NoiseDetector', d), device=c['device'])
+                        for d, c in topology['microphones'].items()},
+        'sensors': {d: init_worker('pir', name=worker_name('PIRDetector', d), pin=c['pin'])
+                    for d, c in topology['sensors'].items()},
+    }
+
+
+def init_workers():
+    """
+    Create all enabled workers, either as threads in this process or each in its own process.
+    In process mode the camera is owned by a capture process sharing frames through shared memory.
+    With ffmpeg ingest the detectors read from its pipes instead of the devices.
+
+    @return list
+    """
+    if topology:
+        return [w for workers in devices.values() for w in workers.values()]
+
+    kinds = parse_workers(os.getenv('WORKERS', 'noise,motion,pir'))
+    logger.info('Workers: {}'.format(', '.join(kinds)))
+
+    if ingest:
+        sources = {'noise': ingest.audio, 'motion': ingest.video}
+
+        return [load_worker(k)(**({'source': sources[k]} if k in sources else {})) for k in kinds]
+
+    if os.getenv('WORKER_MODE', 'thread') == 'process':
+        logger.info('Starting workers in separate processes')
+
+    return [init_worker(k) for k in kinds]
+
 
-    # Convert AVI -> MP4
-    cmd = 'ffmpeg -i {1}/{0}.avi {1}/{0}.mp4 2> /dev/null'.format(filename, source)
-    subprocess.call(cmd, shell=True)
+def init_trigger():
+    """
+    @return Trigger
+    """
+    return Trigger(
+        hold=parse_hold_times(os.getenv('TRIGGER_HOLD', 'PIRDetector:3')),
+        default_hold=float(os.getenv('TRIGGER_DEFAULT_HOLD', 0)),
+        arm_time=float(os.getenv('TRIGGER_ARM_TIME', 0)),
+        cooldown=float(os.getenv('TRIGGER_COOLDOWN', 0)),
+        min_length=float(os.getenv('MIN_RECORDING_LENGTH', 0)),
+        max_length=float(os.getenv('MAX_RECORDING_LENGTH')))
+
+
+def init_segments(path):
+    """
+    @param string path
+    @return SegmentStore|None Rolling buffer of segments in continuous mode
+    """
+    if not ingest and os.getenv('RECORDING_MODE', 'event') != 'continuous':
+        return None
 
-    # Merge MP4 + WAV -> MP4
-    cmd = "ffmpeg -hide_banner -loglevel error -i {1}/{0}.wav -i {1}/{0}.mp4 -c:v copy -c:a aac -strict experimental {2}/{0}.mp4 && rm {1}/{0}.*".format(
-        filename, source, destination)
-    subprocess.call(cmd, shell=True)
+    Path(path).mkdir(exist_ok=True)
+
+    return SegmentStore(path, int(os.getenv('SEGMENT_RETENTION', 3600)), archive=archive)
+
+
+def init_zones():
+    """
+    Group workers into zones, which are triggered and recorded independently.
+    Without a topology all workers form a single zone.
+
+    @return list(Zone)
+    """
+    if not topology:
+        recorders = [t for t in threads if isinstance(t, Recorder)]
 
-    logger.info('Merged.')
+        return [Zone(None, threads, recorders, init_trigger(), init_segments(SEGMENT_PATH))]
+
+    zones = []
+
+    for name, members in topology['zones'].items():
+        workers = [devices[kind][d] for kind in KINDS for d in members[kind]]
+        # Only one camera and one microphone can be merged into a clip, others only detect
+        recorders = [devices[kind][members[kind][0]] for kind in ('cameras', 'microphones') if members[kind]]
+
+        zones.append(Zone(name, workers, recorders, init_trigger(), init_segments(os.path.join(SEGMENT_PATH, name))))
+
+    return zones
+
+
+def begin(zone):
+    """
+    Start a recording.
+
+    @param Zone zone
+    """
+    # Determine recording destination
+    zone.filename = zone.clip_name(datetime.datetime.fromtimestamp(zone.trigger.started))
+
+    if not zone.segments:
+        zone.start_recording(os.path.join(TMP_PATH, zone.filename))
+
+    # Only levels and tracks measured during this recording count
+    zone.take_peaks()
+    zone.take_tracks()
+
+    # Make room while recording
+    retention.check()
+
+    logger.info('Detection by {}'.format(zone.trigger.last_source))
+    logger.info('Recording {} started...'.format(zone.filename))
+
+
+def end(zone, now, recording_started, sources):
+    """
+    Finish the current recording.
+
+    @param Zone zone
+    @param float now
+    @param float recording_started
+    @param list(string) sources Detectors that triggered
+    """
+    tracks = zone.take_tracks()
+    logger.info('Recording {} stopped, {} objects tracked.'.format(zone.filename, len(tracks)))
+
+    if zone.segments:
+        # Cut from the segments once they're encoded
+        zone.segments.mark(zone.filename, recording_started - int(os.getenv('PRE_ROLL_LENGTH', 0)), now, sources,
+                           ARCHIVE_PATH, zone.take_peaks(), tracks)
+    else:
+        zone.stop_recording()
+
+        # Merge audio/video in the background
+        merger.submit(zone.filename, TMP_PATH, ARCHIVE_PATH, {
+            'started': recording_started,
+            'sources': sources,
+            'levels': zone.take_peaks(),
+            'tracks': tracks,
+        })
+
+    logger.info('Waiting...')
+
+
+def rotate(zone):
+    """
+    Finish the current segment and start recording the next one.
+
+    @param Zone zone
+    @return tuple(string, float) Name and start time of the new segment
+    """
+    now = time.time()
+    name = zone.clip_name(datetime.datetime.fromtimestamp(now))
+    path = os.path.join(TMP_PATH, name)
+
+    if zone.segment:
+        # Recorders move on right away, the previous segment is flushed on the segment thread instead of this loop
+        zone.switch_recording(path)
+        zone.segments.add(zone.segment[0], TMP_PATH, zone.segment[1], now, finish=zone.finish_recording)
+    else:
+        zone.start_recording(path)
+
+    return name, now
 
 
 def watch():
     """
     Watch loop to check for detections and trigger recordings.
+    Blocks on the detection bus and only wakes up on state changes or when a deadline of a zone's trigger expires.
+    In continuous mode recorders never stop, detections only mark which part of the segments to cut into a clip.
+    With ffmpeg ingest, ffmpeg writes the segments and the recorders aren't used at all.
     """
-    detected = False
-    notified = False
-    detected_by = ""
-    recording_started = None
-    max_recording_length = int(os.getenv('MAX_RECORDING_LENGTH'))
+    segment_length = int(os.getenv('SEGMENT_LENGTH', 10))
 
     try:
-        logger.info('Ready')
-
-        while True:
-            # Check for detections
-            for t in threads:
-                if isinstance(t, Detector) and t.detected():
-                    detected = True
-                    detected_by = t.name
-                    break
+        logger.info('Ready after {:.2f}s'.format(time.time() - started))
 
-            if detected and not (recording_started and time.time() - recording_started > max_recording_length):
-                if not notified:
-                    recording_started = time.time()
+        for zone in zones:
+            if zone.segments and not ingest:
+                zone.segment = rotate(zone)
 
-                    # Determine recording destination
-                    filename = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-                    path = os.path.join(TMP_PATH, str(filename))
+        while True:
+            now = time.time()
+            deadlines = []
 
-                    for t in threads:
-                        if isinstance(t, Recorder):
-                            t.start_recording(path)
+            for zone in zones:
+                if zone.segment and now - zone.segment[1] >= segment_length:
+                    zone.segment = rotate(zone)
 
-                    logger.info('Detection by {}'.format(detected_by))
-                    logger.info('Recording started...')
+                # What is being recorded, a split moves the trigger on to the next recording right away
+                recording = (zone.trigger.started, sorted(zone.trigger.triggered))
 
-                    notified = True
-            else:
-                if notified:
-                    logger.info('Recording stopped.')
+                for action in zone.trigger.step(now):
+                    if action == START:
+                        begin(zone)
+                    else:
+                        end(zone, now, *recording)
 
-                    for t in threads:
-                        if isinstance(t, Recorder):
-                            t.stop_recording()
+                if zone.trigger.deadline() is not None:
+                    deadlines.append(zone.trigger.deadline())
 
-                    # Merge audio/video
-                    merge(filename, TMP_PATH, ARCHIVE_PATH)
+                if zone.segment:
+                    deadlines.append(zone.segment[1] + segment_length)
 
-                    # Reset for next run
-                    notified = False
-                    recording_started = None
+            # Sleep until the next state change or deadline
+            events = bus.wait(max(0, min(deadlines) - time.time()) if deadlines else None)
 
-                    logger.info('Waiting...')
+            with metrics.timer('manager_decision'):
+                for event in events:
+                    for zone in zones:
+                        if event.source in zone.sources:
+                            zone.trigger.event(event.source, event.detected, event.timestamp)
     except KeyboardInterrupt:
         logger.info('Cancelled')
 
+        # Keep what was recorded of the current segment
+        if ingest:
+            ingest.close()
+
+        for zone in zones:
+            if not zone.segments:
+                continue
+
+            if zone.trigger.state in (RECORDING, COOLDOWN):
+                zone.segments.mark(zone.filename, zone.trigger.started - int(os.getenv('PRE_ROLL_LENGTH', 0)),
+                                   time.time(), sorted(zone.trigger.triggered), ARCHIVE_PATH, zone.take_peaks(),
+                                   zone.take_tracks())
+
+            if zone.segment:
+                zone.stop_recording()
+                zone.segments.add(zone.segment[0], TMP_PATH, zone.segment[1], time.time())
+
+            zone.segments.close()
+
+        # Finish pending merges
+        merger.close()
+
 
 if __name__ == '__main__':
+    # Measure how long it takes to become ready
+    started = time.time()
+
     # Set up environment
     init_environment()
 
     # Set up logger
     logger = init_logger()
 
+    # Expose metrics
+    if int(os.getenv('METRICS_PORT', 0)):
+        MetricsServer(int(os.getenv('METRICS_PORT'))).start()
+
+    if int(os.getenv('METRICS_LOG_INTERVAL', 0)):
+        MetricsReporter(int(os.getenv('METRICS_LOG_INTERVAL'))).start()
+
+    # Low latency browser preview of all cameras
+    if int(os.getenv('PREVIEW_PORT', 0)):
+        if os.getenv('WORKER_MODE', 'thread') == 'process':
+            logger.warning('Preview is not available in process mode')
+        else:
+            PreviewServer(int(os.getenv('PREVIEW_PORT')), os.getenv('PREVIEW_HOST', '0.0.0.0'),
+                          float(os.getenv('PREVIEW_FPS', 10)), int(os.getenv('PREVIEW_QUALITY', 70))).start()
+
+    # Single ffmpeg process owning camera and microphone
+    ingest = None
+
+    if os.getenv('INGEST_MODE', 'devices') == 'ffmpeg':
+        ingest = init_ingest()
+
+    # Cameras, microphones and sensors grouped into zones
+    topology = load_topology(TOPOLOGY_PATH)
+
+    if topology and ingest:
+        logger.warning('Ignoring {} with ffmpeg ingest'.format(TOPOLOGY_PATH))
+        topology = None
+
+    # Shared by all cameras
+    pool = init_pool()
+
     # Set up threads
-    threads = [
-        NoiseDetector(),
-        MotionDetector(),
-        PIRDetector(),
-    ]
+    devices = init_devices() if topology else None
+    threads = init_workers()
 
     # Start all threads
     for t in threads:
         t.start()
 
+    # Metadata and posters of all clips
+    archive = ArchiveIndex(ARCHIVE_PATH)
+
+    # Clips recorded before the index existed, probed in the background as that takes a while
+    if not archive.complete:
+        logger.info('Indexing the archive')
+        threading.Thread(target=archive.rebuild, name='ArchiveRebuild', daemon=True).start()
+
+    # Quotas and compaction of old clips
+    retention = Retention(
+        archive,
+        max_age=float(os.getenv('RETENTION_MAX_AGE', 0)),
+        max_size=float(os.getenv('RETENTION_MAX_SIZE', 0)),
+        min_free=float(os.getenv('RETENTION_MIN_FREE', 0)),
+        compact_after=float(os.getenv('COMPACT_AFTER', 0)),
+        compact_batch=int(os.getenv('COMPACT_BATCH', 5)),
+        compact_height=int(os.getenv('COMPACT_HEIGHT', 480)),
+        compact_crf=int(os.getenv('COMPACT_CRF', 30)),
+        max_load=float(os.getenv('COMPACT_MAX_LOAD', 0.75)),
+        interval=int(os.getenv('RETENTION_INTERVAL', 300)))
+    retention.start()
+
+    # Set up merge workers
+    merger = Merger(int(os.getenv('MERGE_WORKERS', 1)), archive=archive)
+
+    # Triggered and recorded independently, in continuous mode each into its own rolling buffer of segments
+    zones = init_zones()
+
+    if ingest:
+        ingest.follow(zones[0].segments)
+
     # Start watch loop
     watch()
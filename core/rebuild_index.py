@@ -0,0 +1,22 @@
+import os
+import time
+import logging
+import argparse
+from pathlib import Path
+from util.archive_index import ArchiveIndex
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+ARCHIVE_PATH = os.path.join(PROJECT_ROOT, 'archive')
+
+parser = argparse.ArgumentParser(description='Index clips in the archive that are missing from the index and drop records of deleted clips')
+parser.add_argument('--archive', default=ARCHIVE_PATH,
+                    help='Archive folder')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    start = time.time()
+    added, removed = ArchiveIndex(args.archive).rebuild()
+
+    print('Added {}, removed {} records in {:.1f}s'.format(added, removed, time.time() - start))
@@ -0,0 +1,323 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import tempfile
+import datetime
+import threading
+import subprocess
+from util.metrics import metrics
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+  name TEXT PRIMARY KEY,
+  started REAL NOT NULL,
+  duration REAL,
+  size INTEGER,
+  sources TEXT,
+  peak_motion REAL,
+  peak_rms REAL,
+  poster TEXT,
+  compacted INTEGER NOT NULL DEFAULT 0,
+  tracks TEXT
+);
+CREATE INDEX IF NOT EXISTS records_started ON records (started);
+CREATE TABLE IF NOT EXISTS meta (
+  key TEXT PRIMARY KEY,
+  value TEXT
+);
+"""
+
+COLUMNS = ('name', 'started', 'duration', 'size', 'sources', 'peak_motion', 'peak_rms', 'poster', 'tracks')
+
+
+def probe_duration(path):
+  """
+  @param string path
+  @return float|None Seconds
+  """
+  result = subprocess.run(['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'csv=p=0', path],
+                          stdin=subprocess.DEVNULL, capture_output=True)
+
+  try:
+    return float(result.stdout)
+  except ValueError:
+    return None
+
+
+def poster_command(video, destination, at=1):
+  """
+  Build an ffmpeg invocation grabbing a small JPEG from a clip.
+
+  @param string video
+  @param string destination
+  @param float at Seconds into the clip
+  @return list(string)
+  """
+  return ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y', '-ss', '{:.2f}'.format(at), '-i', video,
+          '-frames:v', '1', '-vf', 'scale=320:-2', '-q:v', '5', destination]
+
+
+class ArchiveIndex:
+  def __init__(self, path):
+    """
+    SQLite index of the archive with metadata and a poster per clip.
+    After every change the full listing is written to records.json, so the server never has to scan the folder.
+    The index is incomplete until a rebuild() added all clips already in the archive, which is noted in the index.
+
+    @param string path Archive folder
+    """
+    self.logger = logging.getLogger(self.__class__.__name__)
+
+    self.path = path
+    self.poster_path = os.path.join(path, 'posters')
+    self.listing_path = os.path.join(path, 'records.json')
+    os.makedirs(self.poster_path, exist_ok=True)
+
+    # Shared by the merge and segment threads
+    self.lock = threading.Lock()
+    # Merges, segments and retention all rewrite the listing, a rewrite waiting for its turn covers all changes before it
+    self.listing_lock = threading.Lock()
+    self.listing_pending = False
+    # No listing while rebuilding, the server scans the folder in the meantime
+    self.rebuilding = False
+
+    self.db = sqlite3.connect(os.path.join(path, 'index.sqlite'), check_same_thread=False)
+    self.db.executescript(SCHEMA)
+
+    # Also after a rebuild was interrupted, the clips it didn't get to are still missing
+    self.complete = self.db.execute("SELECT 1 FROM meta WHERE key = 'rebuilt'").fetchone() is not None
+
+    if not self.complete:
+      try:
+        os.remove(self.listing_path)
+      except FileNotFoundError:
+        pass
+
+    # Indexes created before compaction and tracking existed
+    columns = [row[1] for row in self.db.execute('PRAGMA table_info(records)')]
+
+    if 'compacted' not in columns:
+      self.db.execute('ALTER TABLE records ADD COLUMN compacted INTEGER NOT NULL DEFAULT 0')
+
+    if 'tracks' not in columns:
+      self.db.execute('ALTER TABLE records ADD COLUMN tracks TEXT')
+
+  def add(self, video, started=None, sources=(), levels=None, tracks=None, listing=True):
+    """
+    Index a clip and create its poster.
+
+    @param string video Path to the .mp4
+    @param float started Unix time of the start of the clip, derived from the filename if not given
+    @param list(string) sources Detectors that triggered
+    @param dict levels Peak level per detector
+    @param list(dict) tracks Summaries of tracked objects
+    @param bool listing Whether to rewrite the listing right away
+    """
+    start = time.time()
+    name = os.path.splitext(os.path.basename(video))[0]
+    levels = levels or {}
+
+    if started is None:
+      started = self.parse_time(name, video)
+
+    duration = probe_duration(video)
+    poster = os.path.join(self.poster_path, '{}.jpg'.format(name))
+    result = subprocess.run(poster_command(video, poster, min(1, (duration or 0) / 2)), stdin=subprocess.DEVNULL,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    row = (name, started, duration, os.path.getsize(video), ','.join(sources),
+           levels.get('MotionDetector'), levels.get('NoiseDetector'),
+           os.path.basename(poster) if result.returncode == 0 else None, json.dumps(tracks or []))
+
+    with self.lock:
+      self.db.execute('INSERT OR REPLACE INTO records ({}) VALUES ({})'.format(
+        ', '.join(COLUMNS), ','.join('?' * len(COLUMNS))), row)
+      self.db.commit()
+
+    if listing:
+      self.write_listing()
+
+    metrics.histogram('archive_index').observe(time.time() - start)
+
+  @staticmethod
+  def parse_time(name, path):
+    """
+    @param string name YYYYmmdd_HHMMSS, optionally followed by _zone
+    @param string path Falls back to its modification time
+    @return float
+    """
+    try:
+      return datetime.datetime.strptime(name[:15], '%Y%m%d_%H%M%S').timestamp()
+    except ValueError:
+      return os.path.getmtime(path)
+
+  def query(self, offset=0, limit=None, source=None, since=None, until=None):
+    """
+    Newest records first.
+
+    @param int offset
+    @param int limit
+    @param string source Only records triggered by this detector
+    @param float since Unix time
+    @param float until Unix time
+    @return list(dict)
+    """
+    where, params = [], []
+
+    if source:
+      where.append("',' || sources || ',' LIKE ?")
+      params.append('%,{},%'.format(source))
+
+    if since is not None:
+      where.append('started >= ?')
+      params.append(since)
+
+    if until is not None:
+      where.append('started < ?')
+      params.append(until)
+
+    sql = 'SELECT {} FROM records'.format(', '.join(COLUMNS))
+
+    if where:
+      sql += ' WHERE ' + ' AND '.join(where)
+
+    sql += ' ORDER BY started DESC LIMIT ? OFFSET ?'
+    params += [-1 if limit is None else limit, offset]
+
+    with self.lock:
+      rows = self.db.execute(sql, params).fetchall()
+
+    records = [dict(zip(COLUMNS, row)) for row in rows]
+
+    for record in records:
+      record['sources'] = record['sources'].split(',') if record['sources'] else []
+      record['tracks'] = json.loads(record['tracks']) if record['tracks'] else []
+
+    return records
+
+  def write_listing(self):
+    """Write all records to records.json, newest first."""
+    with self.lock:
+      if self.listing_pending:
+        return
+
+      self.listing_pending = True
+
+    with self.listing_lock:
+      with self.lock:
+        self.listing_pending = False
+
+      if self.rebuilding:
+        return
+
+      records = self.query()
+      fd, tmp = tempfile.mkstemp(prefix='records.', suffix='.tmp', dir=self.path)
+
+      try:
+        with os.fdopen(fd, 'w') as f:
+          json.dump(records, f, separators=(',', ':'))
+
+        os.replace(tmp, self.listing_path)
+      except BaseException:
+        os.remove(tmp)
+        raise
+
+  def total_size(self):
+    """
+    @return int Bytes of all indexed clips
+    """
+    with self.lock:
+      return self.db.execute('SELECT COALESCE(SUM(size), 0) FROM records').fetchone()[0]
+
+  def oldest(self, limit, before=None, compacted=None):
+    """
+    Oldest records first.
+
+    @param int limit
+    @param float before Only records started before this unix time
+    @param bool compacted Only records that were (not) compacted yet
+    @return list(tuple(string, float, int)) name, started, size
+    """
+    where, params = [], []
+
+    if before is not None:
+      where.append('started < ?')
+      params.append(before)
+
+    if compacted is not None:
+      where.append('compacted = ?')
+      params.append(int(compacted))
+
+    sql = 'SELECT name, started, size FROM records'
+
+    if where:
+      sql += ' WHERE ' + ' AND '.join(where)
+
+    with self.lock:
+      return self.db.execute(sql + ' ORDER BY started LIMIT ?', params + [limit]).fetchall()
+
+  def update(self, name, **values):
+    """
+    @param string name
+    @param values Columns to set
+    """
+    with self.lock:
+      self.db.execute('UPDATE records SET {} WHERE name = ?'.format(', '.join('{} = ?'.format(k) for k in values)),
+                      list(values.values()) + [name])
+      self.db.commit()
+
+  def remove(self, name):
+    """
+    Drop a record and its poster, the clip itself is left alone.
+
+    @param string name
+    """
+    with self.lock:
+      self.db.execute('DELETE FROM records WHERE name = ?', (name,))
+      self.db.commit()
+
+    try:
+      os.remove(os.path.join(self.poster_path, '{}.jpg'.format(name)))
+    except FileNotFoundError:
+      pass
+
+  def rebuild(self):
+    """
+    Bring the index in line with the clips on disk.
+    Clips recorded before the index existed only get what can be read from the file.
+
+    @return tuple(int, int) Records added, records removed
+    """
+    # A partial listing would hide the clips not indexed yet
+    with self.listing_lock:
+      self.rebuilding = not self.complete
+
+    try:
+      on_disk = {os.path.splitext(f)[0] for f in os.listdir(self.path) if f.endswith('.mp4')}
+
+      with self.lock:
+        indexed = {row[0] for row in self.db.execute('SELECT name FROM records')}
+
+      for name in indexed - on_disk:
+        self.remove(name)
+
+      for i, name in enumerate(sorted(on_disk - indexed)):
+        self.add(os.path.join(self.path, '{}.mp4'.format(name)), listing=False)
+
+        if i % 100 == 99:
+          self.logger.info('Indexed {} of {}'.format(i + 1, len(on_disk - indexed)))
+
+      with self.lock:
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('rebuilt', ?)", (str(time.time()),))
+        self.db.commit()
+
+      self.complete = True
+    finally:
+      with self.listing_lock:
+        self.rebuilding = False
+
+    self.write_listing()
+
+    return len(on_disk - indexed), len(indexed - on_disk)
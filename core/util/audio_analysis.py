@@ -0,0 +1,105 @@
+import numpy as np
+
+# Low rumble, voice fundamentals, speech/clapping, hiss and glass
+DEFAULT_BANDS = ((20, 250), (250, 1000), (1000, 4000), (4000, 16000))
+
+
+def parse_bands(spec):
+  """
+  Parse bands like "20-250,250-1000".
+
+  @param string spec
+  @return tuple(tuple(float, float))
+  """
+  if not spec:
+    return DEFAULT_BANDS
+
+  return tuple(tuple(float(f) for f in band.split('-')) for band in spec.split(','))
+
+
+class BandAnalyzer:
+  def __init__(self, rate, chunk_size, channels=1, bands=DEFAULT_BANDS, factor=3.0, adaptation_time=60):
+    """
+    Batched per-chunk RMS and FFT band energies against an exponentially decaying per-band noise floor.
+    Everything is computed in float32 over whole blocks of chunks at once.
+
+    @param int rate
+    @param int chunk_size Frames per chunk
+    @param int channels
+    @param tuple bands (low, high) pairs in Hz
+    @param float factor Energy relative to the floor above which a band counts as noisy
+    @param float adaptation_time Time constant of the floor in seconds
+    """
+    self.chunk_size = chunk_size
+    self.channels = channels
+    self.factor = factor
+
+    self.window = np.hanning(chunk_size).astype(np.float32)
+    freqs = np.fft.rfftfreq(chunk_size, 1 / rate)
+
+    # Bands outside the sample rate are dropped
+    bands = [(low, min(high, rate / 2)) for low, high in bands if low < rate / 2]
+    self.starts = np.searchsorted(freqs, [low for low, _ in bands])
+    self.ends = np.searchsorted(freqs, [high for _, high in bands])
+    self.bands = bands
+
+    # Per-chunk decay for quiet chunks, ten times slower for noisy ones so sustained noise is absorbed eventually
+    chunks_per_sec = rate / chunk_size
+    self.alpha_quiet = np.float32(1 / (adaptation_time * chunks_per_sec))
+    self.alpha_noisy = self.alpha_quiet / 10
+
+    self.floor = None
+
+  def analyze(self, block):
+    """
+    @param bytes block Whole number of 16 bit chunks
+    @return tuple(array, array) RMS per chunk, band energies per chunk
+    """
+    samples = np.frombuffer(block, np.int16).astype(np.float32)
+    samples = samples.reshape(-1, self.chunk_size, self.channels).mean(axis=2)
+
+    rms = np.sqrt(np.mean(samples * samples, axis=1))
+
+    spectrum = np.fft.rfft(samples * self.window, axis=1)
+    power = (spectrum.real * spectrum.real + spectrum.imag * spectrum.imag).astype(np.float32)
+
+    # One vectorized sum per band across all chunks of the block
+    energies = np.empty((len(power), len(self.bands)), np.float32)
+
+    for i, (start, end) in enumerate(zip(self.starts, self.ends)):
+      power[:, start:end].sum(axis=1, out=energies[:, i])
+
+    return rms, energies
+
+  def calibrate(self, block):
+    """
+    Initialize the floor from a block of background noise.
+
+    @param bytes block
+    """
+    _, energies = self.analyze(block)
+    self.floor = np.maximum(energies.mean(axis=0), 1)
+
+  def process(self, block):
+    """
+    Analyze a block and adapt the noise floor.
+
+    @param bytes block
+    @return tuple(array, array) RMS per chunk, highest band energy relative to its floor per chunk
+    """
+    rms, energies = self.analyze(block)
+
+    if self.floor is None:
+      self.floor = np.maximum(energies.mean(axis=0), 1)
+
+    ratios = energies / self.floor
+    scores = ratios.max(axis=1)
+
+    # Exponential decay towards the block's mean, weighted by how many chunks were quiet or noisy
+    noisy = ratios > self.factor
+    weights = np.where(noisy, self.alpha_noisy, self.alpha_quiet)
+    retain = np.prod(1 - weights, axis=0)
+    target = (energies * weights).sum(axis=0) / np.maximum(weights.sum(axis=0), 1e-12)
+    self.floor = np.maximum(self.floor * retain + target * (1 - retain), 1)
+
+    return rms, scores
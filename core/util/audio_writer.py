@@ -0,0 +1,174 @@
+import wave
+import queue
+import logging
+import threading
+import subprocess
+from util.metrics import metrics
+
+# File extension and ffmpeg output options per codec, WAV is written in-process
+AUDIO_CODECS = {
+  'aac': ('aac', ['-c:a', 'aac', '-f', 'adts']),
+  'flac': ('flac', ['-c:a', 'flac', '-f', 'flac']),
+  'wav': ('wav', None),
+}
+AUDIO_EXTENSIONS = [extension for extension, _ in AUDIO_CODECS.values()]
+
+
+def encode_command(rate, channels, codec, destination, bitrate='128k'):
+  """
+  Build an ffmpeg invocation encoding 16 bit PCM from stdin.
+
+  @param int rate
+  @param int channels
+  @param string codec 'aac' or 'flac'
+  @param string destination
+  @param string bitrate AAC bitrate
+  @return list(string)
+  """
+  cmd = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y',
+         '-f', 's16le', '-ar', str(rate), '-ac', str(channels), '-i', '-']
+  cmd += AUDIO_CODECS[codec][1]
+
+  if codec == 'aac':
+    cmd += ['-b:a', bitrate]
+
+  return cmd + [destination]
+
+
+class AudioWriter(threading.Thread):
+  def __init__(self, path, rate, channels, codec='aac', bitrate='128k', queue_size=64, block=False, pre_roll=b''):
+    """
+    Encode audio to disk on a dedicated thread as it's recorded.
+    Blocks are handed over through a bounded queue and piped into ffmpeg, so memory stays flat however long the recording runs.
+    AAC is written as ADTS, which the merger copies into the MP4 without re-encoding.
+    Audio that doesn't fit into the queue is replaced by as much silence, so everything after it stays aligned with the video.
+
+    @param string path Recording destination without extension
+    @param int rate
+    @param int channels
+    @param string codec 'aac', 'flac' or 'wav'
+    @param string bitrate AAC bitrate
+    @param int queue_size Maximum number of blocks waiting to be encoded
+    @param bool block Wait for the encoder if the queue is full instead of dropping audio
+    @param bytes pre_roll 16 bit PCM to encode ahead of the queued blocks
+    """
+    threading.Thread.__init__(self, daemon=True)
+
+    if codec not in AUDIO_CODECS:
+      raise ValueError("Unknown audio codec '{}', choose from: {}".format(codec, ', '.join(AUDIO_CODECS)))
+
+    self.name = self.__class__.__name__
+    self.logger = logging.getLogger(self.name)
+
+    self.path = '{}.{}'.format(path, AUDIO_CODECS[codec][0])
+    self.pre_roll = pre_roll
+    self.block = block
+    self.queue = queue.Queue(maxsize=queue_size)
+
+    self.wav = None
+    self.process = None
+
+    if codec == 'wav':
+      self.wav = wave.open(self.path, 'wb')
+      self.wav.setnchannels(channels)
+      self.wav.setsampwidth(2)
+      self.wav.setframerate(rate)
+    else:
+      self.process = subprocess.Popen(encode_command(rate, channels, codec, self.path, bitrate),
+                                      stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    self.closed = False
+    self.failed = False
+    # Bytes of PCM encoded and replaced by silence
+    self.written = 0
+    self.dropped = 0
+    # Bytes dropped since the last block that was queued
+    self.missing = 0
+
+  def write(self, block):
+    """
+    Queue 16 bit PCM for encoding, returns right away unless blocking.
+
+    @param bytes block
+    @return bool Whether the block was queued, otherwise it's encoded as silence
+    """
+    if self.closed:
+      return False
+
+    # Silence in place of what was dropped before, so nothing after it moves
+    item = (self.missing, block)
+
+    try:
+      self.queue.put(item, block=self.block)
+    except queue.Full:
+      self.missing += len(block)
+      self.dropped += len(block)
+      metrics.counter('audio_blocks_dropped').inc()
+      return False
+
+    self.missing = 0
+
+    return True
+
+  def close(self):
+    """Encode all queued blocks and finish the file."""
+    self.closed = True
+    self.queue.put((self.missing, None))
+    self.join()
+
+    if self.dropped:
+      self.logger.warning('Replaced {} of {} bytes by silence'.format(self.dropped, self.written))
+
+  def encode(self, block):
+    """
+    @param bytes block
+    """
+    if self.wav:
+      self.wav.writeframes(block)
+    elif not self.failed:
+      try:
+        self.process.stdin.write(block)
+      except (BrokenPipeError, ValueError):
+        # ffmpeg died, its error is logged once the recording is finished
+        self.failed = True
+        return
+
+    self.written += len(block)
+
+  def run(self):
+    """Encoder loop."""
+    try:
+      if self.pre_roll:
+        self.encode(self.pre_roll)
+
+      self.pre_roll = None
+
+      while True:
+        silence, block = self.queue.get()
+
+        if silence:
+          self.encode(bytes(silence))
+
+        if block is None:
+          break
+
+        self.encode(block)
+    finally:
+      self.finish()
+
+  def finish(self):
+    """Close the file, waiting for ffmpeg to flush it."""
+    if self.wav:
+      self.wav.close()
+      return
+
+    try:
+      self.process.stdin.close()
+    except BrokenPipeError:
+      pass
+
+    error = self.process.stderr.read()
+
+    if self.process.wait() != 0:
+      metrics.counter('audio_encode_failures').inc()
+      self.logger.error('ffmpeg failed for {}: {}'.format(self.path, error.decode(errors='replace').strip()))
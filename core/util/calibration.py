@@ -0,0 +1,61 @@
+import os
+import json
+import logging
+import threading
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent.parent
+CALIBRATION_PATH = os.path.join(PROJECT_ROOT, 'config', 'calibration.json')
+
+
+class Calibration:
+  def __init__(self, path):
+    """
+    Per-device calibration results persisted across restarts.
+
+    @param string path
+    """
+    self.path = path
+    self.logger = logging.getLogger(self.__class__.__name__)
+    self.lock = threading.Lock()
+    self.values = {}
+
+    try:
+      with open(path, 'r') as f:
+        self.values = json.load(f)
+    except FileNotFoundError:
+      pass
+    except ValueError:
+      self.logger.warning('Ignoring corrupt calibration file {}'.format(path))
+
+  def get(self, device):
+    """
+    @param string device
+    @return dict|None
+    """
+    with self.lock:
+      values = self.values.get(device)
+
+    return dict(values) if values else None
+
+  def set(self, device, **values):
+    """
+    Update calibration of a device and persist it.
+
+    @param string device
+    @param values
+    """
+    with self.lock:
+      self.values.setdefault(device, {}).update(values)
+
+      # Write to a temporary file first so a crash can't leave a truncated file behind
+      tmp = '{}.tmp'.format(self.path)
+
+      with open(tmp, 'w') as f:
+        json.dump(self.values, f, indent=2)
+
+      os.replace(tmp, self.path)
+
+
+# Shared by all workers
+calibration = Calibration(CALIBRATION_PATH)
@@ -1,8 +1,62 @@
+from util.events import bus
+
+
 class Detector:
+  bus = bus
+  _detected = False
+  _peak = None
+
   def detected(self):
     """
-    Abstract method to be implemented by all detectors.
+    Returns whether the detector currently detects something.
 
     @return bool
     """
-    raise NotImplementedError("detected() is not implemented")
+    return self._detected
+
+  def set_detected(self, detected):
+    """
+    Update detection state and publish an event if it changed.
+
+    @param bool detected
+    """
+    detected = bool(detected)
+
+    if detected != self._detected:
+      self._detected = detected
+      self.bus.publish(self.name, detected, self.tracks())
+
+  def observe_level(self, level):
+    """
+    Note a measured level, e.g. motion percentage or RMS.
+
+    @param float level
+    """
+    if self._peak is None or level > self._peak:
+      self._peak = level
+
+  def tracks(self):
+    """
+    Return summaries of objects tracked since the last take_tracks(), only detectors tracking objects have any.
+
+    @return list(dict)
+    """
+    return []
+
+  def take_tracks(self):
+    """
+    Return summaries of objects tracked since the last call, only detectors tracking objects have any.
+
+    @return list(dict)
+    """
+    return []
+
+  def take_peak(self):
+    """
+    Return the highest level observed since the last call.
+
+    @return float|None
+    """
+    peak, self._peak = self._peak, None
+
+    return peak
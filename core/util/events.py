@@ -0,0 +1,49 @@
+import time
+import threading
+from collections import deque, namedtuple
+
+# Tracks summarize the objects a detector tracked so far in the current recording
+DetectionEvent = namedtuple('DetectionEvent', ['source', 'detected', 'timestamp', 'tracks'], defaults=((),))
+
+
+class EventBus:
+  def __init__(self):
+    self.condition = threading.Condition()
+    self.events = deque()
+
+  def publish(self, source, detected, tracks=()):
+    """
+    Publish a detection state change and wake up all waiting consumers.
+
+    @param string source
+    @param bool detected
+    @param list(dict) tracks Summaries of tracked objects
+    @return DetectionEvent
+    """
+    event = DetectionEvent(source, detected, time.time(), tracks)
+
+    with self.condition:
+      self.events.append(event)
+      self.condition.notify_all()
+
+    return event
+
+  def wait(self, timeout=None):
+    """
+    Block until at least one event was published or the timeout expired.
+
+    @param float timeout Seconds to wait, None to wait forever
+    @return list(DetectionEvent)
+    """
+    with self.condition:
+      if not self.events:
+        self.condition.wait(timeout)
+
+      events = list(self.events)
+      self.events.clear()
+
+    return events
+
+
+# Shared by all detectors and the manager
+bus = EventBus()
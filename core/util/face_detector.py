@@ -0,0 +1,174 @@
+import math
+import time
+import logging
+import threading
+import numpy as np
+import cv2
+from util.metrics import metrics
+
+
+class FaceDetector(threading.Thread):
+  def __init__(self, cascade_path, fps, min_interval=5, max_interval=60, budget=0.25, only_on_motion=True):
+    """
+    Run the face cascade asynchronously on every Nth frame.
+    Between runs, boxes are extrapolated from the movement seen across the last two runs.
+    N adapts so detection uses at most {budget} of the frame budget.
+
+    @param string cascade_path
+    @param int fps
+    @param int min_interval Run at most every {min_interval} frames
+    @param int max_interval Run at least every {max_interval} frames
+    @param float budget Share of the frame time detection may use
+    @param bool only_on_motion Only run while motion is detected
+    """
+    threading.Thread.__init__(self, daemon=True)
+
+    self.name = self.__class__.__name__
+    self.logger = logging.getLogger(self.name)
+
+    # Loaded by the detection thread, so startup doesn't wait for it
+    self.cascade_path = cascade_path
+    self.cascade = None
+    self.frame_time = 1 / max(1, fps)
+    self.min_interval = min_interval
+    self.max_interval = max_interval
+    self.interval = min_interval
+    self.budget = budget
+    self.only_on_motion = only_on_motion
+
+    self.gray = None
+    self.pending = threading.Event()
+    self.lock = threading.Lock()
+
+    self.frame_index = 0
+    # Boxes as float array of (x, y, w, h), their velocity in px/frame and the frame they were found in
+    self.faces = np.empty((0, 4), np.float32)
+    self.velocity = np.empty((0, 4), np.float32)
+    self.detected_at = 0
+
+    self.duration = 0.0
+    self.runs = 0
+    self.last_report = time.time()
+
+  def submit(self, frame, motion=True):
+    """
+    Offer a frame for detection. Returns immediately.
+
+    @param array frame BGR frame
+    @param bool motion Whether motion is currently detected
+    """
+    self.frame_index += 1
+
+    if self.only_on_motion and not motion:
+      return
+
+    if self.pending.is_set() or self.frame_index % self.interval:
+      return
+
+    if self.gray is None:
+      self.gray = np.empty(frame.shape[:2], np.uint8)
+
+    cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self.gray)
+    self.submitted_at = self.frame_index
+    self.pending.set()
+
+  def boxes(self):
+    """
+    Last known faces, moved along their velocity.
+
+    @return list(tuple(int, int, int, int))
+    """
+    with self.lock:
+      elapsed = self.frame_index - self.detected_at
+
+      # Don't keep drawing faces that haven't been confirmed in a while
+      if elapsed > 2 * self.max_interval:
+        return []
+
+      predicted = self.faces + self.velocity * min(elapsed, self.max_interval)
+
+    return [tuple(int(v) for v in box) for box in predicted]
+
+  def draw(self, frame):
+    """
+    Draw a rectangle around the faces.
+
+    @param array frame
+    @return int Number of faces
+    """
+    boxes = self.boxes()
+
+    for (x, y, w, h) in boxes:
+      cv2.rectangle(frame, (x, y), (x+w, y+h), (0, 255, 0), 2)
+
+    return len(boxes)
+
+  def track(self, faces, frame_index):
+    """
+    Match new detections to previous ones by nearest center and update velocities.
+
+    @param array faces
+    @param int frame_index
+    """
+    faces = np.asarray(faces, np.float32).reshape(-1, 4)
+    velocity = np.zeros_like(faces)
+
+    with self.lock:
+      elapsed = max(1, frame_index - self.detected_at)
+
+      if len(faces) and len(self.faces):
+        centers = faces[:, :2] + faces[:, 2:] / 2
+        previous = self.faces[:, :2] + self.faces[:, 2:] / 2
+        distances = np.linalg.norm(centers[:, None] - previous[None], axis=2)
+        nearest = distances.argmin(axis=1)
+
+        # Only treat as the same face if it moved less than its own size
+        matched = distances[np.arange(len(faces)), nearest] < faces[:, 2:].max(axis=1)
+        velocity[matched] = (faces[matched] - self.faces[nearest[matched]]) / elapsed
+
+      self.faces = faces
+      self.velocity = velocity
+      self.detected_at = frame_index
+
+  def adapt(self, duration):
+    """
+    Pick the interval that keeps detection within budget.
+
+    @param float duration Seconds the last run took
+    """
+    self.duration += duration
+    self.runs += 1
+
+    interval = math.ceil(duration / (self.budget * self.frame_time))
+    self.interval = min(self.max_interval, max(self.min_interval, interval))
+
+    if time.time() - self.last_report > 60:
+      average = self.duration / self.runs
+      self.logger.info('{:.1f} ms per run, every {} frames, {:.0f}% of frame budget'.format(
+        average * 1000, self.interval, average / self.interval / self.frame_time * 100))
+
+      self.duration = 0.0
+      self.runs = 0
+      self.last_report = time.time()
+
+  def run(self):
+    """Detection loop."""
+    self.cascade = cv2.CascadeClassifier(self.cascade_path)
+
+    while True:
+      self.pending.wait()
+
+      start = time.perf_counter()
+      faces = self.cascade.detectMultiScale(
+        self.gray,
+        scaleFactor=1.1,
+        minNeighbors=5,
+        minSize=(30, 30),
+        flags=cv2.CASCADE_SCALE_IMAGE
+      )
+      duration = time.perf_counter() - start
+      metrics.histogram('face_detect').observe(duration)
+
+      self.track(faces, self.submitted_at)
+      self.adapt(duration)
+      self.pending.clear()
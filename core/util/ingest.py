@@ -0,0 +1,328 @@
+import os
+import time
+import logging
+import threading
+import subprocess
+import numpy as np
+from util.ring_buffer import AudioRingBuffer
+from util.metrics import metrics
+
+SEGMENT_LIST = 'segments.csv'
+
+
+def device_inputs(video_device, audio_device, size, fps, rate, channels):
+  """
+  @param string video_device e.g. /dev/video0
+  @param string audio_device ALSA device, e.g. hw:2,0
+  @param tuple(int, int) size (width, height)
+  @param int fps
+  @param int rate
+  @param int channels
+  @return list(string) ffmpeg arguments opening the microphone as input 0 and the camera as input 1
+  """
+  return [
+    '-f', 'alsa', '-ar', str(rate), '-ac', str(channels), '-i', audio_device,
+    '-f', 'v4l2', '-framerate', str(fps), '-video_size', '{}x{}'.format(*size), '-i', video_device,
+  ]
+
+
+def ingest_command(inputs, size, rate, channels, audio_fd, hls_path, segment_path, segment_length):
+  """
+  Build the single ffmpeg invocation owning camera and microphone.
+  Video and audio are encoded once for both the HLS stream and the recording segments,
+  raw frames and PCM are written to pipes for the detectors.
+
+  @param list(string) inputs Audio as input 0, video as input 1
+  @param tuple(int, int) size (width, height)
+  @param int rate
+  @param int channels
+  @param int audio_fd Pipe to write PCM to, video goes to stdout
+  @param string hls_path Folder of the live stream
+  @param string segment_path Folder of the recording segments
+  @param int segment_length Seconds
+  @return list(string)
+  """
+  video_size = '{}x{}'.format(*size)
+  hls = '[f=hls:hls_time=1:hls_list_size=10:hls_flags=delete_segments]{}'.format(os.path.join(hls_path, 'index.m3u8'))
+  segments = '[f=segment:segment_time={}:segment_format=mpegts:strftime=1:segment_list={}:segment_list_type=csv]{}'.format(
+    segment_length, os.path.join(segment_path, SEGMENT_LIST), os.path.join(segment_path, '%Y%m%d_%H%M%S.ts'))
+
+  return [
+    'ffmpeg', '-hide_banner', '-loglevel', 'error', '-y'] + inputs + [
+    # Encoded once, segments are cut into clips without re-encoding so they need a keyframe every second
+    '-map', '1:v', '-map', '0:a',
+    '-c:v', 'libx264', '-preset', 'ultrafast', '-tune', 'zerolatency', '-pix_fmt', 'yuv420p',
+    '-force_key_frames', 'expr:gte(t,n_forced)', '-c:a', 'aac', '-b:a', '128k',
+    '-f', 'tee', '{}|{}'.format(hls, segments),
+    # Raw copies for the detectors
+    '-map', '1:v', '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', video_size, 'pipe:1',
+    '-map', '0:a', '-f', 's16le', '-ac', str(channels), '-ar', str(rate), 'pipe:{}'.format(audio_fd),
+  ]
+
+
+class PipeVideoSource:
+  def __init__(self, pipe, size, fps):
+    """
+    Camera-like source reading raw BGR frames from a pipe.
+    Frames are drained on a thread as they arrive so a slow reader never stalls ffmpeg, only the newest one is kept.
+
+    @param file pipe
+    @param tuple(int, int) size (width, height)
+    @param int fps
+    """
+    self.pipe = pipe
+    self.shape = (size[1], size[0], 3)
+    self.fps = fps
+
+    self.condition = threading.Condition()
+    self.frame = None
+    self.sequence = 0
+    self.last = 0
+    self.closed = False
+    # Capture time of the last frame read
+    self.timestamp = None
+    self.captured = None
+    # Capture time of the first frame
+    self.started = None
+
+    threading.Thread(target=self.drain, name=self.__class__.__name__, daemon=True).start()
+
+  def drain(self):
+    """Reader loop."""
+    size = int(np.prod(self.shape))
+
+    while True:
+      buffer = bytearray(size)
+      view = memoryview(buffer)
+      read = 0
+
+      while read < size:
+        n = self.pipe.readinto(view[read:])
+
+        if not n:
+          break
+
+        read += n
+
+      if read < size:
+        break
+
+      with self.condition:
+        if self.sequence > self.last:
+          metrics.counter('ingest_frames_skipped').inc()
+
+        self.frame = np.frombuffer(buffer, np.uint8).reshape(self.shape)
+        self.captured = time.monotonic()
+        self.sequence += 1
+
+        if self.started is None:
+          self.started = self.captured
+        self.condition.notify_all()
+
+    with self.condition:
+      self.closed = True
+      self.condition.notify_all()
+
+  def read(self, timeout=5):
+    """
+    Wait for the next frame, same interface as cv2.VideoCapture.read().
+
+    @param float timeout
+    @return tuple(bool, array)
+    """
+    with self.condition:
+      if not self.condition.wait_for(lambda: self.sequence > self.last or self.closed, timeout):
+        return False, None
+
+      if self.sequence == self.last:
+        return False, None
+
+      self.last = self.sequence
+      self.timestamp = self.captured
+
+      return True, self.frame
+
+  def release(self):
+    self.pipe.close()
+
+
+class PipeAudioSource:
+  def __init__(self, pipe, rate, channels, chunk_size=1024, buffer_seconds=5):
+    """
+    Microphone-like source reading 16 bit PCM from a pipe into a ring buffer.
+
+    @param file pipe
+    @param int rate
+    @param int channels
+    @param int chunk_size Frames drained at once
+    @param float buffer_seconds How far the consumer may fall behind
+    """
+    self.pipe = pipe
+    self.rate = rate
+    self.channels = channels
+    self.frame_bytes = 2 * channels
+    self.chunk_size = chunk_size
+
+    self.ring = AudioRingBuffer(int(buffer_seconds * rate) * self.frame_bytes)
+    self.closed = False
+
+    # Capture times follow from the number of frames
+    self.started = None
+    self.frames = 0
+    self.timestamp = None
+
+    threading.Thread(target=self.drain, name=self.__class__.__name__, daemon=True).start()
+
+  def drain(self):
+    """Reader loop."""
+    while True:
+      data = self.pipe.read(self.chunk_size * self.frame_bytes)
+
+      if not data:
+        break
+
+      if self.started is None:
+        self.started = time.monotonic() - len(data) / self.frame_bytes / self.rate
+
+      if not self.ring.write(data):
+        metrics.counter('audio_ring_overruns').inc()
+
+    self.closed = True
+
+  def read(self, num_frames):
+    """
+    Block until {num_frames} frames are available.
+
+    @param int num_frames
+    @return bytes Empty at the end of the stream
+    """
+    size = num_frames * self.frame_bytes
+    data = b''
+
+    # Poll so the end of the stream is noticed
+    while not data and not (self.closed and self.ring.available() < size):
+      data = self.ring.read(size, timeout=1)
+
+    if data:
+      self.timestamp = self.started + self.frames / self.rate
+      self.frames += num_frames
+
+    return data
+
+  def close(self):
+    self.pipe.close()
+
+
+class FfmpegIngest:
+  def __init__(self, video_device, audio_device, size, fps, rate, channels, hls_path, segment_path, segment_length=10,
+               chunk_size=1024, buffer_seconds=5):
+    """
+    Own camera and microphone through a single ffmpeg process.
+    The detectors read from its pipes and recordings are cut from the segments it writes.
+
+    @param string video_device
+    @param string audio_device
+    @param tuple(int, int) size (width, height)
+    @param int fps
+    @param int rate
+    @param int channels
+    @param string hls_path
+    @param string segment_path
+    @param int segment_length
+    @param int chunk_size
+    @param float buffer_seconds
+    """
+    self.logger = logging.getLogger(self.__class__.__name__)
+    self.segment_list = os.path.join(segment_path, SEGMENT_LIST)
+    self.follower = None
+
+    audio_read, audio_write = os.pipe()
+    cmd = ingest_command(device_inputs(video_device, audio_device, size, fps, rate, channels),
+                         size, rate, channels, audio_write, hls_path, segment_path, segment_length)
+
+    self.process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, pass_fds=(audio_write,))
+    os.close(audio_write)
+
+    # Wall clock time segment times are relative to, known once the first frame or sample arrived
+    self.started = None
+
+    self.video = PipeVideoSource(self.process.stdout, size, fps)
+    self.audio = PipeAudioSource(os.fdopen(audio_read, 'rb'), rate, channels, chunk_size, buffer_seconds)
+
+    self.logger.info('Started ffmpeg ({})'.format(self.process.pid))
+
+  def stream_start(self):
+    """
+    Wall clock time of the first frame or sample read from the pipes.
+    ffmpeg starts its output timestamps there, the time it took to open the devices is left out.
+
+    @return float None if nothing was read yet
+    """
+    captured = [t for t in (self.video.started, self.audio.started) if t is not None]
+
+    if not captured:
+      return None
+
+    return time.time() - (time.monotonic() - min(captured))
+
+  def follow(self, store):
+    """
+    Add segments to the store as ffmpeg finishes them.
+
+    @param SegmentStore store
+    """
+    self.follower = threading.Thread(target=self.follow_segments, args=(store,), name='SegmentFollower', daemon=True)
+    self.follower.start()
+
+  def follow_segments(self, store):
+    """
+    Tail the segment list.
+
+    @param SegmentStore store
+    """
+    position = 0
+
+    while True:
+      # The last segment is listed when ffmpeg exits
+      finished = self.process.poll() is not None
+
+      if self.started is None:
+        self.started = self.stream_start()
+
+      if self.started is None:
+        if finished:
+          break
+
+        time.sleep(1)
+        continue
+
+      try:
+        with open(self.segment_list, 'r') as f:
+          f.seek(position)
+          lines = f.readlines()
+      except FileNotFoundError:
+        lines = []
+
+      for line in lines:
+        # Line is still being written
+        if not line.endswith('\n'):
+          break
+
+        position += len(line)
+        filename, start, end = line.strip().rsplit(',', 2)
+        store.add(os.path.splitext(filename)[0], None, self.started + float(start), self.started + float(end))
+
+      if finished:
+        break
+
+      time.sleep(1)
+
+    self.logger.warning('ffmpeg exited with {}'.format(self.process.returncode))
+
+  def close(self):
+    """Let ffmpeg finish the current segment and exit."""
+    self.process.terminate()
+    self.process.wait()
+
+    if self.follower:
+      self.follower.join()
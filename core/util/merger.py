@@ -0,0 +1,157 @@
+import os
+import time
+import queue
+import logging
+import threading
+import subprocess
+from util.metrics import metrics
+from util.recorder import start_time_path, read_start_time
+from util.audio_writer import AUDIO_EXTENSIONS
+
+
+def merge_command(video, audio, destination, offset=0):
+  """
+  Build a single ffmpeg invocation producing a browser-playable MP4, or an MPEG-TS segment if destination ends in .ts.
+  Video is re-encoded to H.264/yuv420p in the same pass, AAC audio is copied and anything else encoded to AAC.
+
+  @param string video Path to video input, None to skip
+  @param string audio Path to audio input, None to skip
+  @param string destination
+  @param float offset Seconds the audio started after the video, negative if before
+  @return list(string)
+  """
+  cmd = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y']
+  maps = []
+
+  for i, path in enumerate(p for p in (video, audio) if p):
+    # Align audio to the start of the video
+    if path == audio and video and offset > 0:
+      cmd += ['-itsoffset', '{:.3f}'.format(offset)]
+    elif path == audio and video and offset < 0:
+      cmd += ['-ss', '{:.3f}'.format(-offset)]
+
+    cmd += ['-i', path]
+    maps += ['-map', '{}:{}'.format(i, 'v:0' if path == video else 'a:0')]
+
+  cmd += maps
+
+  segment = destination.endswith('.ts')
+
+  if video:
+    cmd += ['-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p']
+
+    # Segments are cut without re-encoding later, so clips can only start on a keyframe
+    if segment:
+      cmd += ['-force_key_frames', 'expr:gte(t,n_forced)']
+
+  if audio and audio.endswith('.aac'):
+    cmd += ['-c:a', 'copy']
+
+    # ADTS headers don't belong into MP4
+    if not segment:
+      cmd += ['-bsf:a', 'aac_adtstoasc']
+  elif audio:
+    cmd += ['-c:a', 'aac', '-b:a', '128k']
+
+  if segment:
+    # Audio running over would shift the following segments
+    return cmd + ['-shortest', '-f', 'mpegts', destination]
+
+  return cmd + ['-movflags', '+faststart', destination]
+
+
+class Merger:
+  def __init__(self, workers=1, archive=None):
+    """
+    Merge recordings in the background so the watch loop never blocks on ffmpeg.
+
+    @param int workers Number of concurrent merge jobs
+    @param ArchiveIndex archive Index to add merged clips to
+    """
+    self.logger = logging.getLogger(self.__class__.__name__)
+    self.archive = archive
+    self.queue = queue.Queue()
+    self.threads = []
+
+    for i in range(workers):
+      t = threading.Thread(target=self.work, name='Merger-{}'.format(i), daemon=True)
+      t.start()
+      self.threads.append(t)
+
+  def submit(self, filename, source, destination, metadata=None):
+    """
+    Queue a merge job.
+
+    @param string filename Recording name without extension
+    @param string source Folder containing the .avi and the audio recording
+    @param string destination Folder to write the .mp4 to
+    @param dict metadata Passed on to ArchiveIndex.add()
+    """
+    self.queue.put((filename, source, destination, metadata or {}))
+    self.logger.info('Queued {} ({} pending)'.format(filename, self.queue.qsize()))
+
+  def close(self):
+    """Wait for all queued jobs to finish."""
+    self.queue.join()
+
+  def work(self):
+    """Worker loop."""
+    while True:
+      filename, source, destination, metadata = self.queue.get()
+
+      try:
+        if self.merge(filename, source, destination) and self.archive:
+          self.archive.add(os.path.join(destination, '{}.mp4'.format(filename)), **metadata)
+      except Exception:
+        self.logger.exception('Merging {} failed'.format(filename))
+      finally:
+        self.queue.task_done()
+
+  def merge(self, filename, source, destination, extension='mp4'):
+    """
+    Merge .avi and the audio recording into .mp4 aligned by capture time and remove the sources on success.
+
+    @param string filename
+    @param string source
+    @param string destination
+    @param string extension 'mp4' or 'ts'
+    @return bool
+    """
+    start = time.time()
+
+    video = os.path.join(source, '{}.avi'.format(filename))
+    video = video if os.path.exists(video) else None
+    audio = next((path for path in (os.path.join(source, '{}.{}'.format(filename, ext)) for ext in AUDIO_EXTENSIONS)
+                  if os.path.exists(path)), None)
+
+    if not video and not audio:
+      self.logger.warning('Nothing to merge for {}'.format(filename))
+      return False
+
+    # Recorders note when their first sample was captured
+    starts = [read_start_time(path) if path else None for path in (video, audio)]
+    offset = starts[1] - starts[0] if None not in starts else 0
+
+    self.logger.debug('Aligning audio of {} by {:+.3f}s'.format(filename, offset))
+
+    output = os.path.join(destination, '{}.{}'.format(filename, extension))
+    result = subprocess.run(merge_command(video, audio, output, offset), stdin=subprocess.DEVNULL,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    if result.returncode != 0:
+      metrics.counter('merge_failures').inc()
+      self.logger.error('ffmpeg failed for {}: {}'.format(filename, result.stderr.decode(errors='replace').strip()))
+      return False
+
+    for path in (video, audio):
+      if path:
+        os.remove(path)
+
+        if os.path.exists(start_time_path(path)):
+          os.remove(start_time_path(path))
+
+    duration = time.time() - start
+    metrics.histogram('merge').observe(duration)
+    self.logger.info('Merged {} in {:.2f}s'.format(filename, duration))
+
+    return True
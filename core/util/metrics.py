@@ -0,0 +1,224 @@
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+
+PREFIX = 'simplecam'
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Histogram:
+  def __init__(self, name, size=2048):
+    """
+    Keep the last {size} observations to compute quantiles from.
+
+    @param string name
+    @param int size
+    """
+    self.name = name
+    self.values = np.zeros(size, np.float64)
+    self.index = 0
+    self.count = 0
+    self.sum = 0.0
+    self.lock = threading.Lock()
+
+  def observe(self, value):
+    """
+    @param float value
+    """
+    with self.lock:
+      self.values[self.index % len(self.values)] = value
+      self.index += 1
+      self.count += 1
+      self.sum += value
+
+  def quantiles(self):
+    """
+    @return dict(float, float)
+    """
+    with self.lock:
+      values = self.values[:min(self.index, len(self.values))].copy()
+
+    if not len(values):
+      return {q: 0.0 for q in QUANTILES}
+
+    return dict(zip(QUANTILES, np.quantile(values, QUANTILES)))
+
+
+class Counter:
+  def __init__(self, name):
+    """
+    @param string name
+    """
+    self.name = name
+    self.value = 0
+    self.lock = threading.Lock()
+
+  def inc(self, amount=1):
+    """
+    @param int amount
+    """
+    with self.lock:
+      self.value += amount
+
+
+class Registry:
+  def __init__(self):
+    self.histograms = {}
+    self.counters = {}
+    self.lock = threading.Lock()
+
+  def histogram(self, name):
+    """
+    Get or create a histogram.
+
+    @param string name
+    @return Histogram
+    """
+    with self.lock:
+      if name not in self.histograms:
+        self.histograms[name] = Histogram(name)
+
+      return self.histograms[name]
+
+  def counter(self, name):
+    """
+    Get or create a counter.
+
+    @param string name
+    @return Counter
+    """
+    with self.lock:
+      if name not in self.counters:
+        self.counters[name] = Counter(name)
+
+      return self.counters[name]
+
+  @contextmanager
+  def timer(self, name):
+    """
+    Time the enclosed block in seconds.
+
+    @param string name
+    """
+    start = time.perf_counter()
+
+    try:
+      yield
+    finally:
+      self.histogram(name).observe(time.perf_counter() - start)
+
+  def snapshot(self):
+    """
+    @return tuple(list, list) Sorted (name, metric) pairs of histograms and counters
+    """
+    with self.lock:
+      return sorted(self.histograms.items()), sorted(self.counters.items())
+
+  def prometheus(self):
+    """
+    Render all metrics in Prometheus text format.
+
+    @return string
+    """
+    lines = []
+    histograms, counters = self.snapshot()
+
+    for name, h in histograms:
+      metric = '{}_{}_seconds'.format(PREFIX, name)
+      lines.append('# TYPE {} summary'.format(metric))
+
+      for q, v in h.quantiles().items():
+        lines.append('{}{{quantile="{}"}} {:.6f}'.format(metric, q, v))
+
+      lines.append('{}_sum {:.6f}'.format(metric, h.sum))
+      lines.append('{}_count {}'.format(metric, h.count))
+
+    for name, c in counters:
+      metric = '{}_{}_total'.format(PREFIX, name)
+      lines.append('# TYPE {} counter'.format(metric))
+      lines.append('{} {}'.format(metric, c.value))
+
+    return '\n'.join(lines) + '\n'
+
+  def summary(self):
+    """
+    One line per metric for the log.
+
+    @return list(string)
+    """
+    lines = []
+    histograms, counters = self.snapshot()
+
+    for name, h in histograms:
+      q = h.quantiles()
+      lines.append('{}: n={} p50={:.1f}ms p95={:.1f}ms p99={:.1f}ms'.format(
+        name, h.count, q[0.5] * 1000, q[0.95] * 1000, q[0.99] * 1000))
+
+    for name, c in counters:
+      lines.append('{}: {}'.format(name, c.value))
+
+    return lines
+
+
+# Shared by all workers
+metrics = Registry()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+  def do_GET(self):
+    if self.path != '/metrics':
+      self.send_error(404)
+      return
+
+    body = metrics.prometheus().encode()
+
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    # Keep scrapes out of the log
+    pass
+
+
+class MetricsServer(threading.Thread):
+  def __init__(self, port, host='127.0.0.1'):
+    """
+    Serve metrics on http://{host}:{port}/metrics
+
+    @param int port
+    @param string host
+    """
+    threading.Thread.__init__(self, daemon=True)
+
+    self.name = self.__class__.__name__
+    self.server = ThreadingHTTPServer((host, port), MetricsHandler)
+
+  def run(self):
+    self.server.serve_forever()
+
+
+class MetricsReporter(threading.Thread):
+  def __init__(self, interval):
+    """
+    Log a summary of all metrics every {interval} seconds.
+
+    @param float interval
+    """
+    threading.Thread.__init__(self, daemon=True)
+
+    self.name = self.__class__.__name__
+    self.logger = logging.getLogger(self.name)
+    self.interval = interval
+
+  def run(self):
+    while True:
+      time.sleep(self.interval)
+
+      for line in metrics.summary():
+        self.logger.info(line)
@@ -0,0 +1,268 @@
+import os
+import numpy as np
+import cv2
+from util.metrics import metrics
+
+
+def load_roi(spec, width, height):
+  """
+  Build a region-of-interest mask at full resolution.
+  The spec is either a path to a mask image (white = observed) or a list of rectangles as "x,y,w,h;x,y,w,h".
+
+  @param string spec
+  @param int width
+  @param int height
+  @return array|None
+  """
+  if not spec:
+    return None
+
+  if os.path.isfile(spec):
+    mask = cv2.imread(spec, cv2.IMREAD_GRAYSCALE)
+
+    if mask is None:
+      raise ValueError("Could not read ROI mask: {}".format(spec))
+
+    mask = cv2.resize(mask, (width, height), interpolation=cv2.INTER_NEAREST)
+    return cv2.threshold(mask, 127, 255, cv2.THRESH_BINARY)[1]
+
+  mask = np.zeros((height, width), np.uint8)
+
+  for rect in spec.split(';'):
+    x, y, w, h = [int(v) for v in rect.split(',')]
+    mask[y:y + h, x:x + w] = 255
+
+  return mask
+
+
+class MotionPipeline:
+  # Share of the observed pixels that have to follow a brightness change for it to count as a lighting change
+  ILLUMINATION_SHARE = 0.6
+
+  def __init__(self, width, height, scale=1.0, roi=None, pixel_threshold=15, dilate_iterations=4, illumination_change=0):
+    """
+    Motion engine interface.
+    Frames are downscaled, converted to gray and blurred, engines only decide which pixels are foreground.
+    Optionally restricted to a region of interest. All intermediate frames are allocated once and reused.
+
+    @param int width Width of input frames
+    @param int height Height of input frames
+    @param float scale Factor to downscale frames by before processing
+    @param array roi Full resolution mask, non-zero pixels are observed
+    @param int pixel_threshold Minimum intensity change for a pixel to count as moved
+    @param int dilate_iterations
+    @param float illumination_change Mean brightness difference (0-255) to the background taken as a lighting change
+                                     instead of motion if most pixels changed the same way, 0 to never reject frames
+    """
+    self.scale = scale
+    self.size = (max(1, int(width * scale)), max(1, int(height * scale)))
+    self.pixel_threshold = pixel_threshold
+    self.dilate_iterations = dilate_iterations
+    self.illumination_change = illumination_change
+
+    # Keep the blur radius proportional to the image
+    k = max(3, int(21 * scale) | 1)
+    self.blur_kernel = (k, k)
+    self.kernel = np.ones((5, 5), np.uint8)
+
+    w, h = self.size
+    self.small = np.empty((h, w, 3), np.uint8) if scale != 1 else None
+    self.gray = np.empty((h, w), np.uint8)
+    self.current = np.empty((h, w), np.uint8)
+    self.thresholded = np.empty((h, w), np.uint8)
+    self.dilated = np.zeros((h, w), np.uint8)
+    self.lighting = np.empty((h, w), np.uint8)
+    self.started = False
+    # Mean brightness of the background, following it as fast as the engine learns
+    self.brightness = None
+    self.learning_rate = 1.0
+
+    self.mask = None
+    self.observed = w * h
+
+    if roi is not None:
+      self.mask = cv2.resize(roi, self.size, interpolation=cv2.INTER_NEAREST)
+      self.observed = max(1, np.count_nonzero(self.mask))
+
+  def process(self, frame):
+    """
+    Compare frame with the background.
+
+    @param array frame BGR frame at full resolution
+    @return float|None Percentage of observed pixels that moved, None for the very first frame
+    """
+    if self.small is not None:
+      cv2.resize(frame, self.size, dst=self.small, interpolation=cv2.INTER_AREA)
+      frame = self.small
+
+    cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self.gray)
+    cv2.GaussianBlur(self.gray, self.blur_kernel, 0, dst=self.current)
+
+    brightness = cv2.mean(self.current, self.mask)[0]
+
+    if not self.started:
+      self.reset()
+      self.brightness = brightness
+      self.started = True
+      return None
+
+    # Lights switched on, the camera's IR filter flipped or exposure ramped up, start over from this frame
+    shift = brightness - self.brightness
+
+    if self.illumination_change and abs(shift) > self.illumination_change and self.lighting_changed(shift):
+      metrics.counter('illumination_changes').inc()
+      self.reset()
+      self.brightness = brightness
+      self.dilated[:] = 0
+      return 0.0
+
+    self.foreground()
+    self.brightness += self.learning_rate * shift
+
+    # Dilate the thresholded image to fill in holes
+    cv2.dilate(self.thresholded, self.kernel, dst=self.dilated, iterations=self.dilate_iterations)
+
+    if self.mask is not None:
+      cv2.bitwise_and(self.dilated, self.mask, dst=self.dilated)
+
+    return np.count_nonzero(self.dilated) * 100 / self.observed
+
+  def lighting_changed(self, shift):
+    """
+    Tell a lighting change, which brightens or darkens most of the image, from something big moving close by.
+
+    @param float shift Mean brightness difference of the current frame to the background
+    @return bool
+    """
+    background = self.background()
+
+    if shift > 0:
+      cv2.subtract(self.current, background, dst=self.lighting)
+    else:
+      cv2.subtract(background, self.current, dst=self.lighting)
+
+    # Pixels that changed by at least half as much as the mean in the same direction
+    cv2.threshold(self.lighting, abs(shift) / 2, 255, cv2.THRESH_BINARY, dst=self.lighting)
+
+    if self.mask is not None:
+      cv2.bitwise_and(self.lighting, self.mask, dst=self.lighting)
+
+    return np.count_nonzero(self.lighting) >= self.ILLUMINATION_SHARE * self.observed
+
+  def reset(self):
+    """Learn the background from the current frame only."""
+    raise NotImplementedError("reset() is not implemented")
+
+  def background(self):
+    """
+    @return array Current background as gray image
+    """
+    raise NotImplementedError("background() is not implemented")
+
+  def foreground(self):
+    """Write the foreground of the current frame to {thresholded} and update the background."""
+    raise NotImplementedError("foreground() is not implemented")
+
+
+class FrameDifference(MotionPipeline):
+  def __init__(self, width, height, learning_rate=None, **options):
+    """
+    Differences between consecutive frames.
+    Cheapest, but slow movement barely differs from one frame to the next.
+
+    @param float learning_rate Unused, there is no background to learn
+    """
+    MotionPipeline.__init__(self, width, height, **options)
+
+    self.previous = np.empty_like(self.current)
+    self.delta = np.empty_like(self.current)
+
+  def reset(self):
+    # Current frame becomes the previous one
+    self.current, self.previous = self.previous, self.current
+
+  def background(self):
+    return self.previous
+
+  def foreground(self):
+    cv2.absdiff(self.previous, self.current, dst=self.delta)
+    cv2.threshold(self.delta, self.pixel_threshold, 255, cv2.THRESH_BINARY, dst=self.thresholded)
+
+    self.reset()
+
+
+class RunningAverage(MotionPipeline):
+  def __init__(self, width, height, learning_rate=0.02, **options):
+    """
+    Differences to an exponentially weighted average of past frames.
+    Catches slow movement, anything staying still is absorbed into the background after about 1 / {learning_rate} frames.
+
+    @param float learning_rate Weight of the current frame
+    """
+    MotionPipeline.__init__(self, width, height, **options)
+
+    self.learning_rate = learning_rate
+    self.average = np.empty(self.current.shape, np.float32)
+    self.background_image = np.empty_like(self.current)
+    self.delta = np.empty_like(self.current)
+
+  def reset(self):
+    self.average[:] = self.current
+
+  def background(self):
+    cv2.convertScaleAbs(self.average, dst=self.background_image)
+    return self.background_image
+
+  def foreground(self):
+    cv2.absdiff(self.background(), self.current, dst=self.delta)
+    cv2.threshold(self.delta, self.pixel_threshold, 255, cv2.THRESH_BINARY, dst=self.thresholded)
+
+    cv2.accumulateWeighted(self.current, self.average, self.learning_rate)
+
+
+class BackgroundSubtractor(MotionPipeline):
+  def __init__(self, width, height, learning_rate=0.005, **options):
+    """
+    OpenCV's MOG2, a mixture of Gaussians per pixel.
+    Most expensive, copes with repetitive background movement like leaves or flickering.
+    The pixel threshold is not used, the model decides per pixel what is unusual.
+
+    @param float learning_rate
+    """
+    MotionPipeline.__init__(self, width, height, **options)
+
+    self.learning_rate = learning_rate
+    self.subtractor = cv2.createBackgroundSubtractorMOG2(
+      history=int(1 / learning_rate), detectShadows=False)
+
+  def reset(self):
+    # Replace the model completely
+    self.subtractor.apply(self.current, self.thresholded, 1)
+
+  def background(self):
+    # Only needed when the brightness is off, not worth keeping up to date
+    return self.subtractor.getBackgroundImage()
+
+  def foreground(self):
+    self.subtractor.apply(self.current, self.thresholded, self.learning_rate)
+
+
+ENGINES = {
+  'diff': FrameDifference,
+  'average': RunningAverage,
+  'mog2': BackgroundSubtractor,
+}
+
+
+def create_pipeline(engine, width, height, **options):
+  """
+  @param string engine diff, average or mog2
+  @param int width
+  @param int height
+  @param options Passed to the engine
+  @return MotionPipeline
+  """
+  if engine not in ENGINES:
+    raise ValueError("Unknown motion engine '{}', choose from: {}".format(engine, ', '.join(ENGINES)))
+
+  return ENGINES[engine](width, height, **options)
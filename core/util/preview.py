@@ -0,0 +1,276 @@
+import time
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from util.metrics import metrics
+
+BOUNDARY = 'frame'
+
+
+def draw_overlays(frame, overlays):
+  """
+  Draw contours and faces on a frame.
+
+  @param array frame Drawn on in place
+  @param dict overlays contours at full resolution and faces as (x, y, w, h)
+  """
+  import cv2
+
+  cv2.drawContours(frame, overlays.get('contours') or [], -1, (0, 0, 255), 2)
+
+  for (x, y, w, h) in overlays.get('faces') or []:
+    cv2.rectangle(frame, (x, y), (x+w, y+h), (0, 255, 0), 2)
+
+
+class PreviewStream(threading.Thread):
+  def __init__(self, name, hub):
+    """
+    Latest frame of a camera, JPEG-encoded at most once per tick and shared by all viewers.
+    With and without overlays are separate variants, each only encoded while someone is watching it.
+
+    @param string name
+    @param Preview hub Holds frame rate and quality
+    """
+    threading.Thread.__init__(self, daemon=True)
+
+    self.name = 'Preview-{}'.format(name)
+    self.hub = hub
+
+    self.condition = threading.Condition()
+    self.frame = None
+    self.overlays = None
+    self.next_tick = 0
+    # Viewers, sequence number and JPEG per variant
+    self.viewers = {False: 0, True: 0}
+    self.jpegs = {False: (0, None), True: (0, None)}
+    self.sequence = 0
+
+  def wants(self, now):
+    """
+    @param float now
+    @return bool Whether a frame should be published
+    """
+    return (self.viewers[False] or self.viewers[True]) and now >= self.next_tick and self.frame is None
+
+  def publish(self, frame, overlays=None):
+    """
+    Hand a frame to the encoder, returns right away.
+
+    @param array frame Must not be modified afterwards
+    @param dict overlays
+    """
+    interval = 1 / self.hub.fps
+
+    with self.condition:
+      self.frame = frame
+      self.overlays = overlays
+      # Keep to the schedule rather than the camera's frame times, without catching up after a pause
+      self.next_tick = max(self.next_tick, time.monotonic() - interval) + interval
+      self.condition.notify_all()
+
+  def run(self):
+    """Encoder loop."""
+    # Only needed once someone watches
+    import cv2
+
+    while True:
+      with self.condition:
+        self.condition.wait_for(lambda: self.frame is not None)
+        frame, overlays = self.frame, self.overlays
+        variants = [v for v in (False, True) if self.viewers[v]]
+
+      self.sequence += 1
+
+      for overlay in variants:
+        image = frame
+
+        if overlay and overlays:
+          image = frame.copy()
+          draw_overlays(image, overlays)
+
+        with metrics.timer('preview_encode'):
+          ok, jpeg = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, self.hub.quality])
+
+        if ok:
+          with self.condition:
+            self.jpegs[overlay] = (self.sequence, jpeg.tobytes())
+
+      with self.condition:
+        # Only now the camera may publish the next frame
+        self.frame = None
+        self.condition.notify_all()
+
+  def join_viewers(self, overlay):
+    """
+    @param bool overlay
+    """
+    with self.condition:
+      self.viewers[overlay] += 1
+
+  def leave_viewers(self, overlay):
+    """
+    @param bool overlay
+    """
+    with self.condition:
+      self.viewers[overlay] -= 1
+
+  def next(self, overlay, last, timeout=5):
+    """
+    Wait for a JPEG newer than the one a viewer got last.
+
+    @param bool overlay
+    @param int last Sequence number of the viewer's last JPEG
+    @param float timeout
+    @return tuple(int, bytes) bytes is None on timeout
+    """
+    with self.condition:
+      self.condition.wait_for(lambda: self.jpegs[overlay][0] > last, timeout)
+
+      sequence, jpeg = self.jpegs[overlay]
+
+    return (sequence, jpeg) if sequence > last else (last, None)
+
+
+class Preview:
+  def __init__(self):
+    """Registry of preview streams, one per camera."""
+    self.lock = threading.Lock()
+    self.streams = {}
+    self.enabled = False
+    self.fps = 10
+    self.quality = 70
+
+  def register(self, name):
+    """
+    Offer a camera for preview, does nothing unless the preview server runs.
+
+    @param string name
+    """
+    if self.enabled:
+      self.stream(name)
+
+  def stream(self, name):
+    """
+    @param string name
+    @return PreviewStream
+    """
+    with self.lock:
+      if name not in self.streams:
+        self.streams[name] = PreviewStream(name, self)
+        self.streams[name].start()
+
+      return self.streams[name]
+
+  def wants(self, name):
+    """
+    Cheap enough to ask on every frame.
+
+    @param string name
+    @return tuple(bool, bool) Whether to publish a frame and whether anyone wants overlays
+    """
+    stream = self.streams.get(name)
+
+    if stream is None or not stream.wants(time.monotonic()):
+      return False, False
+
+    return True, stream.viewers[True] > 0
+
+  def publish(self, name, frame, overlays=None):
+    """
+    @param string name
+    @param array frame
+    @param dict overlays
+    """
+    self.stream(name).publish(frame, overlays)
+
+
+class PreviewHandler(BaseHTTPRequestHandler):
+  def do_GET(self):
+    url = urlparse(self.path)
+    names = sorted(preview.streams)
+
+    if url.path == '/':
+      body = ''.join('<p>{0}<br><img src="/preview/{0}.mjpg?overlay=1"></p>'.format(n) for n in names).encode()
+      self.send_response(200)
+      self.send_header('Content-Type', 'text/html')
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+      return
+
+    # /preview.mjpg is the first camera
+    name = url.path[len('/preview/'):-len('.mjpg')] if url.path.startswith('/preview/') else (names or [None])[0]
+
+    if not url.path.endswith('.mjpg') or name not in preview.streams:
+      self.send_error(404)
+      return
+
+    self.send_stream(preview.streams[name], parse_qs(url.query).get('overlay', ['0'])[0] == '1')
+
+  def send_stream(self, stream, overlay):
+    """
+    Send JPEGs as multipart until the viewer disconnects.
+    A viewer that's slower than the camera only ever gets the newest frame, nothing queues up.
+
+    @param PreviewStream stream
+    @param bool overlay
+    """
+    self.send_response(200)
+    self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary={}'.format(BOUNDARY))
+    self.send_header('Cache-Control', 'no-cache')
+    self.end_headers()
+
+    stream.join_viewers(overlay)
+    last = 0
+
+    try:
+      while True:
+        sequence, jpeg = stream.next(overlay, last)
+
+        if jpeg is None:
+          continue
+
+        if last and sequence > last + 1:
+          metrics.counter('preview_frames_dropped').inc(sequence - last - 1)
+
+        last = sequence
+
+        self.wfile.write('--{}\r\nContent-Type: image/jpeg\r\nContent-Length: {}\r\n\r\n'.format(
+          BOUNDARY, len(jpeg)).encode() + jpeg + b'\r\n')
+    except (BrokenPipeError, ConnectionResetError):
+      pass
+    finally:
+      stream.leave_viewers(overlay)
+
+  def log_message(self, format, *args):
+    # Keep viewers out of the log
+    pass
+
+
+class PreviewServer(threading.Thread):
+  def __init__(self, port, host='0.0.0.0', fps=10, quality=70):
+    """
+    Serve a low latency MJPEG preview of every camera on http://{host}:{port}/preview/{camera}.mjpg
+    Add ?overlay=1 for contours and faces.
+
+    @param int port
+    @param string host
+    @param float fps Frames per second sent to viewers at most
+    @param int quality JPEG quality
+    """
+    threading.Thread.__init__(self, daemon=True)
+
+    self.name = self.__class__.__name__
+    self.server = ThreadingHTTPServer((host, port), PreviewHandler)
+    self.server.daemon_threads = True
+
+    preview.enabled = True
+    preview.fps = fps
+    preview.quality = quality
+
+  def run(self):
+    self.server.serve_forever()
+
+
+# Shared by all cameras and the preview server
+preview = Preview()
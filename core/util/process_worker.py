@@ -0,0 +1,167 @@
+import time
+import queue
+import signal
+import logging
+import threading
+import multiprocessing
+from util.detector import Detector
+from util.recorder import Recorder
+
+
+class QueueBus:
+  def __init__(self, queue):
+    """
+    Stand-in for the event bus inside a worker process, forwarding events to the manager.
+
+    @param multiprocessing.Queue queue
+    """
+    self.queue = queue
+
+  def publish(self, source, detected, tracks=()):
+    """
+    @param string source
+    @param bool detected
+    @param list(dict) tracks
+    """
+    self.queue.put((source, detected, tracks))
+
+
+def run_worker(factory, kwargs, commands, events, acks):
+  """
+  Entry point of a worker process.
+
+  @param callable factory
+  @param dict kwargs
+  @param multiprocessing.Queue commands
+  @param multiprocessing.Queue events
+  @param multiprocessing.Queue acks
+  """
+  # Ctrl+C is handled by the manager, which still has to stop recordings through this process
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+  Detector.bus = QueueBus(events)
+  logger = logging.getLogger(factory.__name__)
+
+  worker = factory(**kwargs)
+  worker.daemon = True
+  worker.start()
+
+  while True:
+    sequence, command, args = commands.get()
+
+    result = None
+
+    try:
+      result = getattr(worker, command)(*args)
+    except Exception:
+      logger.exception('{} failed'.format(command))
+    finally:
+      acks.put((sequence, result))
+
+
+class ProcessWorker(Detector, Recorder):
+  def __init__(self, factory, timeout=30, **kwargs):
+    """
+    Run a worker in its own process while looking like a local one to the manager.
+
+    @param class factory Worker class, instantiated inside the child process
+    @param float timeout Seconds to wait for a call to return
+    @param dict kwargs Passed to the worker's constructor
+    """
+    self.name = kwargs.get('name') or factory.__name__
+    self.logger = logging.getLogger(self.name)
+    self.timeout = timeout
+    self.is_recorder = issubclass(factory, Recorder)
+
+    self.commands = multiprocessing.Queue()
+    self.events = multiprocessing.Queue()
+    self.acks = multiprocessing.Queue()
+    # Segments are finished from another thread than the watch loop, acks must not get mixed up
+    self.lock = threading.Lock()
+    # Acks of calls that timed out arrive late and are skipped by their sequence number
+    self.sequence = 0
+
+    self.process = multiprocessing.Process(
+      target=run_worker, args=(factory, kwargs, self.commands, self.events, self.acks), name=self.name, daemon=True)
+    self.relay = threading.Thread(target=self.forward, name='{}-relay'.format(self.name), daemon=True)
+
+  def start(self):
+    """Start the worker process."""
+    self.process.start()
+    self.relay.start()
+
+  def forward(self):
+    """Publish detections from the worker process on the local bus."""
+    while True:
+      _, detected, tracks = self.events.get()
+      self._detected = detected
+      self.bus.publish(self.name, detected, tracks)
+
+  def call(self, command, *args, default=None):
+    """
+    Run a method in the worker process and wait for it to finish.
+    Never blocks on a dead or hung worker, the failure is logged and {default} returned instead.
+
+    @param string command
+    @param default Returned if the worker doesn't answer
+    @return Whatever the method returned
+    """
+    with self.lock:
+      if not self.process.is_alive():
+        self.logger.error('Worker process is gone (exit code {}), skipping {}'.format(self.process.exitcode, command))
+        return default
+
+      self.sequence += 1
+      self.commands.put((self.sequence, command, args))
+      deadline = time.monotonic() + self.timeout
+
+      while time.monotonic() < deadline:
+        try:
+          sequence, result = self.acks.get(timeout=min(1, max(0, deadline - time.monotonic())))
+        except queue.Empty:
+          if not self.process.is_alive():
+            self.logger.error('Worker process died during {} (exit code {})'.format(command, self.process.exitcode))
+            return default
+
+          continue
+
+        if sequence == self.sequence:
+          return result
+
+      self.logger.error('{} timed out after {}s'.format(command, self.timeout))
+
+      return default
+
+  def start_recording(self, path):
+    """
+    @param string path
+    """
+    if self.is_recorder:
+      self.call('start_recording', path)
+
+  def stop_recording(self):
+    if self.is_recorder:
+      self.call('stop_recording')
+
+  def switch_recording(self, path):
+    """
+    @param string path
+    """
+    if self.is_recorder:
+      self.call('switch_recording', path)
+
+  def finish_recording(self):
+    if self.is_recorder:
+      self.call('finish_recording')
+
+  def take_peak(self):
+    """
+    @return float|None
+    """
+    return self.call('take_peak')
+
+  def take_tracks(self):
+    """
+    @return list(dict)
+    """
+    return self.call('take_tracks', default=[])
@@ -1,3 +1,34 @@
+def start_time_path(path):
+  """
+  @param string path Recorded media file
+  @return string Path of the file holding its start time
+  """
+  return '{}.start'.format(path)
+
+
+def write_start_time(path, timestamp):
+  """
+  Note the capture time of the first sample of a recording, so streams can be aligned when merging.
+
+  @param string path Recorded media file
+  @param float timestamp Monotonic capture time
+  """
+  with open(start_time_path(path), 'w') as f:
+    f.write(repr(float(timestamp)))
+
+
+def read_start_time(path):
+  """
+  @param string path Recorded media file
+  @return float|None
+  """
+  try:
+    with open(start_time_path(path), 'r') as f:
+      return float(f.read())
+  except (FileNotFoundError, ValueError):
+    return None
+
+
 class Recorder:
   def start_recording(self, path):
     """
@@ -10,3 +41,17 @@ class Recorder:
   def stop_recording(self):
     """Abstract method to be implemented by all recorders."""
     raise NotImplementedError("stop_recording() is not implemented")
+
+  def switch_recording(self, path):
+    """
+    Continue recording into a new file, the previous one is finished by finish_recording().
+    Recorders which can't switch without a gap stop and start again.
+
+    @param string path
+    """
+    self.stop_recording()
+    self.start_recording(path)
+
+  def finish_recording(self):
+    """Finish the files left behind by switch_recording(), may be called from another thread."""
+    pass
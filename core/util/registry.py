@@ -0,0 +1,34 @@
+import importlib
+
+# Worker kinds, only imported once enabled
+WORKERS = {
+  'noise': ('workers.noise', 'NoiseDetector'),
+  'motion': ('workers.motion', 'MotionDetector'),
+  'pir': ('workers.pir', 'PIRDetector'),
+}
+
+
+def parse_workers(value):
+  """
+  @param string value e.g. noise,motion,pir
+  @return list(string) Enabled worker kinds
+  """
+  kinds = [v.strip() for v in (value or '').split(',') if v.strip()]
+
+  for kind in kinds:
+    if kind not in WORKERS:
+      raise ValueError("Unknown worker '{}', choose from: {}".format(kind, ', '.join(WORKERS)))
+
+  return kinds
+
+
+def load_worker(kind):
+  """
+  Import a worker class on first use.
+
+  @param string kind
+  @return class
+  """
+  module, name = WORKERS[kind]
+
+  return getattr(importlib.import_module(module), name)
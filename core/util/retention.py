@@ -0,0 +1,229 @@
+import os
+import time
+import shutil
+import logging
+import threading
+import subprocess
+from util.metrics import metrics
+
+GB = 1024 ** 3
+DAY = 24 * 60 * 60
+
+
+def compact_command(source, destination, height=480, crf=30):
+  """
+  Build a lowest-priority ffmpeg invocation re-encoding a clip at lower resolution and bitrate.
+
+  @param string source
+  @param string destination
+  @param int height Maximum height, aspect ratio is kept
+  @param int crf H.264 quality, higher is smaller
+  @return list(string)
+  """
+  return ['nice', '-n', '19', 'ffmpeg', '-hide_banner', '-loglevel', 'error', '-y', '-i', source,
+          '-vf', "scale=-2:'min({},ih)'".format(height), '-c:v', 'libx264', '-preset', 'veryfast', '-crf', str(crf),
+          '-pix_fmt', 'yuv420p', '-c:a', 'aac', '-b:a', '64k', '-threads', '1', '-movflags', '+faststart', '-f', 'mp4', destination]
+
+
+class Retention(threading.Thread):
+  def __init__(self, archive, max_age=0, max_size=0, min_free=0, compact_after=0, compact_batch=5,
+               compact_height=480, compact_crf=30, max_load=0.75, interval=300):
+    """
+    Keep the archive within its quotas and shrink older clips in the background.
+
+    @param ArchiveIndex archive
+    @param float max_age Days to keep clips for, 0 to keep them forever
+    @param float max_size GB the archive may use, 0 for no limit
+    @param float min_free GB to keep free on the archive's disk
+    @param float compact_after Days after which clips are re-encoded smaller, 0 to never compact
+    @param int compact_batch Clips compacted per run at most
+    @param int compact_height
+    @param int compact_crf
+    @param float max_load Defer compaction while the load average per core is above this
+    @param float interval Seconds between runs
+    """
+    threading.Thread.__init__(self, daemon=True)
+
+    self.name = self.__class__.__name__
+    self.logger = logging.getLogger(self.name)
+
+    self.archive = archive
+    self.max_age = max_age * DAY
+    self.max_size = max_size * GB
+    self.min_free = min_free * GB
+    self.compact_after = compact_after * DAY
+    self.compact_batch = compact_batch
+    self.compact_height = compact_height
+    self.compact_crf = compact_crf
+    self.max_load = max_load
+    self.interval = interval
+
+    # Set to run before the interval is up, e.g. when a merge is about to need space
+    self.wakeup = threading.Event()
+
+  def run(self):
+    """Retention loop."""
+    while True:
+      try:
+        if self.enforce():
+          self.archive.write_listing()
+
+        if self.compact_after and self.compact():
+          self.archive.write_listing()
+      except Exception:
+        self.logger.exception('Retention run failed')
+
+      self.wakeup.wait(self.interval)
+      self.wakeup.clear()
+
+  def check(self):
+    """Run right away if the disk is getting full."""
+    if self.min_free and self.free_space() < 2 * self.min_free:
+      self.wakeup.set()
+
+  def free_space(self):
+    """
+    @return int Free bytes on the archive's disk
+    """
+    return shutil.disk_usage(self.archive.path).free
+
+  def path(self, name):
+    """
+    @param string name
+    @return string
+    """
+    return os.path.join(self.archive.path, '{}.mp4'.format(name))
+
+  def delete(self, name, size):
+    """
+    Remove a clip and its record.
+
+    @param string name
+    @param int size
+    """
+    try:
+      os.remove(self.path(name))
+    except FileNotFoundError:
+      pass
+
+    self.archive.remove(name)
+
+    metrics.counter('clips_removed').inc()
+    metrics.counter('bytes_reclaimed').inc(size or 0)
+
+  def enforce(self):
+    """
+    Delete the oldest clips until age, size and free space quotas are met.
+
+    @return int Number of clips removed
+    """
+    removed = 0
+
+    if self.max_age:
+      for name, _, size in self.archive.oldest(1000, before=time.time() - self.max_age):
+        self.delete(name, size)
+        removed += 1
+
+    total = self.archive.total_size()
+    shortfall = self.min_free - self.free_space() if self.min_free else 0
+
+    # Space taken by something else can't be made up for by wiping the archive
+    if shortfall > total:
+      self.logger.warning('Below {:.1f} GB free, but the archive only takes {:.1f} GB, leaving it alone'.format(
+        self.min_free / GB, total / GB))
+      shortfall = 0
+
+    while (self.max_size and total > self.max_size) or shortfall > 0:
+      oldest = self.archive.oldest(1)
+
+      if not oldest:
+        break
+
+      name, _, size = oldest[0]
+      self.delete(name, size)
+      total -= size or 0
+      shortfall -= size or 0
+      removed += 1
+
+    if removed:
+      self.logger.info('Removed {} clips, {:.1f} GB free'.format(removed, self.free_space() / GB))
+
+    return removed
+
+  def deferred(self):
+    """
+    @return string|None Why compaction should wait, None if it can go ahead
+    """
+    if self.max_load and os.getloadavg()[0] / (os.cpu_count() or 1) > self.max_load:
+      return 'load is {:.2f}'.format(os.getloadavg()[0])
+
+    return None
+
+  def compact(self):
+    """
+    Re-encode a batch of old clips, one at a time at lowest priority.
+
+    @return int Number of clips compacted
+    """
+    compacted = 0
+
+    for name, _, size in self.archive.oldest(self.compact_batch, before=time.time() - self.compact_after, compacted=False):
+      reason = self.deferred()
+
+      # Never fill the disk with a compacted copy
+      if not reason and self.free_space() - (size or 0) < self.min_free:
+        reason = 'disk is almost full'
+
+      if reason:
+        metrics.counter('compactions_deferred').inc()
+        self.logger.info('Deferring compaction, {}'.format(reason))
+        break
+
+      if self.compact_clip(name, size):
+        compacted += 1
+
+    return compacted
+
+  def compact_clip(self, name, size):
+    """
+    Replace a clip by a smaller re-encode if it actually is smaller.
+
+    @param string name
+    @param int size
+    @return bool
+    """
+    start = time.time()
+    source = self.path(name)
+    # Not named .mp4 so it's never mistaken for a clip
+    tmp = os.path.join(self.archive.path, '{}.compacting'.format(name))
+
+    result = subprocess.run(compact_command(source, tmp, self.compact_height, self.compact_crf),
+                            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    if result.returncode != 0:
+      metrics.counter('compaction_failures').inc()
+      self.logger.error('Compacting {} failed: {}'.format(name, result.stderr.decode(errors='replace').strip()))
+
+      if os.path.exists(tmp):
+        os.remove(tmp)
+
+      # Don't retry broken clips forever
+      self.archive.update(name, compacted=1)
+      return False
+
+    new_size = os.path.getsize(tmp)
+    metrics.histogram('compact').observe(time.time() - start)
+
+    # Already small enough
+    if size and new_size >= size:
+      os.remove(tmp)
+      self.archive.update(name, compacted=1)
+      return True
+
+    os.replace(tmp, source)
+    self.archive.update(name, compacted=1, size=new_size)
+
+    metrics.counter('bytes_reclaimed').inc((size or 0) - new_size)
+    self.logger.info('Compacted {} from {:.1f} to {:.1f} MB'.format(name, (size or 0) / 1024 ** 2, new_size / 1024 ** 2))
+
+    return True
@@ -0,0 +1,225 @@
+import threading
+import numpy as np
+
+
+class FrameRingBuffer:
+  def __init__(self, capacity, shape, dtype=np.uint8):
+    """
+    Keep the last {capacity} frames and their capture times in a single preallocated block.
+
+    @param int capacity Number of frames
+    @param tuple shape Shape of a single frame
+    @param dtype dtype
+    """
+    self.capacity = capacity
+    self.frames = np.zeros((capacity,) + tuple(shape), dtype)
+    self.timestamps = np.zeros(capacity)
+    self.index = 0
+    self.count = 0
+
+  @property
+  def nbytes(self):
+    return self.frames.nbytes
+
+  def __len__(self):
+    return self.count
+
+  def __iter__(self):
+    """Yield stored frames from oldest to newest (as views into the buffer)."""
+    for frame, _ in self.items():
+      yield frame
+
+  def items(self):
+    """Yield (frame, timestamp) pairs from oldest to newest."""
+    start = (self.index - self.count) % self.capacity if self.capacity else 0
+
+    for i in range(self.count):
+      index = (start + i) % self.capacity
+      yield self.frames[index], float(self.timestamps[index])
+
+  def append(self, frame, timestamp=0):
+    """
+    Copy frame into the buffer, overwriting the oldest one if full.
+
+    @param array frame
+    @param float timestamp Capture time
+    """
+    if not self.capacity:
+      return
+
+    np.copyto(self.frames[self.index], frame)
+    self.timestamps[self.index] = timestamp
+    self.index = (self.index + 1) % self.capacity
+    self.count = min(self.count + 1, self.capacity)
+
+  def resize(self, capacity):
+    """
+    Change the number of frames kept, keeping the newest ones.
+
+    @param int capacity
+    """
+    if capacity == self.capacity:
+      return
+
+    items = list(self.items())[max(0, self.count - capacity):]
+    frames = np.zeros((capacity,) + self.frames.shape[1:], self.frames.dtype)
+    timestamps = np.zeros(capacity)
+
+    for i, (frame, timestamp) in enumerate(items):
+      frames[i] = frame
+      timestamps[i] = timestamp
+
+    self.frames, self.timestamps, self.capacity = frames, timestamps, capacity
+    self.count = len(items)
+    self.index = self.count % capacity if capacity else 0
+
+  def clear(self):
+    """Forget all stored frames."""
+    self.index = 0
+    self.count = 0
+
+
+class ByteRingBuffer:
+  def __init__(self, capacity):
+    """
+    Keep the last {capacity} bytes in a single preallocated bytearray.
+
+    @param int capacity Number of bytes
+    """
+    self.capacity = capacity
+    self.buffer = bytearray(capacity)
+    self.view = memoryview(self.buffer)
+    self.index = 0
+    self.count = 0
+
+  @property
+  def nbytes(self):
+    return self.capacity
+
+  def __len__(self):
+    return self.count
+
+  def write(self, data):
+    """
+    Copy data into the buffer, overwriting the oldest bytes if full.
+
+    @param bytes data
+    """
+    if not self.capacity:
+      return
+
+    # Only the tail of data can survive anyway
+    data = memoryview(data)[-self.capacity:]
+    size = len(data)
+    first = min(size, self.capacity - self.index)
+
+    self.view[self.index:self.index + first] = data[:first]
+    self.view[:size - first] = data[first:]
+
+    self.index = (self.index + size) % self.capacity
+    self.count = min(self.count + size, self.capacity)
+
+  def read(self):
+    """
+    Return all stored bytes from oldest to newest.
+
+    @return bytes
+    """
+    start = (self.index - self.count) % self.capacity if self.capacity else 0
+    end = start + self.count
+
+    if end <= self.capacity:
+      return bytes(self.view[start:end])
+
+    return bytes(self.view[start:]) + bytes(self.view[:end - self.capacity])
+
+  def clear(self):
+    """Forget all stored bytes."""
+    self.index = 0
+    self.count = 0
+
+
+class AudioRingBuffer:
+  def __init__(self, capacity):
+    """
+    Single-producer single-consumer byte queue in a preallocated bytearray.
+    Producer and consumer each only advance their own counter, so no lock is needed.
+
+    @param int capacity Number of bytes
+    """
+    self.capacity = capacity
+    self.buffer = bytearray(capacity)
+    self.view = memoryview(self.buffer)
+
+    # Total bytes ever written and read, only ever increasing
+    self.written = 0
+    self.consumed = 0
+    self.event = threading.Event()
+
+  @property
+  def nbytes(self):
+    return self.capacity
+
+  def available(self):
+    """
+    @return int Bytes waiting to be read
+    """
+    return self.written - self.consumed
+
+  def write(self, data):
+    """
+    Append data. Never blocks.
+
+    @param bytes data
+    @return bool False if data didn't fit and was dropped
+    """
+    data = memoryview(data)
+    size = len(data)
+
+    if self.written - self.consumed + size > self.capacity:
+      return False
+
+    start = self.written % self.capacity
+    first = min(size, self.capacity - start)
+
+    self.view[start:start + first] = data[:first]
+    self.view[:size - first] = data[first:]
+
+    # Publish only after the data is in place
+    self.written += size
+    self.event.set()
+
+    return True
+
+  def read(self, size, timeout=None):
+    """
+    Block until {size} bytes are available and return them.
+
+    @param int size
+    @param float timeout
+    @return bytes Empty on timeout
+    """
+    if size > self.capacity:
+      raise ValueError("Can't read {} bytes from a {} byte buffer".format(size, self.capacity))
+
+    while self.available() < size:
+      self.event.clear()
+
+      # The producer may have written in between
+      if self.available() >= size:
+        break
+
+      if not self.event.wait(timeout):
+        return b''
+
+    start = self.consumed % self.capacity
+    end = start + size
+
+    if end <= self.capacity:
+      data = bytes(self.view[start:end])
+    else:
+      data = bytes(self.view[start:]) + bytes(self.view[:end - self.capacity])
+
+    self.consumed += size
+
+    return data
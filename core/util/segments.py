@@ -0,0 +1,260 @@
+import os
+import json
+import time
+import queue
+import logging
+import threading
+import subprocess
+from util.metrics import metrics
+from util.merger import Merger
+
+
+def concat_list(segments, start, end):
+  """
+  Describe a clip as a list for ffmpeg's concat demuxer.
+
+  @param list(dict) segments Segments overlapping the clip in order, each with path, start and end
+  @param float start
+  @param float end
+  @return string
+  """
+  lines = []
+
+  for segment in segments:
+    lines.append("file '{}'".format(segment['path']))
+
+    if start > segment['start']:
+      lines.append('inpoint {:.3f}'.format(start - segment['start']))
+
+    if end < segment['end']:
+      lines.append('outpoint {:.3f}'.format(end - segment['start']))
+
+  return '\n'.join(lines) + '\n'
+
+
+def cut_command(list_path, destination):
+  """
+  Build an ffmpeg invocation joining segments into an MP4 without re-encoding.
+
+  @param string list_path Concat list
+  @param string destination
+  @return list(string)
+  """
+  return ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y',
+          '-f', 'concat', '-safe', '0', '-i', list_path,
+          '-c', 'copy', '-bsf:a', 'aac_adtstoasc', '-movflags', '+faststart', destination]
+
+
+class SegmentStore:
+  def __init__(self, path, retention=3600, archive=None):
+    """
+    Rolling buffer of fixed-length MPEG-TS segments on disk.
+    Segments and detection events are appended to index.jsonl, clips are cut from the segments by stream copy.
+    Encoding, cutting and removing expired segments all happen on a background thread.
+
+    @param string path Folder holding segments and index
+    @param float retention Seconds to keep segments for
+    @param ArchiveIndex archive Index to add cut clips to
+    """
+    self.logger = logging.getLogger(self.__class__.__name__)
+
+    self.path = path
+    self.archive = archive
+    self.index_path = os.path.join(path, 'index.jsonl')
+    self.retention = retention
+
+    # Only used for merging, not for its threads
+    self.merger = Merger(workers=0)
+    self.lock = threading.Lock()
+
+    # Index records in order, segments still waiting to be encoded aren't included
+    self.segments = []
+    self.events = []
+    # Clips waiting for the segments they span to be encoded
+    self.pending = []
+
+    self.load()
+
+    self.queue = queue.Queue()
+    threading.Thread(target=self.work, name=self.__class__.__name__, daemon=True).start()
+
+  def load(self):
+    """Read the index, skipping segments that are gone."""
+    try:
+      with open(self.index_path, 'r') as f:
+        for line in f:
+          record = json.loads(line)
+
+          if 'segment' in record and os.path.exists(self.segment_path(record['segment'])):
+            self.segments.append(record)
+          elif 'event' in record:
+            self.events.append(record)
+    except FileNotFoundError:
+      pass
+
+    self.logger.info('{} segments, {} events indexed'.format(len(self.segments), len(self.events)))
+
+  def segment_path(self, name):
+    """
+    @param string name
+    @return string
+    """
+    return os.path.join(self.path, '{}.ts'.format(name))
+
+  def append(self, record):
+    """
+    Add a record to the index.
+
+    @param dict record
+    """
+    with self.lock:
+      with open(self.index_path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+  def add(self, name, source, start, end, finish=None):
+    """
+    Queue a recorded segment for encoding.
+
+    @param string name Recording name without extension
+    @param string source Folder containing the .avi and the audio recording, None if the segment is already encoded
+    @param float start Wall clock time the segment started
+    @param float end Wall clock time the segment ended
+    @param callable finish Finishes writing the recorded files, called on this store's thread before encoding
+    """
+    self.queue.put(('segment', {'segment': name, 'start': start, 'end': end}, source, finish))
+
+  def mark(self, name, start, end, sources, destination, levels=None, tracks=None):
+    """
+    Index a detection event and cut it into a clip as soon as its segments are encoded.
+
+    @param string name Clip name without extension
+    @param float start
+    @param float end
+    @param list(string) sources Detectors that triggered
+    @param string destination Folder to write the .mp4 to
+    @param dict levels Peak level per detector
+    @param list(dict) tracks Summaries of tracked objects
+    """
+    record = {'event': name, 'start': start, 'end': end, 'sources': sources, 'levels': levels or {}, 'tracks': tracks or []}
+    self.append(record)
+    self.queue.put(('event', record, destination, None))
+
+  def close(self):
+    """Wait for all queued segments and clips."""
+    self.queue.join()
+
+  def work(self):
+    """Worker loop."""
+    while True:
+      kind, record, folder, finish = self.queue.get()
+
+      try:
+        if finish:
+          finish()
+
+        if kind == 'segment':
+          self.encode(record, folder)
+        else:
+          self.events.append(record)
+          self.pending.append((record, folder))
+
+        self.cut_pending()
+        self.collect()
+      except Exception:
+        self.logger.exception('Handling {} {} failed'.format(kind, record[kind]))
+      finally:
+        self.queue.task_done()
+
+  def encode(self, record, source):
+    """
+    Turn a recorded video and audio pair into a segment.
+
+    @param dict record
+    @param string source
+    """
+    if source is None or self.merger.merge(record['segment'], source, self.path, 'ts'):
+      self.segments.append(record)
+      self.append(record)
+
+  def cut_pending(self):
+    """Cut all clips whose segments are complete."""
+    encoded_until = self.segments[-1]['end'] if self.segments else 0
+
+    for record, destination in list(self.pending):
+      if record['end'] <= encoded_until:
+        self.pending.remove((record, destination))
+        self.cut(record, destination)
+
+  def cut(self, record, destination):
+    """
+    Join the segments spanning an event into a clip.
+
+    @param dict record
+    @param string destination
+    @return bool
+    """
+    start = time.time()
+    segments = [dict(s, path=self.segment_path(s['segment'])) for s in self.segments
+                if s['end'] > record['start'] and s['start'] < record['end']]
+
+    if not segments:
+      self.logger.warning('No segments for {}'.format(record['event']))
+      return False
+
+    list_path = os.path.join(self.path, '{}.txt'.format(record['event']))
+
+    with open(list_path, 'w') as f:
+      f.write(concat_list(segments, record['start'], record['end']))
+
+    output = os.path.join(destination, '{}.mp4'.format(record['event']))
+    result = subprocess.run(cut_command(list_path, output), stdin=subprocess.DEVNULL,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    os.remove(list_path)
+
+    if result.returncode != 0:
+      metrics.counter('cut_failures').inc()
+      self.logger.error('ffmpeg failed for {}: {}'.format(record['event'], result.stderr.decode(errors='replace').strip()))
+      return False
+
+    duration = time.time() - start
+    metrics.histogram('clip_cut').observe(duration)
+    self.logger.info('Cut {} from {} segments in {:.2f}s'.format(record['event'], len(segments), duration))
+
+    if self.archive:
+      self.archive.add(output, started=record['start'], sources=record['sources'], levels=record.get('levels'),
+                       tracks=record.get('tracks'))
+
+    return True
+
+  def collect(self):
+    """Remove segments past retention that no pending clip needs and compact the index."""
+    cutoff = time.time() - self.retention
+
+    if self.pending:
+      cutoff = min(cutoff, min(record['start'] for record, _ in self.pending))
+
+    expired = [s for s in self.segments if s['end'] < cutoff]
+
+    if not expired:
+      return
+
+    for segment in expired:
+      try:
+        os.remove(self.segment_path(segment['segment']))
+      except FileNotFoundError:
+        pass
+
+    metrics.counter('segments_removed').inc(len(expired))
+
+    self.segments = [s for s in self.segments if s['end'] >= cutoff]
+    self.events = [e for e in self.events if e['end'] >= cutoff]
+
+    # Rewrite the index to what's left, to a temporary file first so a crash can't truncate it
+    with self.lock:
+      tmp = '{}.tmp'.format(self.index_path)
+
+      with open(tmp, 'w') as f:
+        for record in sorted(self.segments + self.events, key=lambda r: r['start']):
+          f.write(json.dumps(record) + '\n')
+
+      os.replace(tmp, self.index_path)
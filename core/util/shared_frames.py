@@ -0,0 +1,199 @@
+import time
+import logging
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+
+
+class SharedFrameRing:
+  def __init__(self, shape, slots=8, name=None, create=False):
+    """
+    Fixed number of frame slots in shared memory.
+    The header holds the latest sequence number followed by the sequence number of every slot,
+    then the capture time of every slot.
+
+    @param tuple shape Shape of a single frame
+    @param int slots Number of frames kept
+    @param string name Name of existing shared memory to attach to
+    @param bool create Whether to create the shared memory
+    """
+    self.shape = tuple(shape)
+    self.slots = slots
+
+    sequences_size = (slots + 1) * np.dtype(np.int64).itemsize
+    header_size = sequences_size + slots * np.dtype(np.float64).itemsize
+    frame_size = int(np.prod(self.shape))
+
+    self.shm = shared_memory.SharedMemory(name=name, create=create, size=header_size + slots * frame_size)
+    self.name = self.shm.name
+
+    self.header = np.ndarray((slots + 1,), np.int64, buffer=self.shm.buf)
+    self.timestamps = np.ndarray((slots,), np.float64, buffer=self.shm.buf, offset=sequences_size)
+    self.frames = np.ndarray((slots,) + self.shape, np.uint8, buffer=self.shm.buf, offset=header_size)
+
+    if create:
+      self.header[:] = 0
+      self.timestamps[:] = 0
+
+  @property
+  def sequence(self):
+    return int(self.header[0])
+
+  def write(self, frame, timestamp=0):
+    """
+    Copy frame into the next slot.
+
+    @param array frame
+    @param float timestamp Capture time
+    @return int Sequence number of the frame
+    """
+    sequence = self.sequence + 1
+    slot = sequence % self.slots
+
+    # Mark slot as being written
+    self.header[slot + 1] = -1
+    np.copyto(self.frames[slot], frame)
+    self.timestamps[slot] = timestamp
+    self.header[slot + 1] = sequence
+    self.header[0] = sequence
+
+    return sequence
+
+  def read(self, sequence):
+    """
+    Return the frame with the given sequence number without copying.
+    The view stays valid until the writer wraps around the ring.
+
+    @param int sequence
+    @return tuple(array, float)|None Frame and capture time, None if the frame was already overwritten
+    """
+    slot = sequence % self.slots
+
+    if self.header[slot + 1] != sequence:
+      return None
+
+    return self.frames[slot], float(self.timestamps[slot])
+
+  def close(self, unlink=False):
+    """
+    Detach from shared memory.
+
+    @param bool unlink Also free it (owner only)
+    """
+    # Views into the buffer must be gone before closing
+    del self.header, self.timestamps, self.frames
+    self.shm.close()
+
+    if unlink:
+      self.shm.unlink()
+
+
+class SharedFrameSource:
+  # Frames returned by read() are views into shared memory
+  zero_copy = True
+
+  def __init__(self, name, shape, slots, condition):
+    """
+    Camera-like source reading the newest frame from a SharedFrameRing.
+    Attaches lazily so it can be handed to another process.
+
+    @param string name
+    @param tuple shape
+    @param int slots
+    @param multiprocessing.Condition condition Notified on every new frame
+    """
+    self.name = name
+    self.shape = shape
+    self.slots = slots
+    self.condition = condition
+    self.ring = None
+    self.last = 0
+    # Capture time of the last frame read
+    self.timestamp = None
+
+  def read(self, timeout=5):
+    """
+    Wait for the next frame, same interface as cv2.VideoCapture.read().
+
+    @param float timeout
+    @return tuple(bool, array)
+    """
+    if self.ring is None:
+      self.ring = SharedFrameRing(self.shape, self.slots, name=self.name)
+
+    while True:
+      with self.condition:
+        if not self.condition.wait_for(lambda: self.ring.sequence > self.last, timeout):
+          return False, None
+
+      # Skip ahead if we fell behind
+      self.last = self.ring.sequence
+      slot = self.ring.read(self.last)
+
+      if slot is not None:
+        frame, self.timestamp = slot
+        return True, frame
+
+  def release(self):
+    """Detach from shared memory."""
+    if self.ring:
+      self.ring.close()
+      self.ring = None
+
+
+class CaptureProcess(multiprocessing.Process):
+  def __init__(self, open_camera, slots=8):
+    """
+    Own the camera in a separate process and publish frames into shared memory.
+
+    @param callable open_camera Returns a cv2.VideoCapture
+    @param int slots
+    """
+    multiprocessing.Process.__init__(self, daemon=True)
+
+    self.name = self.__class__.__name__
+    self.open_camera = open_camera
+    self.slots = slots
+    self.condition = multiprocessing.Condition()
+    self.ready = multiprocessing.Queue()
+
+  def source(self):
+    """
+    Wait for the camera to be ready.
+
+    @return SharedFrameSource
+    """
+    name, shape = self.ready.get()
+
+    return SharedFrameSource(name, shape, self.slots, self.condition)
+
+  def run(self):
+    """Capture loop."""
+    logger = logging.getLogger(self.name)
+    camera = self.open_camera()
+    grabbed, frame = camera.read()
+    captured = time.monotonic()
+
+    if not grabbed:
+      logger.error('Could not read from camera.')
+      return
+
+    ring = SharedFrameRing(frame.shape, self.slots, create=True)
+    self.ready.put((ring.name, frame.shape))
+
+    try:
+      while grabbed:
+        ring.write(frame, captured)
+
+        with self.condition:
+          self.condition.notify_all()
+
+        grabbed, frame = camera.read()
+        captured = time.monotonic()
+
+      logger.info('End of camera feed.')
+    except KeyboardInterrupt:
+      pass
+    finally:
+      camera.release()
+      ring.close(unlink=True)
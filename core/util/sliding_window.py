@@ -0,0 +1,112 @@
+import time
+import numpy as np
+
+
+class SlidingWindow:
+  def __init__(self, size, threshold):
+    """
+    Keep the last {size} values in a numpy ring array and maintain aggregates incrementally.
+    Appending is O(1) no matter how large the window is.
+
+    @param int size Number of values to keep
+    @param float threshold
+    """
+    self.size = max(1, int(size))
+    self.threshold = threshold
+
+    self.values = np.zeros(self.size, np.float64)
+    self.above = np.zeros(self.size, np.bool_)
+    self.index = 0
+    self.count = 0
+
+    # Number of values above threshold
+    self.exceeded = 0
+    self.total = 0.0
+    self.last_exceeded = None
+
+  def __len__(self):
+    return self.count
+
+  def append(self, value, timestamp=None):
+    """
+    Add a value, dropping the oldest one if the window is full.
+
+    @param float value
+    @param float timestamp Defaults to now
+    """
+    i = self.index
+    above = value > self.threshold
+
+    if self.count == self.size:
+      self.total -= self.values[i]
+      self.exceeded -= self.above[i]
+    else:
+      self.count += 1
+
+    self.values[i] = value
+    self.above[i] = above
+    self.total += value
+    self.exceeded += above
+
+    if above:
+      self.last_exceeded = time.time() if timestamp is None else timestamp
+
+    self.index = (i + 1) % self.size
+
+    # Re-sync the running sum once per lap so float errors can't accumulate
+    if self.index == 0:
+      self.total = float(self.values.sum())
+
+  def set_threshold(self, threshold):
+    """
+    Change the threshold and recount values above it.
+
+    @param float threshold
+    """
+    self.threshold = threshold
+    np.greater(self.values, threshold, out=self.above)
+    self.above[self.count:] = False
+    self.exceeded = int(self.above.sum())
+
+  def mean(self):
+    """
+    @return float
+    """
+    return self.total / self.count if self.count else 0.0
+
+  def max(self):
+    """
+    Vectorized, only computed when asked for.
+
+    @return float
+    """
+    return float(self.values[:self.count].max()) if self.count else 0.0
+
+  def resize(self, size):
+    """
+    Change the number of values kept, keeping the newest ones.
+
+    @param int size
+    """
+    size = max(1, int(size))
+    values = self.values[(self.index - self.count + np.arange(self.count)) % self.size][-size:]
+
+    self.size = size
+    self.values = np.zeros(size, np.float64)
+    self.above = np.zeros(size, np.bool_)
+    self.count = len(values)
+    self.index = self.count % size
+
+    self.values[:self.count] = values
+    np.greater(values, self.threshold, out=self.above[:self.count])
+    self.exceeded = int(self.above.sum())
+    self.total = float(values.sum())
+
+  def clear(self):
+    """Forget all values."""
+    self.index = 0
+    self.count = 0
+    self.exceeded = 0
+    self.total = 0.0
+    self.above[:] = False
+    self.last_exceeded = None
@@ -0,0 +1,353 @@
+import time
+import wave
+import threading
+from util.ring_buffer import AudioRingBuffer
+from util.metrics import metrics
+
+
+class VideoFileSource:
+  def __init__(self, path, realtime=False):
+    """
+    Camera-like source replaying a video file.
+
+    @param string path
+    @param bool realtime Pace frames at the file's frame rate instead of reading as fast as possible
+    """
+    import cv2
+
+    self.capture = cv2.VideoCapture(path)
+
+    if not self.capture.isOpened():
+      raise IOError("Could not open video: {}".format(path))
+
+    self.fps = int(round(self.capture.get(cv2.CAP_PROP_FPS))) or 30
+    self.realtime = realtime
+    self.frames = 0
+    self.started = None
+    # Capture time of the last frame read, media time unless replaying in real time
+    self.timestamp = None
+
+  @property
+  def position(self):
+    """Seconds of video read so far."""
+    return self.frames / self.fps
+
+  def pace(self):
+    """Wait for the next frame if replaying in real time and stamp it."""
+    self.timestamp = self.position
+
+    if self.realtime:
+      if self.started is None:
+        self.started = time.monotonic()
+
+      time.sleep(max(0, self.started + self.position - time.monotonic()))
+      self.timestamp += self.started
+
+  def read(self):
+    """
+    Same interface as cv2.VideoCapture.read().
+
+    @return tuple(bool, array)
+    """
+    self.pace()
+
+    grabbed, frame = self.capture.read()
+
+    if grabbed:
+      self.frames += 1
+
+    return grabbed, frame
+
+  def grab(self):
+    """
+    Advance without decoding, same interface as cv2.VideoCapture.grab().
+
+    @return bool
+    """
+    self.pace()
+
+    grabbed = self.capture.grab()
+
+    if grabbed:
+      self.frames += 1
+
+    return grabbed
+
+  def release(self):
+    self.capture.release()
+
+
+class MicrophoneSource:
+  def __init__(self, device, rate, channels, chunk_size):
+    """
+    Read 16 bit PCM from a PyAudio input device.
+
+    @param int device
+    @param int rate
+    @param int channels
+    @param int chunk_size
+    """
+    import pyaudio
+
+    self.rate = rate
+    self.channels = channels
+    # Capture time of the first frame of the last read
+    self.timestamp = None
+
+    self.audio = pyaudio.PyAudio()
+    self.stream = self.audio.open(
+      format=pyaudio.paInt16,
+      channels=channels,
+      rate=rate,
+      input=True,
+      input_device_index=device,
+      frames_per_buffer=chunk_size
+    )
+
+  def read(self, num_frames):
+    """
+    Block until {num_frames} frames are available.
+
+    @param int num_frames
+    @return bytes
+    """
+    data = self.stream.read(num_frames, exception_on_overflow=False)
+
+    # The last frame was captured just now
+    self.timestamp = time.monotonic() - len(data) / (2 * self.channels) / self.rate
+
+    return data
+
+  def close(self):
+    self.stream.close()
+    self.audio.terminate()
+
+
+class CallbackMicrophoneSource:
+  def __init__(self, device, rate, channels, chunk_size, buffer_seconds=5):
+    """
+    Capture 16 bit PCM with PyAudio's callback API into a ring buffer.
+    Capture keeps going even while the consumer is busy, and lost samples are counted instead of silently skipped.
+
+    @param int device
+    @param int rate
+    @param int channels
+    @param int chunk_size
+    @param float buffer_seconds How far the consumer may fall behind
+    """
+    import pyaudio
+
+    self.pyaudio = pyaudio
+    self.rate = rate
+    self.channels = channels
+    self.frame_bytes = 2 * channels
+
+    self.ring = AudioRingBuffer(int(buffer_seconds * rate) * self.frame_bytes)
+    # Capture time at which the next callback's first frame is expected
+    self.expected = None
+
+    # Gaps are padded, so capture times follow from the number of frames
+    self.started = None
+    self.frames = 0
+    self.timestamp = None
+
+    self.audio = pyaudio.PyAudio()
+    self.stream = self.audio.open(
+      format=pyaudio.paInt16,
+      channels=channels,
+      rate=rate,
+      input=True,
+      input_device_index=device,
+      frames_per_buffer=chunk_size,
+      stream_callback=self.callback
+    )
+
+  def callback(self, in_data, frame_count, time_info, status):
+    """Called by PortAudio for every captured buffer."""
+    if self.started is None:
+      self.started = time.monotonic() - frame_count / self.rate
+
+    if status & self.pyaudio.paInputOverflow:
+      metrics.counter('audio_overruns').inc()
+
+    # Fill samples lost by the device with silence to keep duration in sync with the clock
+    captured = time_info.get('input_buffer_adc_time', 0)
+
+    if captured and self.expected is not None:
+      missing = int(round((captured - self.expected) * self.rate))
+
+      if missing > frame_count // 2:
+        metrics.counter('audio_gap_frames').inc(missing)
+        self.write(bytes(min(missing * self.frame_bytes, self.ring.capacity // 2)))
+
+    self.expected = captured + frame_count / self.rate if captured else None
+    self.write(in_data)
+
+    return None, self.pyaudio.paContinue
+
+  def write(self, data):
+    """
+    @param bytes data
+    """
+    if not self.ring.write(data):
+      metrics.counter('audio_ring_overruns').inc()
+
+  def read(self, num_frames):
+    """
+    Block until {num_frames} frames were captured.
+
+    @param int num_frames
+    @return bytes
+    """
+    data = self.ring.read(num_frames * self.frame_bytes)
+    self.timestamp = self.started + self.frames / self.rate
+    self.frames += len(data) // self.frame_bytes
+
+    return data
+
+  def close(self):
+    self.stream.stop_stream()
+    self.stream.close()
+    self.audio.terminate()
+
+
+class WavFileSource:
+  def __init__(self, path, realtime=False):
+    """
+    Replay a 16 bit PCM WAV file.
+
+    @param string path
+    @param bool realtime Pace reads like a microphone would instead of returning immediately
+    """
+    self.wav = wave.open(path, 'rb')
+
+    if self.wav.getsampwidth() != 2:
+      raise ValueError("Only 16 bit WAV files are supported: {}".format(path))
+
+    self.rate = self.wav.getframerate()
+    self.channels = self.wav.getnchannels()
+    self.realtime = realtime
+    self.frames = 0
+    self.started = None
+    # Capture time of the first frame of the last read, media time unless replaying in real time
+    self.timestamp = None
+
+  @property
+  def position(self):
+    """Seconds of audio read so far."""
+    return self.frames / self.rate
+
+  def read(self, num_frames):
+    """
+    @param int num_frames
+    @return bytes Empty at the end of the file
+    """
+    self.timestamp = self.position
+    data = self.wav.readframes(num_frames)
+    self.frames += len(data) // (2 * self.channels)
+
+    if self.realtime:
+      if self.started is None:
+        self.started = time.monotonic()
+
+      time.sleep(max(0, self.started + self.position - time.monotonic()))
+      self.timestamp += self.started
+
+    return data
+
+  def close(self):
+    self.wav.close()
+
+
+class GPIOSource:
+  def __init__(self, pin):
+    """
+    Digital input on a Raspberry Pi GPIO pin (BCM numbering).
+
+    @param int pin
+    """
+    import RPi.GPIO as GPIO
+
+    self.GPIO = GPIO
+    self.pin = pin
+
+    GPIO.setmode(GPIO.BCM)
+    GPIO.setup(pin, GPIO.IN)
+
+  def input(self):
+    """
+    @return bool
+    """
+    return bool(self.GPIO.input(self.pin))
+
+  def watch(self, callback):
+    """
+    Call callback(pin) on every edge.
+
+    @param callable callback
+    """
+    self.GPIO.add_event_detect(self.pin, self.GPIO.BOTH, callback=callback)
+
+  def close(self):
+    self.GPIO.cleanup()
+
+
+class ScriptedGPIOSource:
+  def __init__(self, timeline, speed=1.0):
+    """
+    Replay a timeline of input changes as if they came from a GPIO pin.
+
+    @param list(tuple(float, bool)) timeline (seconds from start, state) pairs
+    @param float speed Values above 1 replay faster than real time
+    """
+    self.timeline = sorted(timeline)
+    self.speed = speed
+    self.pin = 0
+    self.state = False
+    self.done = threading.Event()
+
+  @classmethod
+  def parse(cls, spec, speed=1.0):
+    """
+    Build from a string like "0:0,2.5:1,5:0".
+
+    @param string spec
+    @param float speed
+    @return ScriptedGPIOSource
+    """
+    timeline = []
+
+    for event in spec.split(','):
+      at, state = event.split(':')
+      timeline.append((float(at), bool(int(state))))
+
+    return cls(timeline, speed)
+
+  def input(self):
+    """
+    @return bool
+    """
+    return self.state
+
+  def watch(self, callback):
+    """
+    Start replaying, calling callback(pin) on every change.
+
+    @param callable callback
+    """
+    def replay():
+      start = time.time()
+
+      for at, state in self.timeline:
+        time.sleep(max(0, start + at / self.speed - time.time()))
+
+        if state != self.state:
+          self.state = state
+          callback(self.pin)
+
+      self.done.set()
+
+    threading.Thread(target=replay, name=self.__class__.__name__, daemon=True).start()
+
+  def close(self):
+    pass
@@ -0,0 +1,60 @@
+import yaml
+
+KINDS = ('cameras', 'microphones', 'sensors')
+
+
+def load_topology(path):
+  """
+  Read the devices and zones of a multi-camera setup.
+  Cameras and microphones record for the one zone listing them, sensors may be shared between zones.
+
+  @param string path
+  @return dict|None cameras, microphones and sensors by name and zones, None if there is no such file
+  """
+  try:
+    with open(path, 'r') as f:
+      topology = yaml.safe_load(f.read()) or {}
+  except FileNotFoundError:
+    return None
+
+  for kind in KINDS:
+    topology[kind] = topology.get(kind) or {}
+
+  zones = topology.get('zones') or {}
+  owners = {}
+
+  for zone, devices in zones.items():
+    devices = zones[zone] = devices or {}
+
+    for kind in KINDS:
+      devices[kind] = devices.get(kind) or []
+
+      for device in devices[kind]:
+        if device not in topology[kind]:
+          raise ValueError("Zone {} uses unknown {} '{}'".format(zone, kind[:-1], device))
+
+        if kind != 'sensors' and (kind, device) in owners:
+          raise ValueError("{} '{}' is in zones {} and {}".format(kind[:-1], device, owners[(kind, device)], zone))
+
+        owners[(kind, device)] = zone
+
+  topology['zones'] = zones
+
+  return topology
+
+
+def worker_name(kind, device):
+  """
+  @param string kind Worker class name, e.g. MotionDetector
+  @param string device Device name from the topology
+  @return string e.g. MotionDetector.front
+  """
+  return '{}.{}'.format(kind, device)
+
+
+def worker_kind(name):
+  """
+  @param string name Worker name, with or without device
+  @return string Worker class name
+  """
+  return name.split('.')[0]
@@ -0,0 +1,158 @@
+import numpy as np
+import cv2
+
+
+def find_targets(mask, scale=1.0, min_area=500):
+  """
+  Find moving objects in a motion mask.
+
+  @param array mask Binary motion mask, possibly downscaled
+  @param float scale Factor the mask was downscaled by
+  @param float min_area Smallest object at full resolution in pixels
+  @return tuple(list, array) Contours at mask resolution and their targets at full resolution as rows of (x, y, area)
+  """
+  contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+  kept = []
+  targets = []
+
+  for c in contours:
+    area = cv2.contourArea(c) / scale ** 2
+
+    # If the contour is too small, ignore it
+    if area < min_area:
+      continue
+
+    x, y, w, h = cv2.boundingRect(c)
+    kept.append(c)
+    targets.append(((x + w / 2) / scale, (y + h / 2) / scale, area))
+
+  return kept, np.array(targets, np.float32).reshape(-1, 3)
+
+
+class Tracker:
+  def __init__(self, max_distance=80, max_missed=5, min_frames=5, min_travel=30):
+    """
+    Follow targets from frame to frame by matching each track with its closest target.
+    Tracks count as real once they persisted for {min_frames} and moved {min_travel} from where they appeared,
+    flickering leaves, noise and lighting blobs rarely do both.
+
+    @param float max_distance Pixels a target may move between frames and still be matched
+    @param int max_missed Frames a track survives without a match
+    @param int min_frames
+    @param float min_travel Pixels
+    """
+    self.max_distance = max_distance
+    self.max_missed = max_missed
+    self.min_frames = min_frames
+    self.min_travel = min_travel
+
+    self.next_id = 0
+    # One row per track
+    self.ids = np.empty(0, np.int64)
+    self.positions = np.empty((0, 2), np.float32)
+    self.origins = np.empty((0, 2), np.float32)
+    self.travel = np.empty(0, np.float32)
+    self.frames = np.empty(0, np.int32)
+    self.missed = np.empty(0, np.int32)
+    self.areas = np.empty(0, np.float32)
+    self.started = np.empty(0, np.float64)
+
+    # Summaries of confirmed tracks since the last take_summaries()
+    self.summaries = {}
+    # Time a confirmed track was last seen
+    self.last_confirmed = None
+
+  def update(self, targets, timestamp):
+    """
+    Match the targets of a frame with the tracks.
+
+    @param array targets Rows of (x, y, area)
+    @param float timestamp
+    @return int Number of confirmed tracks seen in this frame
+    """
+    points = targets[:, :2]
+    matched_tracks = np.zeros(len(self.ids), np.bool_)
+    matched_targets = np.zeros(len(targets), np.bool_)
+
+    if len(self.ids) and len(targets):
+      distances = np.linalg.norm(self.positions[:, None, :] - points[None, :, :], axis=2)
+
+      # Closest pairs first, each track and target is matched at most once
+      for flat in np.argsort(distances, axis=None):
+        track, target = divmod(int(flat), len(targets))
+
+        if distances[track, target] > self.max_distance:
+          break
+
+        if matched_tracks[track] or matched_targets[target]:
+          continue
+
+        matched_tracks[track] = matched_targets[target] = True
+        self.positions[track] = points[target]
+        self.areas[track] = max(self.areas[track], targets[target, 2])
+
+    self.frames[matched_tracks] += 1
+    self.missed[matched_tracks] = 0
+    self.missed[~matched_tracks] += 1
+    self.travel = np.maximum(self.travel, np.linalg.norm(self.positions - self.origins, axis=1))
+
+    confirmed = matched_tracks & (self.frames >= self.min_frames) & (self.travel >= self.min_travel)
+
+    for i in np.flatnonzero(confirmed):
+      self.summaries[int(self.ids[i])] = self.summary(i, timestamp)
+
+    if confirmed.any():
+      self.last_confirmed = timestamp
+
+    # Forget lost tracks, start new ones for unmatched targets
+    keep = self.missed <= self.max_missed
+    new = points[~matched_targets]
+    count = len(new)
+
+    self.ids = np.concatenate([self.ids[keep], np.arange(self.next_id, self.next_id + count)])
+    self.positions = np.concatenate([self.positions[keep], new])
+    self.origins = np.concatenate([self.origins[keep], new])
+    self.travel = np.concatenate([self.travel[keep], np.zeros(count, np.float32)])
+    self.frames = np.concatenate([self.frames[keep], np.ones(count, np.int32)])
+    self.missed = np.concatenate([self.missed[keep], np.zeros(count, np.int32)])
+    self.areas = np.concatenate([self.areas[keep], targets[~matched_targets, 2]])
+    self.started = np.concatenate([self.started[keep], np.full(count, timestamp)])
+    self.next_id += count
+
+    return int(confirmed.sum())
+
+  def summary(self, i, timestamp):
+    """
+    @param int i Track row
+    @param float timestamp
+    @return dict
+    """
+    return {
+      'id': int(self.ids[i]),
+      'start': [round(float(v)) for v in self.origins[i]],
+      'end': [round(float(v)) for v in self.positions[i]],
+      'travel': round(float(self.travel[i])),
+      'max_area': round(float(self.areas[i])),
+      'frames': int(self.frames[i]),
+      'duration': round(timestamp - float(self.started[i]), 2),
+    }
+
+  def take_summaries(self):
+    """
+    Return summaries of all tracks confirmed since the last call.
+
+    @return list(dict)
+    """
+    # Swapped in one statement, the capture thread may add a summary at any time
+    summaries, self.summaries = self.summaries, {}
+
+    return sorted(summaries.values(), key=lambda s: s['id'])
+
+  def summarize(self):
+    """
+    Return summaries of all tracks confirmed since the last take_summaries(), keeping them.
+
+    @return list(dict)
+    """
+    return sorted(self.summaries.values(), key=lambda s: s['id'])
@@ -0,0 +1,175 @@
+from util.metrics import metrics
+from util.topology import worker_kind
+
+IDLE = 'idle'
+ARMED = 'armed'
+RECORDING = 'recording'
+COOLDOWN = 'cooldown'
+
+START = 'start'
+STOP = 'stop'
+
+
+def parse_hold_times(value):
+  """
+  @param string value e.g. PIRDetector:3,NoiseDetector:1
+  @return dict Seconds per detector
+  """
+  hold = {}
+
+  for item in filter(None, (v.strip() for v in (value or '').split(','))):
+    name, seconds = item.split(':')
+    hold[name.strip()] = float(seconds)
+
+  return hold
+
+
+class Trigger:
+  def __init__(self, hold=None, default_hold=0, arm_time=0, cooldown=0, min_length=0, max_length=0):
+    """
+    Recording state machine: idle -> armed -> recording -> cooldown -> idle.
+    A detector counts as active until its hold time after it cleared.
+    Detections during cooldown continue the current recording instead of starting a new one.
+    Nothing here sleeps, step() is called whenever events arrive or the deadline() has passed.
+
+    @param dict hold Seconds a detector stays active after it cleared, per detector or kind of detector
+    @param float default_hold Hold time of detectors not in {hold}
+    @param float arm_time Seconds a detection has to last before recording starts
+    @param float cooldown Seconds to keep recording after all detectors are clear
+    @param float min_length Seconds a recording lasts at least
+    @param float max_length Seconds after which a recording is split, 0 to never split
+    """
+    self.hold = hold or {}
+    self.default_hold = default_hold
+    self.arm_time = arm_time
+    self.cooldown = cooldown
+    self.min_length = min_length
+    self.max_length = max_length
+
+    self.state = IDLE
+    self.active = set()
+    # Time each inactive detector cleared
+    self.released = {}
+    # Detectors that were active during the current recording
+    self.triggered = set()
+    self.last_source = None
+
+    self.armed_at = None
+    self.started = None
+    self.cooling_since = None
+
+  def event(self, source, detected, timestamp):
+    """
+    Apply a detection state change.
+
+    @param string source
+    @param bool detected
+    @param float timestamp
+    """
+    if detected:
+      self.active.add(source)
+      self.released.pop(source, None)
+      self.triggered.add(source)
+      self.last_source = source
+    else:
+      self.active.discard(source)
+      self.released[source] = timestamp
+
+  def hold_time(self, source):
+    """
+    @param string source
+    @return float
+    """
+    return self.hold.get(source, self.hold.get(worker_kind(source), self.default_hold))
+
+  def holding(self, now):
+    """
+    @param float now
+    @return set(string) Detectors active or within their hold time
+    """
+    held = {s for s, at in self.released.items() if at + self.hold_time(s) > now}
+
+    return self.active | held
+
+  def step(self, now):
+    """
+    Advance the state machine.
+
+    @param float now
+    @return list(string) Actions to take in order, START and STOP
+    """
+    actions = []
+    holding = self.holding(now)
+
+    # Forget detectors whose hold time is over
+    for source in [s for s in self.released if s not in holding]:
+      del self.released[source]
+
+    if self.state == IDLE and holding:
+      self.state = ARMED
+      self.armed_at = now
+
+    if self.state == ARMED:
+      if not holding:
+        self.state = IDLE
+      elif now >= self.armed_at + self.arm_time:
+        self.state = RECORDING
+        self.begin(now, holding)
+        actions.append(START)
+
+    if self.state == RECORDING:
+      if self.max_length and now >= self.started + self.max_length:
+        # Split overlong recordings, the next part starts right away if still detected
+        actions.append(STOP)
+        self.state = IDLE
+
+        if holding:
+          self.state = RECORDING
+          self.begin(now, holding)
+          actions.append(START)
+      elif not holding:
+        self.state = COOLDOWN
+        self.cooling_since = now
+
+    if self.state == COOLDOWN:
+      if holding:
+        # Back-to-back event, keep going
+        self.state = RECORDING
+        metrics.counter('events_merged').inc()
+      elif now >= self.cooldown_until():
+        self.state = IDLE
+        actions.append(STOP)
+
+    return actions
+
+  def begin(self, now, holding):
+    """
+    @param float now
+    @param set(string) holding
+    """
+    self.started = now
+    self.triggered = set(holding)
+
+  def cooldown_until(self):
+    """
+    @return float
+    """
+    return max(self.cooling_since + self.cooldown, self.started + self.min_length)
+
+  def deadline(self):
+    """
+    @return float|None When step() has to be called even without events, None if only events matter
+    """
+    deadlines = []
+
+    if self.state in (ARMED, RECORDING):
+      deadlines += [at + self.hold_time(s) for s, at in self.released.items()]
+
+    if self.state == ARMED:
+      deadlines.append(self.armed_at + self.arm_time)
+    elif self.state == RECORDING and self.max_length:
+      deadlines.append(self.started + self.max_length)
+    elif self.state == COOLDOWN:
+      deadlines.append(self.cooldown_until())
+
+    return min(deadlines) if deadlines else None
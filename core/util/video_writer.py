@@ -0,0 +1,169 @@
+import queue
+import logging
+import threading
+import cv2
+from util.metrics import metrics
+
+DROP_NEWEST = 'newest'
+DROP_OLDEST = 'oldest'
+BLOCK = 'block'
+
+
+class VideoWriter(threading.Thread):
+  def __init__(self, path, codec, fps, size, queue_size=60, drop_policy=DROP_NEWEST, pre_roll=None):
+    """
+    Encode frames to disk on a dedicated thread as they arrive.
+    Frames are handed over through a bounded queue, so memory stays flat however long the recording runs.
+    Output has a constant frame rate: frames are placed by capture time, repeating or skipping frames where the camera deviates from {fps}.
+
+    @param string path
+    @param int codec FourCC
+    @param int fps
+    @param tuple(int, int) size (width, height)
+    @param int queue_size Maximum number of frames waiting to be encoded
+    @param string drop_policy What to do if the queue is full: 'newest' drops the incoming frame, 'oldest' drops the longest waiting one, 'block' waits for the encoder
+    @param FrameRingBuffer pre_roll Frames to encode ahead of the queued ones, cleared afterwards
+    """
+    threading.Thread.__init__(self, daemon=True)
+
+    if drop_policy not in (DROP_NEWEST, DROP_OLDEST, BLOCK):
+      raise ValueError("Unknown drop policy: {}".format(drop_policy))
+
+    self.name = self.__class__.__name__
+    self.logger = logging.getLogger(self.name)
+
+    self.path = path
+    self.pre_roll = pre_roll
+    self.drop_policy = drop_policy
+    self.queue = queue.Queue(maxsize=queue_size)
+    self.writer = cv2.VideoWriter(path, codec, fps, size)
+
+    self.fps = fps
+    # Capture time of the first encoded frame
+    self.start_time = None
+    # Number of frames in the output file
+    self.slots = 0
+    self.last = None
+
+    # Set once the pre-roll buffer was encoded and may be filled again
+    self.pre_rolled_event = threading.Event()
+
+    self.closed = False
+    self.received = 0
+    self.written = 0
+    self.dropped = 0
+    self.pre_rolled = 0
+    self.repeated = 0
+    self.skipped = 0
+
+  def write(self, frame, timestamp=None):
+    """
+    Queue a frame for encoding.
+
+    @param array frame
+    @param float timestamp Capture time, None to append at the next slot
+    @return bool Whether the frame was queued
+    """
+    if self.closed:
+      return False
+
+    self.received += 1
+    item = (frame, timestamp)
+
+    if self.drop_policy == BLOCK:
+      self.queue.put(item)
+      return True
+
+    try:
+      self.queue.put_nowait(item)
+      return True
+    except queue.Full:
+      pass
+
+    self.dropped += 1
+    metrics.counter('frames_dropped').inc()
+
+    if self.drop_policy == DROP_NEWEST:
+      return False
+
+    # Make room by discarding the longest waiting frame
+    try:
+      self.queue.get_nowait()
+    except queue.Empty:
+      pass
+
+    self.queue.put_nowait(item)
+
+    return True
+
+  def close(self):
+    """Encode all queued frames and release the file."""
+    self.closed = True
+    self.queue.put(None)
+    self.join()
+
+    if self.dropped:
+      self.logger.warning('Dropped {} of {} frames'.format(self.dropped, self.dropped + self.written))
+
+  @property
+  def duration(self):
+    """Seconds of video encoded so far."""
+    return self.slots / self.fps
+
+  def encode(self, frame, timestamp):
+    """
+    Encode frame at the output slot matching its capture time.
+
+    @param array frame
+    @param float timestamp
+    @return bool False if the frame was skipped
+    """
+    if timestamp is None:
+      slot = self.slots
+    else:
+      if self.start_time is None:
+        self.start_time = timestamp
+
+      slot = int(round((timestamp - self.start_time) * self.fps))
+
+    # Arrived faster than the output frame rate
+    if slot < self.slots:
+      self.skipped += 1
+      return False
+
+    # Hold the previous frame over frames the camera didn't deliver
+    while self.slots < slot and self.last is not None:
+      self.writer.write(self.last)
+      self.slots += 1
+      self.repeated += 1
+
+    self.writer.write(frame)
+    self.slots += 1
+    self.last = frame
+
+    return True
+
+  def run(self):
+    """Encoder loop."""
+    try:
+      if self.pre_roll is not None:
+        for frame, timestamp in self.pre_roll.items():
+          if self.encode(frame, timestamp):
+            self.pre_rolled += 1
+
+        self.pre_roll.clear()
+
+      self.pre_rolled_event.set()
+
+      while True:
+        item = self.queue.get()
+
+        if item is None:
+          break
+
+        if self.encode(*item):
+          self.written += 1
+    finally:
+      self.pre_rolled_event.set()
+      self.last = None
+      self.writer.release()
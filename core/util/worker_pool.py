@@ -0,0 +1,76 @@
+import queue
+import logging
+import threading
+from concurrent.futures import Future
+from util.metrics import metrics
+
+
+class WorkerPool:
+  def __init__(self, workers=2):
+    """
+    Bounded pool running the heavy detection stage of several streams.
+    Every stream has at most one job queued or running. A stream submitting faster than the pool keeps up
+    has its frames skipped instead of crowding out the others, so streams are served round robin.
+
+    @param int workers Threads, e.g. one per core left over after capture
+    """
+    self.name = self.__class__.__name__
+    self.logger = logging.getLogger(self.name)
+
+    self.queue = queue.Queue()
+    self.lock = threading.Lock()
+    # Latest job per stream
+    self.jobs = {}
+
+    for i in range(workers):
+      threading.Thread(target=self.work, name='{}-{}'.format(self.name, i), daemon=True).start()
+
+  def submit(self, key, fn, *args):
+    """
+    Queue a job unless the stream's previous job is still pending. Returns immediately.
+
+    @param string key Stream
+    @param callable fn
+    @return bool Whether the job was queued
+    """
+    with self.lock:
+      job = self.jobs.get(key)
+
+      if job is not None and not job.done():
+        metrics.counter('pool_jobs_skipped').inc()
+        return False
+
+      job = Future()
+      self.jobs[key] = job
+
+    self.queue.put((job, fn, args))
+
+    return True
+
+  def take(self, key):
+    """
+    Take the stream's finished job.
+
+    @param string key
+    @return Future|None None if there is none or it's still pending
+    """
+    with self.lock:
+      job = self.jobs.get(key)
+
+      if job is None or not job.done():
+        return None
+
+      del self.jobs[key]
+
+    return job
+
+  def work(self):
+    """Worker loop."""
+    while True:
+      job, fn, args = self.queue.get()
+
+      try:
+        job.set_result(fn(*args))
+      except Exception as e:
+        self.logger.exception('Job failed')
+        job.set_exception(e)
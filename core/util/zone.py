@@ -0,0 +1,88 @@
+from util.detector import Detector
+from util.topology import worker_kind
+
+
+class Zone:
+  def __init__(self, name, workers, recorders, trigger, segments=None):
+    """
+    Detectors and recorders which are triggered and recorded together.
+
+    @param string name None for the single zone without a topology
+    @param list workers Detectors of this zone
+    @param list recorders Recorders of this zone, at most one camera and one microphone
+    @param Trigger trigger
+    @param SegmentStore segments Segment buffer in continuous mode
+    """
+    self.name = name
+    self.workers = workers
+    self.recorders = recorders
+    self.trigger = trigger
+    self.segments = segments
+    self.sources = {w.name for w in workers if isinstance(w, Detector)}
+
+    # Name and start time of the current recording and segment
+    self.filename = None
+    self.segment = None
+
+  def clip_name(self, timestamp):
+    """
+    @param datetime timestamp
+    @return string
+    """
+    name = timestamp.strftime("%Y%m%d_%H%M%S")
+
+    return name if self.name is None else '{}_{}'.format(name, self.name)
+
+  def start_recording(self, path):
+    """
+    Start all recorders.
+
+    @param string path Recording destination without extension
+    """
+    for t in self.recorders:
+      t.start_recording(path)
+
+  def stop_recording(self):
+    """Stop all recorders."""
+    for t in self.recorders:
+      t.stop_recording()
+
+  def switch_recording(self, path):
+    """
+    Move all recorders on to a new file without a gap.
+
+    @param string path Recording destination without extension
+    """
+    for t in self.recorders:
+      t.switch_recording(path)
+
+  def finish_recording(self):
+    """Finish the previous files of all recorders."""
+    for t in self.recorders:
+      t.finish_recording()
+
+  def take_peaks(self):
+    """
+    Collect the highest level every kind of detector measured since the last call.
+
+    @return dict
+    """
+    peaks = {}
+
+    for t in self.workers:
+      if isinstance(t, Detector):
+        peak = t.take_peak()
+        kind = worker_kind(t.name)
+
+        if peak is not None and (kind not in peaks or peak > peaks[kind]):
+          peaks[kind] = peak
+
+    return peaks
+
+  def take_tracks(self):
+    """
+    Collect summaries of objects tracked since the last call.
+
+    @return list(dict) Each with the detector it was tracked by as source
+    """
+    return [dict(track, source=t.name) for t in self.workers if isinstance(t, Detector) for track in t.take_tracks()]
@@ -8,12 +8,20 @@ import numpy as np
 import cv2
 import threading
 import subprocess
-from collections import deque
 from pathlib import Path
 from dotenv import load_dotenv
 import logging
-from util.recorder import Recorder
+from util.recorder import Recorder, write_start_time
 from util.detector import Detector
+from util.sliding_window import SlidingWindow
+from util.motion_pipeline import create_pipeline, load_roi
+from util.video_writer import VideoWriter
+from util.ring_buffer import FrameRingBuffer
+from util.face_detector import FaceDetector
+from util.tracker import Tracker, find_targets
+from util.preview import preview
+from util.metrics import metrics
+from util.calibration import calibration
 
 PROJECT_ROOT = Path(__file__).resolve().parent.parent.parent
 CONFIG_PATH = os.path.join(PROJECT_ROOT, 'config')
@@ -23,14 +31,24 @@ DOTENV_PATH = os.path.join(PROJECT_ROOT, '.env')
 load_dotenv(DOTENV_PATH)
 
 class MotionDetector(threading.Thread, Recorder, Detector):
-    def __init__(self):
+    # Relative change of the measured frame rate, at least 2 FPS, that resizes the buffers
+    FPS_CHANGE = 0.1
+
+    def __init__(self, source=None, name=None, camera=None, pool=None):
+        """
+        @param source Anything with cv2.VideoCapture's read() and release(), defaults to the camera
+        @param string name Defaults to the class name
+        @param int|string camera Device index or path, defaults to CAMERA
+        @param WorkerPool pool Shared pool to run motion detection on, runs on this thread if not given
+        """
         threading.Thread.__init__(self)
 
-        self.name = self.__class__.__name__
+        self.name = name or self.__class__.__name__
         self.logger = logging.getLogger(self.name)
 
         # Time in seconds to be observed for motion
         self.OBSERVER_LENGTH = int(os.getenv('OBSERVER_LENGTH'))
+        # Percentage of moved pixels
         self.threshold = 3  # float(os.getenv('MOTION_THRESHOLD'))
 
         self.do_add_contours = int(os.getenv('ADD_CONTOURS'))
@@ -39,19 +57,148 @@ class MotionDetector(threading.Thread, Recorder, Detector):
         self.detect_faces = int(os.getenv('FACE_DETECTION'))
         self.show_image = int(os.getenv('SHOW_IMAGE'))
 
-        self.source = self.init_camera()
+        self.camera = camera if camera is not None else int(os.getenv('CAMERA'))
+        self.source = source if source is not None else self.init_camera(self.camera)
+        self.pool = pool
+        # Without detection frames are only needed while recording, pre-rolling or previewing
+        self.grab_only = hasattr(self.source, 'grab') and not (
+            self.enable_motion_detection or self.detect_faces or self.show_image)
+        # Frames of zero-copy sources are shared and must not be modified or kept
+        self.zero_copy = getattr(self.source, 'zero_copy', False)
+        # Sources which know when a frame was captured, others are stamped on arrival
+        self.timestamped = hasattr(self.source, 'timestamp')
         self.codec = cv2.VideoWriter_fourcc('M', 'J', 'P', 'G')  # (*'X264')
-        self.height, self.width = self.get_dimensions(self.source)
 
-        self.face_cascade = cv2.CascadeClassifier(os.path.join(
-            CONFIG_PATH, 'haarcascade_frontalface_default.xml'))
+        # File sources know their frame rate, cameras are calibrated once and re-measured in the background
+        self.calibrate = not hasattr(self.source, 'fps')
+        self.calibration_key = 'camera:{}'.format(self.camera)
+        cached = calibration.get(self.calibration_key) if self.calibrate else None
+
+        if cached:
+            self.height, self.width, self.fps = cached['height'], cached['width'], cached['fps']
+            self.logger.info('Using calibration: {}x{} at {} FPS'.format(self.width, self.height, self.fps))
+        else:
+            self.height, self.width = self.get_dimensions(self.source)
+            self.fps = getattr(self.source, 'fps', None) or self.find_fps(self.source)
+
+            if self.calibrate:
+                calibration.set(self.calibration_key, width=self.width, height=self.height, fps=self.fps)
+
+        # Only count motion of objects that persist and move, if enabled
+        self.tracker = None
+        self.min_area = int(os.getenv('MOTION_MIN_AREA', 500))
+
+        if int(os.getenv('MOTION_TRACKING', 0)):
+            self.tracker = Tracker(
+                max_distance=float(os.getenv('TRACK_MAX_DISTANCE', 80)),
+                max_missed=int(os.getenv('TRACK_MAX_MISSED', 5)),
+                min_frames=int(os.getenv('TRACK_MIN_FRAMES', 5)),
+                min_travel=float(os.getenv('TRACK_MIN_TRAVEL', 30)))
+
+        # Face detection runs on its own thread every few frames
+        self.face_detector = None
+
+        if self.detect_faces:
+            self.face_detector = FaceDetector(
+                os.path.join(CONFIG_PATH, 'haarcascade_frontalface_default.xml'),
+                self.fps,
+                min_interval=int(os.getenv('FACE_DETECTION_INTERVAL', 5)),
+                budget=float(os.getenv('FACE_DETECTION_BUDGET', 0.25)),
+                only_on_motion=bool(int(os.getenv('FACE_DETECTION_ON_MOTION', 1))))
+
+        # Frames waiting to be encoded and what to do if the encoder can't keep up
+        self.queue_size = int(os.getenv('RECORDING_QUEUE_SIZE', 60))
+        self.drop_policy = os.getenv('RECORDING_DROP_POLICY', 'newest')
+
+        # Swapping the writer and touching the pre-roll buffer must not overlap
+        self.lock = threading.Lock()
+
+        self.init_buffers()
+
+        # Frame rate measured off by more than {FPS_CHANGE}, applied once the next measurement confirms it
+        self.measured_fps = None
+        # Confirmed frame rate waiting until nothing is detected or recorded
+        self.resize_fps = None
+
+        self.recording_start = None
+        self.writer = None
+        # Writers and start times of files left behind by switch_recording()
+        self.finishing = []
+
+    def init_buffers(self):
+        """Allocate everything depending on frame dimensions and FPS."""
+        # Detect on a downscaled copy, optionally restricted to a region of interest
+        self.pipeline = create_pipeline(
+            os.getenv('MOTION_ENGINE', 'diff'),
+            self.width, self.height,
+            scale=float(os.getenv('MOTION_SCALE', 1)),
+            roi=load_roi(os.getenv('MOTION_ROI'), self.width, self.height),
+            pixel_threshold=int(os.getenv('MOTION_PIXEL_THRESHOLD', 15)),
+            learning_rate=float(os.getenv('MOTION_LEARNING_RATE', 0.02)),
+            illumination_change=float(os.getenv('MOTION_ILLUMINATION_CHANGE', 10)))
+
+        # Keep the last {PRE_ROLL_LENGTH} seconds to prepend to recordings
+        self.pre_roll = FrameRingBuffer(int(os.getenv('PRE_ROLL_LENGTH', 0)) * self.fps, (self.height, self.width, 3))
+        self.logger.info('Pre-roll buffer: {} frames, {:.1f} MB'.format(
+            self.pre_roll.capacity, self.pre_roll.nbytes / 1024 / 1024))
+
+        # Movement of the last {OBSERVER_LENGTH} seconds
+        self.observer = SlidingWindow(self.fps * self.OBSERVER_LENGTH, self.threshold)
+
+    def recalibrate(self, frame, frames, elapsed):
+        """
+        Compare the live camera with its calibration and update it if necessary.
+
+        @param array frame Current frame
+        @param int frames Frames read during {elapsed}
+        @param float elapsed Seconds
+        """
+        height, width = frame.shape[:2]
 
-        self.fps = self.find_fps(self.source)
+        if (height, width) != (self.height, self.width):
+            self.logger.warning('Camera delivers {}x{} instead of {}x{}'.format(width, height, self.width, self.height))
 
-        self._detected = False
+            with self.lock:
+                self.height, self.width = height, width
+                self.init_buffers()
 
-        self.recording_start = None
-        self.recording = []
+            calibration.set(self.calibration_key, width=width, height=height)
+
+        if not elapsed:
+            return
+
+        fps = int(round(frames / elapsed))
+
+        # Jitter and slowdowns while encoding don't count
+        if not fps or abs(fps - self.fps) < max(2, self.FPS_CHANGE * self.fps):
+            self.measured_fps = self.resize_fps = None
+            return
+
+        if self.measured_fps is not None and (self.measured_fps > self.fps) == (fps > self.fps):
+            self.logger.info('Measured {} FPS instead of {} twice, adjusting once idle'.format(fps, self.fps))
+            self.resize_fps = fps
+            calibration.set(self.calibration_key, fps=fps)
+
+        self.measured_fps = fps
+
+    def resize_buffers(self):
+        """
+        Apply a confirmed frame rate to the buffers holding a number of seconds worth of frames.
+        Waits while recording, writers are opened with the frame rate they started with.
+        """
+        with self.lock:
+            if self.writer is not None:
+                return
+
+            self.logger.info('Adjusting FPS from {} to {}'.format(self.fps, self.resize_fps))
+            self.fps, self.resize_fps = self.resize_fps, None
+
+            # Keep what was seen so far, the motion pipeline doesn't depend on the frame rate
+            self.pre_roll.resize(int(os.getenv('PRE_ROLL_LENGTH', 0)) * self.fps)
+            self.observer.resize(self.fps * self.OBSERVER_LENGTH)
+
+        if self.face_detector:
+            self.face_detector.frame_time = 1 / self.fps
 
     def __del__(self):
         # Release camera
@@ -98,20 +245,19 @@ class MotionDetector(threading.Thread, Recorder, Detector):
 
         return fps
 
-    def init_camera(self):
+    @staticmethod
+    def init_camera(device=None):
         """
         Start the camera.
 
+        @param int|string device Defaults to CAMERA
         @return cv2.VideoCapture
         """
         # Init camera
-        camera = cv2.VideoCapture(int(os.getenv('CAMERA')))
+        camera = cv2.VideoCapture(device if device is not None else int(os.getenv('CAMERA')))
         camera.set(3, 320)
         camera.set(4, 240)
 
-        # Wait half a second for light adjustment
-        time.sleep(0.5)
-
         return camera
 
     def start_recording(self, path):
@@ -120,185 +266,300 @@ class MotionDetector(threading.Thread, Recorder, Detector):
 
         @param string path
         """
-        self.path = path
+        with self.lock:
+            self.open_writer(path)
+
+    def open_writer(self, path):
+        """
+        Start encoding into a new file, must hold the lock.
+
+        @param string path
+        """
+        # The pre-roll buffer belongs to the writer until it encoded it
+        writer = VideoWriter('{}.avi'.format(path), self.codec, self.fps, (self.width, self.height),
+                             queue_size=self.queue_size, drop_policy=self.drop_policy, pre_roll=self.pre_roll)
+        writer.start()
 
         self.recording_start = time.time()
+        self.writer = writer
 
     def stop_recording(self):
-        """Reset values to default."""
-        duration = time.time() - self.recording_start
-        fps = math.floor(len(self.recording) / duration)
-        self.logger.info('Actual FPS: {}'.format(fps))
+        """Finish encoding and reset values to default."""
+        self.writer.pre_rolled_event.wait()
 
-        self.recording_start = None
+        # Frames captured while the writer is flushed go to the pre-roll again
+        with self.lock:
+            writer, started = self.writer, self.recording_start
+            self.writer = self.recording_start = None
+
+        self.finish(writer, started)
+
+    def switch_recording(self, path):
+        """
+        Continue recording into a new file without losing a frame in between.
 
-        self.save(fps)
-        self.recording = []
+        @param string path
+        """
+        self.writer.pre_rolled_event.wait()
+
+        with self.lock:
+            self.finishing.append((self.writer, self.recording_start))
+            self.open_writer(path)
+
+    def finish_recording(self):
+        """Finish the files left behind by switch_recording()."""
+        with self.lock:
+            finishing, self.finishing = self.finishing, []
+
+        for writer, started in finishing:
+            self.finish(writer, started)
 
-    def save(self, fps):
+    def finish(self, writer, started):
         """
-        Save stored frames to file.
+        Wait for a writer to encode all frames and note when the recording started.
 
-        @param int fps
+        @param VideoWriter writer
+        @param float started Wall clock time the recording started
         """
-        writer = cv2.VideoWriter('{}.avi'.format(
-            self.path), self.codec, fps, (self.width, self.height))
+        duration = time.time() - started
 
-        for frame in self.recording:
-            writer.write(frame)
+        with metrics.timer('video_save'):
+            writer.close()
+
+        if writer.start_time is not None:
+            write_start_time(writer.path, writer.start_time)
+
+        self.logger.info('Captured {:.1f} FPS, encoded {:.1f}s at {} FPS ({} frames repeated, {} skipped)'.format(
+            writer.received / duration, writer.duration, self.fps, writer.repeated, writer.skipped))
 
     def run(self):
         """
         Main worker.
         """
-        observer = deque(maxlen=self.fps * self.OBSERVER_LENGTH)
-        previous_frame = None
+        if self.face_detector:
+            self.face_detector.start()
+
+        preview.register(self.name)
+
+        # Ignore the first half second while the camera adjusts to the light
+        warmup = self.fps // 2
+
+        # Frames counted towards the next FPS measurement
+        frames = 0
+        measure_start = time.time()
 
         while True:
+            # Not while something is detected, the observer keeps the movement that triggered it
+            if self.resize_fps and not self.detected():
+                self.resize_buffers()
+
+            calibrating = self.calibrate and (frames == 0 or time.time() - measure_start > 30)
+
+            idle = self.grab_only and not calibrating and self.writer is None and not self.pre_roll.capacity
+
+            # Nobody looks at this frame, skip decoding it
+            if idle and not preview.wants(self.name)[0]:
+                with metrics.timer('capture_grab'):
+                    grabbed = self.source.grab()
+
+                if not grabbed:
+                    self.logger.info('End of camera feed.')
+                    break
+
+                frames += 1
+                continue
+
             # Grab a frame
-            (grabbed, current_frame) = self.source.read()
+            with metrics.timer('capture_read'):
+                (grabbed, current_frame) = self.source.read()
+
+            timestamp = self.source.timestamp if self.timestamped else time.monotonic()
 
             # End of feed
             if not grabbed:
                 self.logger.info('End of camera feed.')
                 break
 
+            if self.calibrate:
+                if calibrating:
+                    self.recalibrate(current_frame, frames, time.time() - measure_start)
+                    frames = 0
+                    measure_start = time.time()
+
+                frames += 1
+
+            if warmup:
+                warmup -= 1
+
+            # Motion mask and contours of this frame, if there are any
+            mask = contours = None
+
             if self.enable_motion_detection:
-                # Gray frame
-                frame_gray = cv2.cvtColor(current_frame, cv2.COLOR_BGR2GRAY)
+                movement, mask = self.detect_motion(current_frame)
 
-                # Blur frame
-                frame_blur = cv2.GaussianBlur(frame_gray, (21, 21), 0)
+                if movement is not None and not warmup:
+                    # Add movement percentage to observer
+                    self.observer.append(movement)
+                    self.observe_level(movement)
 
-                # If there's no previous frame, us the current one
-                if previous_frame is None:
-                    previous_frame = frame_blur
-                    continue
+                    if self.tracker or self.do_add_contours:
+                        with metrics.timer('motion_track'):
+                            contours, targets = find_targets(mask, self.pipeline.scale, self.min_area)
 
-                # Delta frame
-                delta_frame = cv2.absdiff(previous_frame, frame_blur)
+                            if self.tracker:
+                                self.tracker.update(targets, timestamp)
 
-                # Threshold frame
-                threshold_frame = cv2.threshold(
-                    delta_frame, 15, 255, cv2.THRESH_BINARY)[1]
+                        if self.do_add_contours:
+                            current_frame = self.add_contours(current_frame, contours, targets)
 
-                # Dilate the thresholded image to fill in holes
-                kernel = np.ones((5, 5), np.uint8)
-                dilated_frame = cv2.dilate(
-                    threshold_frame, kernel, iterations=4)
+            detected = self.observer.exceeded > 0
 
-                # Find difference in percent
-                res = dilated_frame.astype(np.uint8)
-                movement = (np.count_nonzero(res) * 100) / res.size
+            # Motion alone isn't enough, an object has to have been tracked within the observed time
+            if self.tracker and detected:
+                last = self.tracker.last_confirmed
+                detected = last is not None and timestamp - last <= self.OBSERVER_LENGTH
 
-                # Add movement percentage to observer
-                observer.append(movement)
+            self.set_detected(detected)
 
-                if self.do_add_contours:
-                    current_frame, targets = self.add_contours(
-                        current_frame, dilated_frame)
+            if self.face_detector:
+                # Without motion detection there's nothing to gate on
+                self.face_detector.submit(current_frame, self.detected() or not self.enable_motion_detection)
 
-                # Set blurred frame as new previous frame
-                previous_frame = frame_blur
+                if self.zero_copy:
+                    current_frame = current_frame.copy()
 
-                if self.do_add_contours:
-                    current_frame, _ = self.add_contours(
-                        current_frame, dilated_frame)
+                self.face_detector.draw(current_frame)
 
-            if self.detect_faces:
-                _, current_frame = self.find_face(current_frame)
+            # Hand frame to the encoder if recording, keep it as pre-roll otherwise
+            with self.lock:
+                writer = self.writer
 
-            self._detected = sum([x > self.threshold for x in observer]) > 0
+                if not writer:
+                    self.pre_roll.append(current_frame, timestamp)
 
-            # Exit on 'q'
-            key = cv2.waitKey(1) & 0xFF
+            if writer:
+                writer.write(current_frame.copy() if self.zero_copy else current_frame, timestamp)
 
-            if key == ord('q'):
-                break
+            # Share with preview viewers, at most at the preview's frame rate
+            publish, overlay = preview.wants(self.name)
 
-            # Store frame if recording
-            if self.recording_start:
-                self.recording.append(current_frame)
+            if publish:
+                preview.publish(self.name, current_frame.copy() if self.zero_copy else current_frame,
+                                self.overlays(contours, mask) if overlay else None)
 
             # Display
             if self.show_image:
                 cv2.imshow("Current frame:", current_frame)
 
-    def detected(self):
-        """
-        Returns whether movement was detected.
-
-        @return bool
-        """
-        return self._detected
+                # Exit on 'q'
+                if cv2.waitKey(1) & 0xFF == ord('q'):
+                    break
 
-    def find_face(self, frame):
+    def detect_motion(self, frame):
         """
-        Find face in frame.
+        Run motion detection, through the shared pool if there is one.
+        With a pool the result of the previous frame is returned and frames are skipped while it's busy.
 
         @param array frame
-        @return tuple(int, array)
+        @return tuple(float, array) Percentage of moved pixels and the motion mask, None if there's no result for this frame
         """
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        if not self.pool:
+            return self.measure_motion(self.pipeline, frame)
+
+        job = self.pool.take(self.name)
+        movement, mask = None, None
+
+        if job:
+            try:
+                movement, mask = job.result()
+            except Exception as e:
+                # The pool logged the traceback, a single bad frame must not end this camera's loop
+                metrics.counter('motion_jobs_failed').inc()
+                self.logger.warning('Motion detection failed for a frame: {}'.format(e))
+                movement, mask = 0.0, np.zeros_like(self.pipeline.dilated)
 
-        faces = self.face_cascade.detectMultiScale(
-            gray,
-            scaleFactor=1.1,
-            minNeighbors=5,
-            minSize=(30, 30),
-            flags=cv2.CASCADE_SCALE_IMAGE
-        )
+        # The frame may be drawn on or reused by the source while the job is waiting
+        self.pool.submit(self.name, self.measure_motion, self.pipeline, frame.copy(),
+                         bool(self.do_add_contours or self.tracker or preview.enabled))
 
-        # Draw a rectangle around the faces
-        for (x, y, w, h) in faces:
-            cv2.rectangle(frame, (x, y), (x+w, y+h), (0, 255, 0), 2)
+        return movement, mask
+
+    @staticmethod
+    def measure_motion(pipeline, frame, copy=False):
+        """
+        @param MotionPipeline pipeline
+        @param array frame
+        @param bool copy Whether to copy the mask, as the pipeline reuses it for the next frame
+        @return tuple(float, array)
+        """
+        with metrics.timer('motion_detect'):
+            movement = pipeline.process(frame)
 
-        return len(faces), frame
+        return movement, pipeline.dilated.copy() if copy else pipeline.dilated
 
-    def add_contours(self, raw_frame, dilated_frame):
+    def add_contours(self, raw_frame, contours, targets):
         """
-        Add contours to frame.
+        Draw contours and targets on a copy of the frame.
 
         @param array raw_frame
-        @param array dilated_frame
-        @return tuple(array, list)
+        @param list contours At the resolution of the motion mask
+        @param array targets Rows of (x, y, area)
+        @return array
         """
-        # Find contours on thresholded image
-        contours, nada = cv2.findContours(
-            dilated_frame.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        contours = self.full_resolution(contours)
 
         # Make coutour frame
         contour_frame = raw_frame.copy()
 
-        # Target contours
-        targets = []
-
-        # Loop over the contour
-        for c in contours:
-            # If the contour is too small, ignore it
-            if cv2.contourArea(c) < 500:
-                # Make sure this has a less than sign, not an html escape
-                continue
-
-            # Contour data
-            M = cv2.moments(c)
-            cx = int(M['m10']/M['m00'])
-            cy = int(M['m01']/M['m00'])
+        for c, (rx, ry, _) in zip(contours, targets):
             x, y, w, h = cv2.boundingRect(c)
-            rx = x + int(w / 2)
-            ry = y + int(h / 2)
-            ca = cv2.contourArea(c)
 
             # Plot contours
             cv2.drawContours(contour_frame, [c], 0, (0, 0, 255), 2)
             cv2.rectangle(contour_frame, (x, y), (x+w, y+h), (0, 255, 0), 2)
-            cv2.circle(contour_frame, (cx, cy), 2, (0, 0, 255), 2)
-            cv2.circle(contour_frame, (rx, ry), 2, (0, 255, 0), 2)
+            cv2.circle(contour_frame, (int(rx), int(ry)), 2, (0, 255, 0), 2)
+
+        return contour_frame
+
+    def full_resolution(self, contours):
+        """
+        Map contours back to full resolution.
+
+        @param list contours At the resolution of the motion mask
+        @return list
+        """
+        if self.pipeline.scale == 1:
+            return contours
 
-            # Save target contours
-            targets.append((rx, ry, ca))
+        return [(c / self.pipeline.scale).astype(np.int32) for c in contours]
 
-        return contour_frame, targets
+    def overlays(self, contours, mask):
+        """
+        What to draw on the preview.
+
+        @param list contours Of the current frame if already found
+        @param array mask Motion mask of the current frame, if any
+        @return dict
+        """
+        if contours is None and mask is not None:
+            contours, _ = find_targets(mask, self.pipeline.scale, self.min_area)
+
+        return {
+            'contours': self.full_resolution(contours or []),
+            'faces': self.face_detector.boxes() if self.face_detector else [],
+        }
+
+    def tracks(self):
+        """
+        @return list(dict) Summaries of objects tracked since the last take_tracks()
+        """
+        return self.tracker.summarize() if self.tracker else []
+
+    def take_tracks(self):
+        """
+        @return list(dict) Summaries of objects tracked since the last call
+        """
+        return self.tracker.take_summaries() if self.tracker else []
 
 
 if __name__ == "__main__":
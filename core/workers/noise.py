@@ -1,22 +1,21 @@
-import pyaudio
-import wave
-import audioop
-import subprocess
 import os
 import time
 import datetime
 import math
-import struct
 import threading
-import io
 import numpy as np
-from collections import deque
 from pathlib import Path
 import logging
-import wave
 from dotenv import load_dotenv
-from util.recorder import Recorder
+from util.recorder import Recorder, write_start_time
+from util.audio_writer import AudioWriter
 from util.detector import Detector
+from util.sliding_window import SlidingWindow
+from util.ring_buffer import ByteRingBuffer
+from util.metrics import metrics
+from util.sources import MicrophoneSource, CallbackMicrophoneSource
+from util.calibration import calibration
+from util.audio_analysis import BandAnalyzer, parse_bands
 
 PROJECT_ROOT = Path(__file__).resolve().parent.parent.parent
 
@@ -25,122 +24,182 @@ DOTENV_PATH = os.path.join(PROJECT_ROOT, '.env')
 load_dotenv(DOTENV_PATH)
 
 class NoiseDetector(threading.Thread, Recorder, Detector):
-    def __init__(self):
+    def __init__(self, source=None, name=None, device=None):
+        """
+        @param source Anything with read(num_frames), rate and channels, defaults to the microphone
+        @param string name Defaults to the class name
+        @param int device PyAudio device index, defaults to AUDIO_DEVICE_ID
+        """
         threading.Thread.__init__(self)
 
-        self.name = self.__class__.__name__
+        self.name = name or self.__class__.__name__
         self.logger = logging.getLogger(self.name)
 
-        self.FORMAT = pyaudio.paInt16
+        # 16 bit samples
+        self.SAMPLE_WIDTH = 2
         # Hz, so samples (bytes) per second, e.g. 44100 or 48000
         self.RATE = int(os.getenv('AUDIO_SAMPLE_RATE'))
         # How many bytes to read from mic each time (stream.read()), e.g. 512 or 2048
         self.CHUNK_SIZE = int(os.getenv('AUDIO_CHUNK_SIZE'))
+        self.CHANNELS = int(os.getenv('AUDIO_CHANNELS'))
+        device = int(device if device is not None else os.getenv('AUDIO_DEVICE_ID'))
+
+        # Microphones are calibrated once and keep adapting in the background
+        self.calibrate = source is None
+        self.calibration_key = 'microphone:{}:{}'.format(device, self.RATE)
+
+        if source is None and os.getenv('AUDIO_CAPTURE_MODE', 'callback') == 'callback':
+            source = CallbackMicrophoneSource(device, self.RATE, self.CHANNELS, self.CHUNK_SIZE,
+                                              buffer_seconds=float(os.getenv('AUDIO_BUFFER_LENGTH', 5)))
+        elif source is None:
+            source = MicrophoneSource(device, self.RATE, self.CHANNELS, self.CHUNK_SIZE)
+
+        self.source = source
+        self.RATE = source.rate
+        self.CHANNELS = source.channels
+        self.BYTE_RATE = self.RATE * self.CHANNELS * self.SAMPLE_WIDTH
         # How many chunks make a second? (example: 16.000 bytes/s, each chunk is 1.024 bytes, so 1s is 15 chunks)
         self.CHUNKS_PER_SEC = math.floor(self.RATE / self.CHUNK_SIZE)
-        self.CHANNELS = int(os.getenv('AUDIO_CHANNELS'))
+
         # Time in seconds to be observed after noise
         self.OBSERVER_LENGTH = 5
-        # Seconds of audio cache for prepending to records to prevent chopped phrases (history length + observer length = min record length)
-        self.HISTORY_LENGTH = 0
+        # Seconds of audio cache for prepending to records to prevent chopped phrases (pre-roll length + observer length = min record length)
+        self.PRE_ROLL_LENGTH = int(os.getenv('PRE_ROLL_LENGTH', 0))
 
-        self.chunk = None
+        # Time constant in seconds of the background noise floor adaptation
+        self.ADAPTATION_TIME = 60
+        # Number of chunks analyzed at once
+        self.BLOCK_CHUNKS = int(os.getenv('AUDIO_ANALYSIS_BLOCK', 8))
 
-        self.audio = pyaudio.PyAudio()
-        self.stream = self.get_stream()
+        # Per-band energies against a per-band noise floor
+        self.analyzer = BandAnalyzer(
+            self.RATE, self.CHUNK_SIZE, self.CHANNELS,
+            bands=parse_bands(os.getenv('NOISE_BANDS')),
+            factor=float(os.getenv('NOISE_BAND_FACTOR', 3)),
+            adaptation_time=self.ADAPTATION_TIME)
 
-        self.threshold = self.determine_threshold()
+        # Anything this much louder than the noise floor in any band is considered noise
+        self.threshold = self.analyzer.factor
+
+        cached = calibration.get(self.calibration_key) if self.calibrate else None
+        self.calibrated_at = time.time()
+
+        if cached and len(cached.get('band_floor', [])) == len(self.analyzer.bands):
+            self.analyzer.floor = np.array(cached['band_floor'], np.float32)
+            self.logger.info('Using calibrated noise floor')
+        else:
+            self.determine_noise_floor()
+
+        self.logger.info('Noise floor per band: {}'.format(', '.join(
+            '{:.0f}-{:.0f} Hz: {:.3g}'.format(low, high, floor)
+            for (low, high), floor in zip(self.analyzer.bands, self.analyzer.floor))))
 
         # Prepend audio from before noise was detected
-        # Keep the last {HISTORY_LENGTH} seconds in history
-        self.history = deque(maxlen=self.HISTORY_LENGTH * self.CHUNKS_PER_SEC)
-        self._detected = False
-        self.record = []
-        self.recording = False
+        # Keep the last {PRE_ROLL_LENGTH} seconds in pre-roll
+        self.pre_roll = ByteRingBuffer(
+            self.PRE_ROLL_LENGTH * self.RATE * self.CHANNELS * self.SAMPLE_WIDTH)
+        self.logger.info('Pre-roll buffer: {:.1f} MB'.format(self.pre_roll.nbytes / 1024 / 1024))
+
+        # Recordings are encoded while they're recorded, as AAC unless configured otherwise
+        self.codec = os.getenv('AUDIO_CODEC', 'aac')
+        self.bitrate = os.getenv('AUDIO_BITRATE', '128k')
+
+        # Swapping the writer and touching the pre-roll buffer must not overlap
+        self.lock = threading.Lock()
+
+        self.writer = None
+        # Writers and start times of files left behind by switch_recording()
+        self.finishing = []
+        # Capture time of the first recorded frame
+        self.record_start = None
+        # Capture time right after the last block read
+        self.timestamp = None
 
     def __del__(self):
-        # Stop recording
-        if self.stream:
-            self.stream.close()
+        # Release audio source
+        if self.source:
+            self.source.close()
+
+    def determine_noise_floor(self):
+        """Determine background noise intensity per band."""
+        self.logger.info("Determining noise floor...")
+
+        self.analyzer.calibrate(b''.join(self.source.read(self.CHUNK_SIZE) for x in range(50)))
+        self.save_calibration()
 
-        if self.audio:
-            self.audio.terminate()
+    def save_calibration(self):
+        """Persist the current noise floor."""
+        if self.calibrate:
+            calibration.set(self.calibration_key, band_floor=[float(f) for f in self.analyzer.floor])
 
-    def get_stream(self):
+        self.calibrated_at = time.time()
+
+    def start_recording(self, path):
         """
-        Open audio stream.
+        Setup the recorder.
 
-        @return PyAudio
+        @param string path
         """
-        return self.audio.open(
-            format=self.FORMAT,
-            channels=self.CHANNELS,
-            rate=self.RATE,
-            input=True,
-            input_device_index=int(os.getenv('AUDIO_DEVICE_ID')),
-            frames_per_buffer=self.CHUNK_SIZE
-        )
-
-    def determine_threshold(self):
+        with self.lock:
+            self.open_writer(path)
+
+    def open_writer(self, path):
         """
-        Determine threshold noise intensity using RMS.
-        Anything below the threshold is considered silence
+        Start encoding into a new file, must hold the lock.
 
-        @return float
+        @param string path
         """
-        self.logger.info("Determining noise threshold...")
-        start = time.time()
+        pre_roll = self.pre_roll.read()
+        self.pre_roll.clear()
 
-        res = []
-        for x in range(50):
-            block = self.stream.read(
-                self.CHUNK_SIZE, exception_on_overflow=False)
-            rms = self.get_rms(block)
-            res.append(rms)
+        writer = AudioWriter(path, self.RATE, self.CHANNELS, codec=self.codec, bitrate=self.bitrate, pre_roll=pre_roll)
+        writer.start()
+        self.writer = writer
 
-        # Set threshold to 50% above average
-        threshold = (sum(res) / len(res)) * 1.5
-        self.logger.info("Setting threshold to: {}".format(threshold))
+        # Otherwise taken from the first block recorded
+        self.record_start = None
 
-        return threshold
+        if self.timestamp is not None:
+            self.record_start = self.timestamp - len(pre_roll) / self.BYTE_RATE
 
-    def get_rms(self, block):
-        """
-        Calculate Root Mean Square (noise level) for audio chunk.
+    def stop_recording(self):
+        """Finish encoding and reset values to default."""
+        with self.lock:
+            writer, record_start = self.writer, self.record_start
+            self.writer = self.record_start = None
 
-        @param bytes block
-        @return float
-        """
-        d = np.frombuffer(block, np.int16).astype(float)
-        return np.sqrt((d * d).sum() / len(d))
+        self.finish(writer, record_start)
 
-    def start_recording(self, path):
+    def switch_recording(self, path):
         """
-        Setup the recorder.
+        Continue recording into a new file without losing a sample in between.
 
         @param string path
         """
-        self.save_path = '{}.wav'.format(path)
-        self.recording = True
+        with self.lock:
+            self.finishing.append((self.writer, self.record_start))
+            self.open_writer(path)
 
-    def stop_recording(self):
-        """
-        Reset variables to default
+    def finish_recording(self):
+        """Finish the files left behind by switch_recording()."""
+        with self.lock:
+            finishing, self.finishing = self.finishing, []
+
+        for writer, record_start in finishing:
+            self.finish(writer, record_start)
+
+    def finish(self, writer, record_start):
         """
-        self.save()
+        Wait for a writer to encode all audio and note when the recording started.
 
-        self.save_path = None
-        self.recording = False
-        self.record = []
+        @param AudioWriter writer
+        @param float record_start Capture time of the first recorded sample
+        """
+        with metrics.timer('audio_save'):
+            writer.close()
 
-    def save(self):
-        """Create wave file from recorded chunks."""
-        wf = wave.open(self.save_path, 'wb')
-        wf.setnchannels(self.CHANNELS)
-        wf.setsampwidth(self.audio.get_sample_size(self.FORMAT))
-        wf.setframerate(self.RATE)
-        wf.writeframes(b''.join(self.record))
-        wf.close()
+        if record_start is not None:
+            write_start_time(writer.path, record_start)
 
     def run(self):
         """
@@ -148,38 +207,58 @@ class NoiseDetector(threading.Thread, Recorder, Detector):
         Noise is defined as sound surrounded by silence (according to threshold)
         """
 
-        # Stores audio intensity of previous sound-chunks
+        # Stores how far previous sound-chunks exceeded the noise floor
         # If one of these chunks is above threshold, recording gets triggered
         # Keep the last {OBSERVER_LENGTH} seconds in observer
-        observer = deque(maxlen=self.OBSERVER_LENGTH * self.CHUNKS_PER_SEC)
+        observer = SlidingWindow(self.OBSERVER_LENGTH * self.CHUNKS_PER_SEC, self.threshold)
+
+        # Chunks are read and analyzed in blocks
+        chunk_bytes = self.CHUNK_SIZE * self.CHANNELS * self.SAMPLE_WIDTH
+        block_bytes = self.BLOCK_CHUNKS * chunk_bytes
 
         self.logger.info("Listening...")
 
         try:
             while True:
-                # Current chunk of audio data
-                self.chunk = self.stream.read(
-                    self.CHUNK_SIZE, exception_on_overflow=False)
-                self.history.append(self.chunk)
+                # Current block of audio data
+                with metrics.timer('audio_read'):
+                    block = self.source.read(self.CHUNK_SIZE * self.BLOCK_CHUNKS)
 
-                # Add noise level of this chunk to the sliding-window
-                rms = self.get_rms(self.chunk)
-                observer.append(rms)
+                with self.lock:
+                    if self.writer:
+                        if self.record_start is None:
+                            self.record_start = self.source.timestamp
 
-                if self.recording:
-                    self.record.append(self.chunk)
+                        self.writer.write(block)
+                    else:
+                        self.pre_roll.write(block)
 
-                self._detected = sum([x > self.threshold for x in observer]) > 0
-        except KeyboardInterrupt:
-            self.logger.info("Interrupted.")
+                    self.timestamp = self.source.timestamp + len(block) / self.BYTE_RATE
 
-    def detected(self):
-        """
-        Returns whether noise was detected.
+                # Only whole chunks are analyzed
+                chunks = len(block) // chunk_bytes
 
-        @return bool
-        """
-        return self._detected
+                if chunks:
+                    # Add noise level of the block's chunks to the sliding-window
+                    with metrics.timer('audio_analysis'):
+                        rms, scores = self.analyzer.process(block[:chunks * chunk_bytes])
+
+                    for score in scores:
+                        observer.append(score)
+
+                    self.observe_level(float(rms.max()))
+
+                    self.set_detected(observer.exceeded > 0)
+
+                # End of feed
+                if len(block) < block_bytes:
+                    self.logger.info('End of audio feed.')
+                    break
+
+                if time.time() - self.calibrated_at > self.ADAPTATION_TIME:
+                    self.save_calibration()
+        except KeyboardInterrupt:
+            self.logger.info("Interrupted.")
 
 if __name__ == "__main__":
     nd = NoiseDetector()
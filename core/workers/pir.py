@@ -1,10 +1,10 @@
 import os
-import RPi.GPIO as GPIO
 import time
 import threading
 from pathlib import Path
 from dotenv import load_dotenv
 from util.detector import Detector
+from util.sources import GPIOSource
 
 PROJECT_ROOT = Path(__file__).resolve().parent.parent.parent
 
@@ -12,26 +12,20 @@ PROJECT_ROOT = Path(__file__).resolve().parent.parent.parent
 DOTENV_PATH = os.path.join(PROJECT_ROOT, '.env')
 load_dotenv(DOTENV_PATH)
 
-SENSOR_PIN = int(os.getenv('PIR_SENSOR_PIN'))
-
-GPIO.setmode(GPIO.BCM)
-GPIO.setup(SENSOR_PIN, GPIO.IN)
-
 class PIRDetector(threading.Thread, Detector):
-    def __init__(self):
+    def __init__(self, source=None, name=None, pin=None):
+        """
+        @param source Anything with input(), watch(callback) and close(), defaults to the GPIO pin
+        @param string name Defaults to the class name
+        @param int pin Defaults to PIR_SENSOR_PIN
+        """
         threading.Thread.__init__(self)
 
-        self.name = self.__class__.__name__
+        self.name = name or self.__class__.__name__
 
-        self._detected = False
-
-    def detected(self):
-        """
-        Returns whether movement was detected.
-
-        @return bool
-        """
-        return self._detected
+        # The GPIO pin is only set up once the detector runs
+        self.source = source
+        self.pin = pin if pin is not None else os.getenv('PIR_SENSOR_PIN')
 
     def callback(self, channel):
         """
@@ -39,21 +33,20 @@ class PIRDetector(threading.Thread, Detector):
 
         @param int channel
         """
-        if GPIO.input(SENSOR_PIN):
-            self._detected = True
-        else:
-            time.sleep(3)  # You might also do this on the sensor directly
-            self._detected = False
+        # How long a detection is held after the sensor cleared is up to the manager (TRIGGER_HOLD)
+        self.set_detected(self.source.input())
 
     def run(self):
         """Main entry point."""
+        if self.source is None:
+            self.source = GPIOSource(int(self.pin))
+
         try:
-            GPIO.add_event_detect(SENSOR_PIN, GPIO.BOTH,
-                                  callback=self.callback)
+            self.source.watch(self.callback)
 
             while True:
                 time.sleep(100)
         except KeyboardInterrupt:
             pass
 
-        GPIO.cleanup()
+        self.source.close()
@@ -3,6 +3,60 @@ const path = require('path');
 const fs = require('fs');
 const router = express.Router();
 const archive = path.resolve(__dirname, '../../archive');
+const listingPath = path.join(archive, 'records.json');
+
+// Listing written by the archive index, only re-read when it changed
+let listing = { mtime: 0, records: [] };
+
+/**
+ * Start of a clip in unix time from its YYYYmmdd_HHMMSS name, like the archive index does
+ * Falls back to the file's modification time
+ */
+function parseTime(name, file) {
+    const m = name.match(/^(\d{4})(\d{2})(\d{2})_(\d{2})(\d{2})(\d{2})/);
+
+    if (m) {
+        return new Date(m[1], m[2] - 1, m[3], m[4], m[5], m[6]).getTime() / 1000;
+    }
+
+    return fs.statSync(file).mtimeMs / 1000;
+}
+
+/**
+ * Get all records from the precomputed listing, newest first
+ * Falls back to scanning the archive if there is no listing yet
+ */
+function getRecords() {
+    let stat;
+
+    try {
+        stat = fs.statSync(listingPath);
+    } catch (e) {
+        return fs.readdirSync(archive)
+            .filter(f => f.split('.').pop() == 'mp4')
+            .map(f => {
+                const name = f.replace(/\.[^/.]+$/, "");
+                return { name, started: parseTime(name, path.join(archive, f)), sources: [], tracks: [] };
+            })
+            .sort((a, b) => b.started - a.started);
+    }
+
+    if (stat.mtimeMs != listing.mtime) {
+        listing = { mtime: stat.mtimeMs, records: JSON.parse(fs.readFileSync(listingPath)) };
+    }
+
+    return listing.records;
+}
+
+/**
+ * Get poster of a record
+ */
+router.get('/:filename/poster', async (req, res) => {
+    // Make sure we don't have any relative path
+    const filename = path.basename(req.params.filename + ".jpg");
+
+    res.sendFile(path.join(archive, 'posters', filename));
+});
 
 /**
  * Get record by filename
@@ -17,11 +71,30 @@ router.get('/:filename', async (req, res) => {
 
 /**
  * Get all records
+ * Optional query: source, since and until (unix time), offset, limit
+ * Returns record names unless details is set
  */
 router.get('/', async (req, res) => {
-    const records = fs.readdirSync(archive).filter(f => f.split('.').pop() == 'mp4').map(f => f.replace(/\.[^/.]+$/, ""));
+    let records = getRecords();
+    const { source, since, until, details } = req.query;
+
+    if (source) {
+        records = records.filter(r => r.sources.includes(source));
+    }
+
+    if (since) {
+        records = records.filter(r => r.started >= Number(since));
+    }
+
+    if (until) {
+        records = records.filter(r => r.started < Number(until));
+    }
+
+    const offset = Number(req.query.offset) || 0;
+    const limit = Number(req.query.limit) || records.length;
+    records = records.slice(offset, offset + limit);
 
-    res.json(records);
+    res.json(details ? records : records.map(r => r.name));
 });
 
 module.exports = {